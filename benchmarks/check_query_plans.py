@@ -0,0 +1,161 @@
+import os
+import sys
+import json
+import argparse
+import tempfile
+from pathlib import Path
+from datetime import date, timedelta
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'scripts')))
+from run import SCHEMA, configure_environment
+
+# Schedule of the seeded network: every trip runs every day, its stops two minutes apart, with realtime rows
+# for every stop time already passed, written shortly before and at the actual arrival
+SEED = """
+    INSERT INTO gtfs_data (trip_id, start_date, stop_sequence, stop_id, route_id, stop_name, route_long_name,
+                           arrival_time, departure_time, geo_coordinates)
+    SELECT 't' || t, d::date, s, (t * 7 + s) %% %(stops)s, 'r' || t %% %(routes)s, 'Stop ' || s, 'Route ' || t %% %(routes)s,
+        d + interval '5 hours' + (t %% 72) * interval '15 minutes' + s * interval '2 minutes',
+        d + interval '5 hours' + (t %% 72) * interval '15 minutes' + s * interval '2 minutes' + interval '30 seconds',
+        '46.49,-80.99'
+    FROM generate_series(%(first_day)s::date, %(last_day)s::date, interval '1 day') AS d,
+        generate_series(1, %(trips)s) AS t, generate_series(1, %(stops_per_trip)s) AS s;
+
+    INSERT INTO trip_updates (trip_id, start_date, stop_sequence, stop_id, arrival_time, departure_time, created_at, updated_at)
+    SELECT trip_id, start_date, stop_sequence, stop_id::text,
+        arrival_time + (stop_sequence %% 5) * interval '1 minute', departure_time + (stop_sequence %% 5) * interval '1 minute',
+        arrival_time - interval '10 minutes', arrival_time
+    FROM gtfs_data
+    WHERE arrival_time <= now();
+
+    INSERT INTO weather_observations (observed_at, weather_id, weather_group, weather_description, temperature, fetched_at)
+    SELECT o, 800, 'Clear', 'clear sky', 10, o
+    FROM generate_series(%(first_day)s::timestamptz, now(), interval '10 minutes') AS o;
+"""
+
+
+def seed(cur, args):
+    cur.execute(SCHEMA)
+    from lib.weather import ensure_weather_table
+    from lib.rollups import ensure_rollup_table
+    ensure_weather_table(cur)
+    ensure_rollup_table(cur)
+    last_day = date.today()
+    cur.execute(SEED, {'first_day': last_day - timedelta(days=args.days - 1), 'last_day': last_day, 'trips': args.trips,
+                       'stops_per_trip': args.stops_per_trip, 'stops': args.stops, 'routes': args.routes})
+
+
+def seq_scans(plan):
+    # (relation, estimated rows) of every sequential scan of a plan
+    if plan.get('Node Type') == 'Seq Scan':
+        yield plan['Relation Name'], plan['Plan Rows']
+    for child in plan.get('Plans', []):
+        yield from seq_scans(child)
+
+
+def checked_queries(cur):
+    # Queries of the incremental runs, with the parameters of a run right after the last realtime write
+    import diff_times
+    from export_diffs import export_query
+    from lib.rollups import ROLLUP_TABLE, create_rollup_keys, rollup_query
+
+    cur.execute("SELECT max(GREATEST(created_at, updated_at)) FROM trip_updates")
+    since = cur.fetchone()[0] - diff_times.watermark_overlap
+    cur.execute("SELECT min(start_date), max(start_date) FROM trip_updates WHERE GREATEST(created_at, updated_at) > %s", (since,))
+    first_date, last_date = cur.fetchone()
+    # A run right after the schedule of one service date was reloaded
+    params = {'since': since, 'first_date': first_date, 'last_date': last_date, 'reloaded_dates': [first_date]}
+
+    # Triples an incremental diff run would collect, so the rollup refresh is planned with realistic statistics
+    create_rollup_keys(cur)
+    cur.execute("""
+        INSERT INTO rollup_keys
+        SELECT DISTINCT d.route_id, d.stop_id, d.start_date
+        FROM trip_updates_with_diffs AS d
+        WHERE GREATEST(d.created_at, d.updated_at) > %(since)s""", params)
+    cur.execute("ANALYZE rollup_keys")
+    keys = """JOIN (SELECT DISTINCT route_id, stop_id, start_date FROM rollup_keys) AS k
+            ON d.route_id = k.route_id AND d.stop_id = k.stop_id AND d.start_date = k.start_date"""
+    return params, {
+        'diff_times incremental': diff_times.diff_query(True),
+        'rollup refresh delete': f"""
+            DELETE FROM {ROLLUP_TABLE} AS r
+            USING (SELECT DISTINCT route_id, stop_id, start_date FROM rollup_keys) AS k
+            WHERE r.route_id = k.route_id AND r.stop_id = k.stop_id AND r.start_date = k.start_date""",
+        'rollup refresh insert': rollup_query(keys),
+        'export diffs since': export_query('diffs', None, None, since),
+        'export diffs by date': export_query('diffs', first_date, last_date, None),
+        'export rollups by date': export_query('rollups', first_date, last_date, None),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seed a scratch database and fail when the incremental queries plan sequential scans of large tables.')
+    parser.add_argument('--db-url', default=os.getenv('BENCH_DB_URL'),
+                        help='Dedicated database, its tables are dropped and recreated. Defaults to BENCH_DB_URL.')
+    parser.add_argument('--days', type=int, default=28, help='Service days seeded, ending today.')
+    parser.add_argument('--trips', type=int, default=1000, help='Trips running every day.')
+    parser.add_argument('--stops-per-trip', type=int, default=20)
+    parser.add_argument('--stops', type=int, default=1000)
+    parser.add_argument('--routes', type=int, default=40)
+    parser.add_argument('--min-rows', type=int, default=10000, help='Tables with at least this many rows must not be scanned sequentially.')
+    parser.add_argument('--show-plans', action='store_true', help='Print every plan.')
+    args = parser.parse_args()
+
+    # The check drops the pipeline tables: refuse anything that does not look like a scratch database
+    if not args.db_url:
+        parser.error('a scratch database is required, with --db-url or BENCH_DB_URL')
+    if 'bench' not in args.db_url.rsplit('/', 1)[-1]:
+        parser.error('the database name must contain "bench", its tables are dropped')
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        # The scripts read their settings from the environment at import time
+        configure_environment(args.db_url, Path(work_dir))
+        import psycopg2
+        import diff_times
+        from lib.migrations import run_migrations
+        from lib.rollups import rebuild_rollups
+
+        conn = psycopg2.connect(args.db_url)
+        cur = conn.cursor()
+        print(f'Seeding {args.days} days of {args.trips} trips with {args.stops_per_trip} stops...')
+        seed(cur, args)
+        conn.commit()
+        run_migrations(conn)
+
+        # Diffs and rollups as a full rebuild leaves them, then fresh statistics for the planner
+        cur.execute(diff_times.diff_query(False))
+        rebuild_rollups(cur)
+        conn.commit()
+        cur.execute("ANALYZE")
+        cur.execute("SELECT relname, reltuples::bigint FROM pg_class WHERE relkind IN ('r', 'p') AND reltuples >= %s", (args.min_rows,))
+        large_tables = dict(cur.fetchall())
+        print('Large tables: ' + ', '.join(f'{name} ({rows:,} rows)' for name, rows in sorted(large_tables.items())))
+
+        params, queries = checked_queries(cur)
+        failures = 0
+        for name, query in queries.items():
+            cur.execute("EXPLAIN (FORMAT JSON) " + query, params)
+            plan = cur.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            plan = plan[0]['Plan']
+            if args.show_plans:
+                print(json.dumps(plan, indent=2))
+            scans = [(relation, rows) for relation, rows in seq_scans(plan) if relation in large_tables]
+            failures += bool(scans)
+            details = ', '.join(f'Seq Scan on {relation} (~{rows:,} rows)' for relation, rows in scans)
+            print(f"{'FAIL' if scans else 'ok  '} {name}: {plan['Node Type']}, cost {plan['Total Cost']:,.0f}" + (f' - {details}' if scans else ''))
+
+        conn.rollback()
+        cur.close()
+        conn.close()
+
+    if failures:
+        print(f'{failures} query plan(s) scan large tables sequentially')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import os
+import sys
+import time
+import signal
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import main_runner
+
+# URL of the engine each stage process creates. The stages of the checks never connect
+DB_URL = 'postgresql+psycopg2://localhost/unused'
+
+
+def child_pid_file():
+    return Path(os.environ['STAGE_CHECK_DIR']) / 'child.pid'
+
+
+def hung_stage(engine):
+    # Waits forever, with a child process of its own like the shards of a parallel rebuild
+    child = subprocess.Popen(['sleep', '3600'])
+    child_pid_file().write_text(str(child.pid))
+    time.sleep(3600)
+
+
+def stubborn_stage(engine):
+    # Ignores SIGTERM, as a stage blocked in a C call would until the call returns
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    time.sleep(3600)
+
+
+def ok_stage(engine):
+    return 'ok'
+
+
+def failing_stage(engine):
+    raise RuntimeError('stage failed')
+
+
+def crashing_stage(engine):
+    os._exit(1)
+
+
+def process_gone(pid):
+    # A zombie left to an init that does not reap it counts as gone
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    try:
+        return Path(f'/proc/{pid}/stat').read_text().split(') ')[1].startswith('Z')
+    except (FileNotFoundError, IndexError):
+        return True
+
+
+# Stage functions of each check and the expected statuses. Every run must end within the timeout plus the
+# grace period, with the child of the hung stage gone
+CASES = [
+    ('hung stage and its child', {'sync': hung_stage, 'diff': ok_stage}, {'sync': 'timeout_error', 'diff': 'not_run'}),
+    ('stage ignoring SIGTERM', {'sync': stubborn_stage, 'diff': ok_stage}, {'sync': 'timeout_error', 'diff': 'not_run'}),
+    ('stages that succeed', {'sync': ok_stage, 'diff': ok_stage}, {'sync': 'ok', 'diff': 'ok'}),
+    ('stage raising', {'sync': failing_stage, 'diff': ok_stage}, {'sync': 'error', 'diff': 'not_run'}),
+    ('stage exiting without a status', {'sync': crashing_stage, 'diff': ok_stage}, {'sync': 'error', 'diff': 'not_run'}),
+]
+
+
+def check_timeouts(timeout, grace):
+    # Every case on the sync and diff stages. Returns the number of failures
+    main_runner.stage_grace_seconds = grace
+    failures = 0
+    for name, functions, expected in CASES:
+        child_pid_file().unlink(missing_ok=True)
+        start = time.monotonic()
+        results, failed = main_runner.run_pipeline(['sync', 'diff'], DB_URL, {}, 2, timeout, functions)
+        seconds = time.monotonic() - start
+        statuses = {stage: status for stage, (status, _) in results.items()}
+        ok = statuses == expected and failed == any(status != 'ok' for status in expected.values())
+        ok &= seconds < timeout + grace + 10
+        if functions['sync'] is hung_stage:
+            ok &= child_pid_file().is_file() and process_gone(int(child_pid_file().read_text()))
+        failures += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {name:<32} -> {statuses} in {seconds:.1f} s (expected {expected})")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that main_runner.py stops stages that run past their timeout, with the processes they started.')
+    parser.add_argument('--timeout', type=int, default=3, help='Stage timeout of the checks, in seconds.')
+    parser.add_argument('--grace', type=int, default=2, help='Seconds between SIGTERM and SIGKILL.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.environ['STAGE_CHECK_DIR'] = work_dir
+        failures = check_timeouts(args.timeout, args.grace)
+    if failures:
+        print(f'{failures} stage timeout check(s) failed')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
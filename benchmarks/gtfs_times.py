@@ -0,0 +1,116 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import pytz
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'scripts')))
+from historical_extractor import parse_date_and_time_vectorized, service_day_origin
+
+# GTFS time, service date and expected UTC time around the 2024 DST changes in Toronto. Times count from
+# noon minus 12 hours, which is 23:00 the evening before on the spring change and 01:00 on the fall change
+DST_CASES = [
+    # Ordinary summer day: noon minus 12 hours is midnight, UTC is 4 hours ahead
+    ('08:00:00', '20240701', '2024-07-01T12:00:00Z'),
+    ('25:10:00', '20240701', '2024-07-02T05:10:00Z'),
+    # Spring forward on March 10: 02:00 to 03:00 does not exist on the clock, but GTFS times stay continuous
+    ('00:00:00', '20240310', '2024-03-10T04:00:00Z'),
+    ('02:30:00', '20240310', '2024-03-10T06:30:00Z'),
+    ('12:00:00', '20240310', '2024-03-10T16:00:00Z'),
+    ('23:59:59', '20240309', '2024-03-10T04:59:59Z'),
+    # Fall back on November 3: 01:00 to 02:00 happens twice on the clock, GTFS times are still one instant each
+    ('00:00:00', '20241103', '2024-11-03T05:00:00Z'),
+    ('01:30:00', '20241103', '2024-11-03T06:30:00Z'),
+    ('12:00:00', '20241103', '2024-11-03T17:00:00Z'),
+    ('24:30:00', '20241102', '2024-11-03T04:30:00Z'),
+    # Single-digit hour, as some feeds write it
+    ('7:05:00', '20240701', '2024-07-01T11:05:00Z'),
+]
+
+
+def legacy_parse_date_and_time_vectorized(dates, times):
+    # String-based parser that parse_date_and_time_vectorized replaced, kept here as the comparison point
+    sudbury_tz = pytz.timezone('America/Toronto')
+    hours, minutes, seconds = zip(*[map(int, time.split(':')) for time in times])
+    hours = pd.Series(hours)
+    dates = pd.to_datetime(dates, format="%Y%m%d")
+    dates += pd.to_timedelta((hours // 24).astype(int), unit='D')
+    hours %= 24
+    timestamps = pd.to_datetime(dates.astype(str) + ' ' + hours.astype(str) + ':' + pd.Series(minutes).astype(str) + ':' + pd.Series(seconds).astype(str))
+    timestamps = timestamps.dt.tz_localize(sudbury_tz)
+    return timestamps.dt.tz_convert('UTC')
+
+
+def check_dst():
+    # Every case, the missing time and the per-date cache. Returns the number of failures
+    failures = 0
+    times, dates, expected = zip(*DST_CASES)
+    actual = parse_date_and_time_vectorized(pd.Series(dates), pd.Categorical(times))
+    for time_string, date_string, wanted, got in zip(times, dates, expected, actual):
+        ok = got == pd.Timestamp(wanted)
+        failures += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {date_string} {time_string:>8} -> {got} (expected {wanted})")
+
+    missing = parse_date_and_time_vectorized(['20240701', '20240701'], pd.Series(['08:00:00', None]))
+    ok = missing.isna().tolist() == [False, True]
+    failures += not ok
+    print(f"{'ok  ' if ok else 'FAIL'} missing time -> {missing.tolist()}")
+
+    # One lookup per service date, whatever the number of rows
+    service_day_origin.cache_clear()
+    parse_date_and_time_vectorized(np.repeat(['20240310', '20241103'], 1000), np.repeat(['08:00:00'], 2000))
+    ok = service_day_origin.cache_info().misses == 2
+    failures += not ok
+    print(f"{'ok  ' if ok else 'FAIL'} service day origins cached: {service_day_origin.cache_info()}")
+    return failures
+
+
+def build_rows(rows, days, seed=1):
+    # Stop times spread over the service day and past midnight, on ordinary days away from the DST changes
+    rng = np.random.default_rng(seed)
+    seconds = rng.integers(5 * 3600, 26 * 3600, rows)
+    times = pd.Series([f'{second // 3600:02d}:{second // 60 % 60:02d}:{second % 60:02d}' for second in seconds])
+    dates = pd.Series(pd.date_range('2024-06-03', periods=days).strftime('%Y%m%d')[rng.integers(0, days, rows)])
+    return dates, times
+
+
+def best_of(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the GTFS time parser around DST changes and compare it with the legacy parser.')
+    parser.add_argument('--rows', type=int, default=500000)
+    parser.add_argument('--days', type=int, default=60)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    failures = check_dst()
+    if failures:
+        print(f'{failures} DST check(s) failed')
+        sys.exit(1)
+
+    dates, times = build_rows(args.rows, args.days)
+    categorical = pd.Categorical(times)
+    # Both parsers must agree on days without a DST change before their timings mean anything
+    pd.testing.assert_series_equal(legacy_parse_date_and_time_vectorized(dates, times).reset_index(drop=True),
+                                   parse_date_and_time_vectorized(dates, times), check_dtype=False, check_names=False)
+
+    results = {
+        'legacy parser': best_of(lambda: legacy_parse_date_and_time_vectorized(dates, times), args.repeat),
+        'parser (strings)': best_of(lambda: parse_date_and_time_vectorized(dates, times), args.repeat),
+        'parser (categorical)': best_of(lambda: parse_date_and_time_vectorized(dates, categorical), args.repeat),
+    }
+    baseline = results['legacy parser']
+    for name, seconds in results.items():
+        print(f'{name:<22} {seconds:8.3f} s  {args.rows / seconds:12,.0f} rows/s  {baseline / seconds:6.1f}x')
+
+
+if __name__ == "__main__":
+    main()
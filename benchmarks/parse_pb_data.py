@@ -0,0 +1,98 @@
+import os
+import sys
+import time
+import argparse
+import pandas as pd
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'scripts')))
+from lib import gtfs_realtime_pb2
+from realtime_extractor import parse_pb_data
+
+
+def legacy_parse_pb_data(data):
+    # Row-by-row decoder that parse_pb_data replaced, kept here as the comparison point
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(data)
+
+    parsed_data = []
+    for entity in feed.entity:
+        if entity.HasField('trip_update'):
+            trip_id = entity.trip_update.trip.trip_id
+            start_date = entity.trip_update.trip.start_date
+            for update in entity.trip_update.stop_time_update:
+                departure_time = pd.to_datetime(update.departure.time, unit='s', utc=True) if update.HasField('departure') else None
+                arrival_time = pd.to_datetime(update.arrival.time, unit='s', utc=True) if update.HasField('arrival') else None
+                parsed_data.append({
+                    'trip_id': trip_id,
+                    'start_date': start_date,
+                    'stop_sequence': update.stop_sequence,
+                    'stop_id': update.stop_id,
+                    'departure_time': departure_time,
+                    'arrival_time': arrival_time,
+                })
+
+    return pd.DataFrame(parsed_data)
+
+
+def build_feed(trips, stops_per_trip, start_epoch=1692300000):
+    # Synthetic feed where the first stop of every trip has no arrival and the last has no departure
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '2.0'
+    feed.header.timestamp = start_epoch
+    for trip in range(trips):
+        entity = feed.entity.add()
+        entity.id = str(trip)
+        entity.trip_update.trip.trip_id = f'trip-{trip}'
+        entity.trip_update.trip.start_date = '20230817'
+        for stop in range(stops_per_trip):
+            update = entity.trip_update.stop_time_update.add()
+            update.stop_sequence = stop + 1
+            update.stop_id = str(1000 + stop)
+            event_time = start_epoch + trip * 60 + stop * 90
+            if stop > 0:
+                update.arrival.time = event_time
+            if stop < stops_per_trip - 1:
+                update.departure.time = event_time + 15
+    return feed.SerializeToString()
+
+
+def best_of(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the legacy and columnar GTFS-RT decoders.')
+    parser.add_argument('--trips', type=int, default=2000)
+    parser.add_argument('--stops-per-trip', type=int, default=40)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    data = build_feed(args.trips, args.stops_per_trip)
+    rows = args.trips * args.stops_per_trip
+    print(f'Synthetic feed: {rows} stop time updates, {len(data)} bytes')
+
+    # Both decoders must agree before their timings mean anything
+    expected = legacy_parse_pb_data(data)
+    actual = parse_pb_data(data)
+    for frame in (expected, actual):
+        for column in ('arrival_time', 'departure_time'):
+            frame[column] = pd.to_datetime(frame[column], utc=True)
+    pd.testing.assert_frame_equal(expected, actual, check_dtype=False)
+
+    results = {
+        'legacy parse_pb_data': best_of(lambda: legacy_parse_pb_data(data), args.repeat),
+        'parse_pb_data (DataFrame)': best_of(lambda: parse_pb_data(data), args.repeat),
+        'parse_pb_data (columns)': best_of(lambda: parse_pb_data(data, as_frame=False), args.repeat),
+    }
+    baseline = results['legacy parse_pb_data']
+    for name, seconds in results.items():
+        print(f'{name:<28} {seconds:8.3f} s  {rows / seconds:12,.0f} rows/s  {baseline / seconds:6.1f}x')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import contextlib
+from pathlib import Path
+from datetime import date, datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'scripts')))
+import synthetic
+
+# Tables of the benchmark database, as documented in the main README
+SCHEMA = """
+    DROP TABLE IF EXISTS gtfs_data, trip_updates, trip_updates_with_diffs, etl_watermarks, schedule_reloads, weather_observations, trip_delay_rollups, schema_migrations CASCADE;
+    CREATE TABLE gtfs_data (
+        trip_id text NOT NULL,
+        start_date date NOT NULL,
+        stop_sequence bigint NOT NULL,
+        stop_id bigint NOT NULL,
+        route_id text NOT NULL,
+        stop_name text NOT NULL,
+        route_long_name text NOT NULL,
+        arrival_time timestamp with time zone,
+        departure_time timestamp with time zone,
+        geo_coordinates text NOT NULL,
+        CONSTRAINT gtfs_data_pkey PRIMARY KEY (trip_id, start_date, stop_sequence, stop_id)
+    );
+    CREATE TABLE trip_updates (
+        trip_id text NOT NULL,
+        start_date date NOT NULL,
+        stop_sequence integer NOT NULL,
+        stop_id text NOT NULL,
+        arrival_time timestamp with time zone NOT NULL DEFAULT '1969-12-31 21:00:00-03'::timestamp with time zone,
+        departure_time timestamp with time zone NOT NULL DEFAULT '1969-12-31 21:00:00-03'::timestamp with time zone,
+        weather_group text,
+        weather_description text,
+        temperature double precision,
+        created_at timestamp with time zone,
+        updated_at timestamp with time zone,
+        CONSTRAINT trip_updates_pkey PRIMARY KEY (trip_id, start_date, stop_sequence, stop_id)
+    );
+    CREATE TABLE trip_updates_with_diffs (
+        trip_id text NOT NULL,
+        start_date date NOT NULL,
+        stop_sequence integer NOT NULL,
+        stop_id bigint NOT NULL,
+        route_id text,
+        stop_name text,
+        route_long_name text,
+        actual_arrival_time timestamp with time zone,
+        scheduled_arrival_time timestamp with time zone,
+        arrival_time_diff_in_minutes double precision,
+        actual_departure_time timestamp with time zone,
+        scheduled_departure_time timestamp with time zone,
+        departure_time_diff_in_minutes double precision,
+        average_diff_in_minutes double precision,
+        weather_group text,
+        weather_description text,
+        temperature double precision,
+        day_type text,
+        sudbury_hour_of_day integer,
+        geo_coordinates text NOT NULL,
+        created_at timestamp with time zone,
+        updated_at timestamp with time zone,
+        CONSTRAINT trip_updates_with_diffs_pkey PRIMARY KEY (trip_id, start_date, stop_sequence, stop_id)
+    );
+"""
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    # Serves the synthetic static zip and the current realtime snapshot, standing in for sudbury.tmix.se
+    def do_GET(self):
+        payload = self.server.files.get(self.path)
+        if payload is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_feed_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FeedHandler)
+    server.files = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def configure_environment(db_url, work_dir):
+    # The scripts read their settings from the environment at import time, so this runs before importing them.
+    # Every database setting points at the benchmark database, every state file into the work directory
+    from sqlalchemy.engine import make_url
+    database = make_url(db_url)
+    os.environ.update({
+        'REMOTE_DB_URL': db_url,
+        'LOCAL_DB_URL': db_url,
+        'LOCAL_DB_NAME': database.database,
+        'LOCAL_DB_USERNAME': database.username or '',
+        'LOCAL_DB_PASSWORD': database.password or '',
+        'REALTIME_TABLE': 'trip_updates',
+        'HISTORICAL_TABLE': 'gtfs_data',
+        'REALTIME_STATE_FILE': str(work_dir / 'realtime_state.json'),
+        'GTFS_CACHE_DIR': str(work_dir / 'cache'),
+    })
+
+
+@contextlib.contextmanager
+def quiet(verbose):
+    # The scripts report their progress on stdout, which would drown the benchmark results
+    if verbose:
+        yield
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+
+
+def timed(function, repeat=1):
+    # Best of repeat runs, in seconds
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def stage(seconds, rows):
+    return {'seconds': round(seconds, 6), 'rows': rows, 'rows_per_second': round(rows / max(seconds, 1e-9), 1)}
+
+
+def parse_stages(feed, repeat):
+    from parse_pb_data import legacy_parse_pb_data
+    from realtime_extractor import parse_pb_data
+    rows = len(parse_pb_data(feed, as_frame=False)['trip_id'])
+    return {
+        'parse_pb_data_legacy': stage(timed(lambda: legacy_parse_pb_data(feed), repeat), rows),
+        'parse_pb_data_frame': stage(timed(lambda: parse_pb_data(feed), repeat), rows),
+        'parse_pb_data_columns': stage(timed(lambda: parse_pb_data(feed, as_frame=False), repeat), rows),
+    }
+
+
+def database_stages(args, network, day, server):
+    import requests
+    import psycopg2
+    from sqlalchemy import create_engine
+    import realtime_extractor
+    import historical_extractor
+    import diff_times
+
+    with psycopg2.connect(args.db_url) as conn, conn.cursor() as cur:
+        cur.execute(SCHEMA)
+    conn.close()
+
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    server.files['/gtfs.zip'] = synthetic.build_static_zip(network)
+    realtime_extractor.url = base_url + '/tripupdates.pb'
+    realtime_extractor.get_weather_data = lambda engine: None
+    historical_extractor.url = base_url + '/gtfs.zip'
+    results = {}
+
+    # Static schedule: download from the stand-in server, expand and bulk load
+    with quiet(args.verbose):
+        seconds = timed(lambda: historical_extractor.main(bulk=True))
+    with psycopg2.connect(args.db_url) as conn, conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM gtfs_data")
+        results['historical_load'] = stage(seconds, cur.fetchone()[0])
+    conn.close()
+
+    # Realtime polling: every snapshot is downloaded, parsed and upserted by the same code as a cron run
+    engine = create_engine(args.db_url)
+    session = requests.Session()
+    state = realtime_extractor.load_state()
+    feeds = [synthetic.build_feed(network, day, snapshot) for snapshot in range(args.snapshots + 1)]
+    rows = sum(len(realtime_extractor.parse_pb_data(payload, as_frame=False)['trip_id']) for payload in feeds[:-1])
+    start = time.perf_counter()
+    for payload in feeds[:-1]:
+        server.files['/tripupdates.pb'] = payload
+        with quiet(args.verbose):
+            realtime_extractor.run_once(engine, session, state)
+    results['realtime_run_once'] = stage(time.perf_counter() - start, rows)
+
+    # Upsert of one whole snapshot, without the download and the change detection in front of it
+    columns = realtime_extractor.parse_pb_data(feeds[-1], as_frame=False)
+    snapshot_rows = list(realtime_extractor.feed_rows(columns))
+    seconds = timed(lambda: realtime_extractor.write_trip_updates(engine, snapshot_rows, datetime.now(timezone.utc)))
+    results['realtime_upsert'] = stage(seconds, len(snapshot_rows))
+
+    # Diffs: a full rebuild, then an incremental run after one more snapshot
+    with psycopg2.connect(args.db_url) as conn, conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM trip_updates")
+        realtime_rows = cur.fetchone()[0]
+    conn.close()
+    with quiet(args.verbose):
+        results['diff_full_rebuild'] = stage(timed(lambda: diff_times.populate_table(full_rebuild=True)), realtime_rows)
+        results['diff_parallel_rebuild'] = stage(timed(lambda: diff_times.populate_table(parallel=args.parallel)), realtime_rows)
+        server.files['/tripupdates.pb'] = synthetic.build_feed(network, day, args.snapshots + 1)
+        realtime_extractor.run_once(engine, session, state)
+        results['diff_incremental'] = stage(timed(lambda: diff_times.populate_table()), realtime_rows)
+    engine.dispose()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # Stages slower than the baseline by more than the tolerance are regressions
+    regressions = []
+    if baseline.get('parameters') != results['parameters']:
+        print('Warning: the baseline was recorded with different parameters, timings may not be comparable.')
+    print(f"{'stage':<24} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for name, current in results['stages'].items():
+        previous = baseline.get('stages', {}).get(name)
+        if previous is None:
+            print(f"{name:<24} {'-':>10} {current['seconds']:10.3f} {'new':>7}")
+            continue
+        ratio = current['seconds'] / max(previous['seconds'], 1e-9)
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"{name:<24} {previous['seconds']:10.3f} {current['seconds']:10.3f} {ratio:6.2f}x{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on a synthetic network, against a local Postgres and a local HTTP stand-in for the feeds.')
+    parser.add_argument('--scale', type=float, default=1, help='Size of the network relative to Sudbury.')
+    parser.add_argument('--routes', type=int)
+    parser.add_argument('--trips-per-route', type=int)
+    parser.add_argument('--stops', type=int)
+    parser.add_argument('--stops-per-trip', type=int)
+    parser.add_argument('--days', type=int, default=7, help='Service days in the static feed.')
+    parser.add_argument('--snapshots', type=int, default=5, help='Realtime snapshots polled.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of the parsing stages, the best one is kept.')
+    parser.add_argument('--parallel', type=int, default=4, help='Worker processes of the parallel diff rebuild.')
+    parser.add_argument('--db-url', default=os.getenv('BENCH_DB_URL'),
+                        help='Dedicated benchmark database, its tables are dropped and recreated. Defaults to BENCH_DB_URL; without it only the parsing stages run.')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file the results are written to.')
+    parser.add_argument('--baseline', help='Results of an earlier run to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Slowdown over the baseline tolerated before a stage counts as a regression.')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the scripts.')
+    args = parser.parse_args()
+
+    # The benchmark drops the pipeline tables: refuse anything that does not look like a scratch database
+    if args.db_url and 'bench' not in args.db_url.rsplit('/', 1)[-1]:
+        parser.error('the benchmark database name must contain "bench", its tables are dropped')
+
+    size = synthetic.network_size(args.scale, routes=args.routes, trips_per_route=args.trips_per_route,
+                                  stops=args.stops, stops_per_trip=args.stops_per_trip)
+    day = date.today()
+    network = synthetic.build_network(**size, days=args.days, first_day=day)
+    results = {
+        'recorded_at': datetime.now(timezone.utc).isoformat(),
+        'parameters': {**size, 'days': args.days, 'snapshots': args.snapshots},
+        'stages': {},
+    }
+    print(f"Synthetic network: {size['routes']} routes, {size['routes'] * size['trips_per_route']} trips, "
+          f"{len(network['stop_times'])} stop times, {args.days} days.")
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.db_url:
+            configure_environment(args.db_url, Path(work_dir))
+        results['stages'].update(parse_stages(synthetic.build_feed(network, day), args.repeat))
+        if args.db_url:
+            server = start_feed_server()
+            try:
+                results['stages'].update(database_stages(args, network, day, server))
+            finally:
+                server.shutdown()
+        else:
+            print('No benchmark database given, skipping the database stages.')
+
+    for name, result in results['stages'].items():
+        print(f"{name:<24} {result['seconds']:10.3f} s {result['rows']:>10} rows {result['rows_per_second']:>14,.0f} rows/s")
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {args.output}.')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"Regressions over {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
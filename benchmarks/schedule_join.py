@@ -0,0 +1,125 @@
+import os
+import sys
+import time
+import argparse
+import resource
+import tempfile
+import zipfile
+import multiprocessing
+import numpy as np
+import pandas as pd
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'scripts')))
+import synthetic
+
+
+def legacy_schedule_batches(zf, chunk_size):
+    # Per-chunk four-way merge that iter_schedule_batches replaced, kept here as the comparison point
+    from historical_extractor import parse_date_and_time_vectorized
+    stop_times_df = pd.read_csv(zf.open('stop_times.txt'), chunksize=chunk_size)
+    trips_df = pd.read_csv(zf.open('trips.txt'))
+    calendar_dates_df = pd.read_csv(zf.open('calendar_dates.txt'))
+    stops_df = pd.read_csv(zf.open('stops.txt'))
+    routes_df = pd.read_csv(zf.open('routes.txt'))
+
+    for chunk in stop_times_df:
+        df = (chunk
+            .merge(trips_df, on='trip_id')
+            .merge(calendar_dates_df, on='service_id')
+            .merge(stops_df, on='stop_id')
+            .merge(routes_df, on='route_id'))
+        df['arrival_time'] = parse_date_and_time_vectorized(df['date'].to_numpy(), df['arrival_time'])
+        df['departure_time'] = parse_date_and_time_vectorized(df['date'].to_numpy(), df['departure_time'])
+        df['date'] = pd.to_datetime(df['date'], format="%Y%m%d").dt.date
+        df.rename(columns={'date': 'start_date'}, inplace=True)
+        df['geo_coordinates'] = df['stop_lat'].astype(str) + ', ' + df['stop_lon'].astype(str)
+        yield df[['trip_id', 'start_date', 'stop_sequence', 'stop_id', 'route_id', 'stop_name', 'route_long_name', 'arrival_time', 'departure_time', 'geo_coordinates']]
+
+
+def rows_digest(df):
+    # Order-independent hash of the rows, with the columns in the types both paths can produce
+    normalized = pd.DataFrame({
+        'trip_id': df['trip_id'].astype(str).to_numpy(),
+        'start_date': df['start_date'].astype(str).to_numpy(),
+        'stop_sequence': df['stop_sequence'].astype(np.int64).to_numpy(),
+        'stop_id': df['stop_id'].astype(str).to_numpy(),
+        'route_id': df['route_id'].astype(str).to_numpy(),
+        'stop_name': df['stop_name'].astype(str).to_numpy(),
+        'route_long_name': df['route_long_name'].astype(str).to_numpy(),
+        'arrival_time': df['arrival_time'].astype('int64').to_numpy(),
+        'departure_time': df['departure_time'].astype('int64').to_numpy(),
+        'geo_coordinates': df['geo_coordinates'].astype(str).to_numpy(),
+    })
+    return int(pd.util.hash_pandas_object(normalized, index=False).sum())
+
+
+def run_path(path, feed_file, memory_cap_mb, check_rows):
+    # Runs in a fresh process, so the peak RSS is this path's alone. Imports are done before the baseline.
+    # Hashing the rows needs copies of every batch, so the runs checking the rows are not the ones measured
+    import historical_extractor
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    rows = digest = batches = 0
+    with zipfile.ZipFile(feed_file) as zf:
+        if path == 'merge':
+            frames = legacy_schedule_batches(zf, historical_extractor.chunk_size)
+        else:
+            frames = historical_extractor.iter_schedule_batches(zf, memory_cap_mb)
+        for df in frames:
+            rows += len(df)
+            batches += 1
+            if check_rows:
+                digest = (digest + rows_digest(df)) % 2**64
+    return {
+        'seconds': time.perf_counter() - start,
+        'rows': rows,
+        'batches': batches,
+        'digest': digest,
+        'baseline_mb': baseline_kb / 1024,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the peak memory of the old merge path and iter_schedule_batches on a synthetic static feed, and check they produce the same rows.')
+    parser.add_argument('--scale', type=float, default=1, help='Size of the network relative to Sudbury.')
+    parser.add_argument('--days', type=int, default=90, help='Service days in the static feed.')
+    parser.add_argument('--memory-cap-mb', type=int, default=256, help='Memory cap of iter_schedule_batches.')
+    args = parser.parse_args()
+
+    size = synthetic.network_size(args.scale)
+    network = synthetic.build_network(**size, days=args.days)
+    print(f"Synthetic network: {size['routes']} routes, {size['routes'] * size['trips_per_route']} trips, "
+          f"{len(network['stop_times'])} stop times, {args.days} days.")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        feed_file = os.path.join(work_dir, 'gtfs.zip')
+        with open(feed_file, 'wb') as f:
+            f.write(synthetic.build_static_zip(network))
+        del network
+
+        # One process per path and per run, so no run inherits another's peak
+        context = multiprocessing.get_context('spawn')
+        for path in ('merge', 'batches'):
+            for check_rows in (False, True):
+                with context.Pool(1, maxtasksperchild=1) as pool:
+                    result = pool.apply(run_path, (path, feed_file, args.memory_cap_mb, check_rows))
+                if check_rows:
+                    results[path]['digest'] = result['digest']
+                else:
+                    results[path] = result
+
+    for path, result in results.items():
+        print(f"{path:<8} {result['seconds']:8.2f} s {result['rows']:>12,} rows in {result['batches']:>6} batches  "
+              f"peak RSS {result['peak_rss_mb']:8.1f} MB ({result['peak_rss_mb'] - result['baseline_mb']:+.1f} MB over the imports)")
+
+    merge, batches = results['merge'], results['batches']
+    if (merge['rows'], merge['digest']) != (batches['rows'], batches['digest']):
+        print('FAIL the two paths produce different rows')
+        sys.exit(1)
+    print('ok   both paths produce the same rows')
+
+
+if __name__ == "__main__":
+    main()
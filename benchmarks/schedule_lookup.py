@@ -0,0 +1,97 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib.schedule_index import ScheduleIndex, service_day_number, write_schedule_index
+
+# Scheduled arrival of the one stop time of the check index, and its departure a minute later
+SCHEDULED = 1719835200
+
+# Realtime row (trip_id, start_date, stop_sequence, stop_id, arrival_epoch, departure_epoch) and the expected
+# (arrival, departure) delays in minutes. Rows with an empty or malformed start date must not match anything
+DATE_CASES = [
+    ('valid date', ('t1', '20240701', 1, '100', SCHEDULED + 120, SCHEDULED + 180), (2.0, 2.0)),
+    ('no departure', ('t1', '20240701', 1, '100', SCHEDULED - 60, None), (-1.0, None)),
+    ('other stop', ('t1', '20240701', 1, '101', SCHEDULED, SCHEDULED + 60), (None, None)),
+    ('empty date', ('t1', '', 1, '100', SCHEDULED, SCHEDULED + 60), (None, None)),
+    ('missing date', ('t1', None, 1, '100', SCHEDULED, SCHEDULED + 60), (None, None)),
+    ('malformed date', ('t1', '2024-07-01', 1, '100', SCHEDULED, SCHEDULED + 60), (None, None)),
+    ('invalid day', ('t1', '20240732', 1, '100', SCHEDULED, SCHEDULED + 60), (None, None)),
+    ('before 1970', ('t1', '19691231', 1, '100', SCHEDULED, SCHEDULED + 60), (None, None)),
+    ('past the key range', ('t1', '21990701', 1, '100', SCHEDULED, SCHEDULED + 60), (None, None)),
+]
+
+
+def build_index(directory, trips, stops_per_trip, days):
+    # Every trip on every day from 2024-07-01, its stops two minutes apart
+    first_day = service_day_number('20240701')
+    trip_codes, day_numbers, sequences = (grid.reshape(-1) for grid in np.meshgrid(
+        np.arange(trips), np.arange(first_day, first_day + days), np.arange(1, stops_per_trip + 1), indexing='ij'))
+    arrivals = SCHEDULED + (day_numbers - first_day) * 86400 + (sequences - 1) * 120
+    vocabulary = {
+        'trip_ids': [f't{trip + 1}' for trip in range(trips)],
+        'route_ids': ['r1'],
+        'stop_ids': [str(100 + stop) for stop in range(stops_per_trip)],
+    }
+    return write_schedule_index(directory, vocabulary, trip_codes, day_numbers, sequences, arrivals, arrivals + 60,
+                                np.zeros(len(trip_codes)), sequences - 1)
+
+
+def check_dates(index):
+    # Every case, then all of them in one batch as the extractor sends them. Returns the number of failures
+    failures = 0
+    names, rows, expected = zip(*DATE_CASES)
+    for name, row, wanted in DATE_CASES:
+        try:
+            got = index.delays([row])[0]
+        except Exception as e:
+            got = repr(e)
+        ok = got == wanted
+        failures += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {name:<20} {row[1]!r:>12} -> {got} (expected {wanted})")
+
+    try:
+        batch = index.delays(list(rows))
+    except Exception as e:
+        batch = repr(e)
+    ok = batch == list(expected)
+    failures += not ok
+    print(f"{'ok  ' if ok else 'FAIL'} one batch of {len(rows)} rows -> {batch}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the schedule index lookups on valid and invalid start dates, and time them.')
+    parser.add_argument('--trips', type=int, default=2000)
+    parser.add_argument('--stops-per-trip', type=int, default=30)
+    parser.add_argument('--days', type=int, default=14)
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        entries = build_index(work_dir, args.trips, args.stops_per_trip, args.days)
+        index = ScheduleIndex(work_dir)
+        failures = check_dates(index)
+        if failures:
+            print(f'{failures} start date check(s) failed')
+            sys.exit(1)
+
+        # One feed's worth of rows on the first day, a tenth of them without a usable start date
+        rng = np.random.default_rng(1)
+        trips = rng.integers(1, args.trips + 1, args.rows)
+        sequences = rng.integers(1, args.stops_per_trip + 1, args.rows)
+        dates = np.where(rng.random(args.rows) < 0.1, '', '20240701')
+        rows = [(f't{trip}', date, int(sequence), str(99 + sequence), SCHEDULED + 60, None)
+                for trip, date, sequence in zip(trips, dates, sequences)]
+        start = time.perf_counter()
+        delays = index.delays(rows)
+        seconds = time.perf_counter() - start
+        print(f'{len(rows):,} rows looked up in {entries:,} stop times in {seconds:.3f} s '
+              f'({len(rows) / max(seconds, 1e-9):,.0f} rows/s), {sum(delay != (None, None) for delay in delays):,} scheduled.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import io
+import os
+import sys
+import csv
+import random
+import zipfile
+from datetime import date, datetime, time, timedelta
+import pytz
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib import gtfs_realtime_pb2
+
+# Rough size of the Sudbury network, multiplied by --scale
+SUDBURY_SIZE = {'routes': 40, 'trips_per_route': 50, 'stops': 1000, 'stops_per_trip': 40}
+
+# Services and the weekdays they run on
+SERVICES = {'weekday': range(0, 5), 'saturday': [5], 'sunday': [6]}
+
+
+def network_size(scale=1, **overrides):
+    size = {name: max(1, int(value * scale)) for name, value in SUDBURY_SIZE.items()}
+    size['stops_per_trip'] = SUDBURY_SIZE['stops_per_trip']
+    size.update({name: value for name, value in overrides.items() if value is not None})
+    return size
+
+
+def build_network(routes, trips_per_route, stops, stops_per_trip, days, first_day=None, seed=1):
+    # Deterministic synthetic network: every route serves a fixed run of stops, trips are spread from 05:00
+    # to past midnight (GTFS times over 24:00) and alternate between the weekday, saturday and sunday services
+    rng = random.Random(seed)
+    first_day = first_day or date.today()
+    service_ids = list(SERVICES)
+
+    network = {'routes': [], 'stops': [], 'trips': [], 'stop_times': [], 'calendar_dates': []}
+    for stop in range(stops):
+        network['stops'].append((1000 + stop, f'Stop {stop}', round(46.4 + rng.random() * 0.2, 6), round(-81.1 + rng.random() * 0.2, 6)))
+
+    for route in range(routes):
+        route_id = f'R{route}'
+        network['routes'].append((route_id, f'Route {route}'))
+        first_stop = rng.randrange(stops)
+        for trip in range(trips_per_route):
+            trip_id = f'{route_id}-T{trip}'
+            network['trips'].append((route_id, service_ids[trip % len(service_ids)], trip_id))
+            departure = 5 * 3600 + int(trip * 20 * 3600 / trips_per_route)
+            for sequence in range(stops_per_trip):
+                arrival = departure + sequence * 90
+                network['stop_times'].append((trip_id, arrival, arrival + 15, 1000 + (first_stop + sequence) % stops, sequence + 1))
+
+    for offset in range(days):
+        day = first_day + timedelta(days=offset)
+        for service_id, weekdays in SERVICES.items():
+            if day.weekday() in weekdays:
+                network['calendar_dates'].append((service_id, day.strftime('%Y%m%d'), 1))
+    return network
+
+
+def format_gtfs_time(seconds):
+    return f'{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+
+def build_static_zip(network):
+    # gtfs.zip with the files historical_extractor.py reads
+    files = {
+        'routes.txt': (['route_id', 'route_long_name'], network['routes']),
+        'stops.txt': (['stop_id', 'stop_name', 'stop_lat', 'stop_lon'], network['stops']),
+        'trips.txt': (['route_id', 'service_id', 'trip_id'], network['trips']),
+        'calendar_dates.txt': (['service_id', 'date', 'exception_type'], network['calendar_dates']),
+        'stop_times.txt': (['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'],
+                           [(trip_id, format_gtfs_time(arrival), format_gtfs_time(departure), stop_id, sequence)
+                            for trip_id, arrival, departure, stop_id, sequence in network['stop_times']]),
+    }
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, (header, rows) in files.items():
+            text = io.StringIO()
+            writer = csv.writer(text, lineterminator='\n')
+            writer.writerow(header)
+            writer.writerows(rows)
+            zf.writestr(name, text.getvalue())
+    return buffer.getvalue()
+
+
+def service_day_origin(day, timezone_name='America/Toronto'):
+    # GTFS times count from noon minus 12 hours of the service day, in local time
+    noon = pytz.timezone(timezone_name).localize(datetime.combine(day, time(12)))
+    return int(noon.timestamp()) - 12 * 3600
+
+
+def build_feed(network, day, snapshot=0, seed=1):
+    # Trip updates for every trip running on the day, with delays that drift from one snapshot to the next.
+    # As in the live feed, the first stop has a zero arrival time and the last stop a zero departure time
+    rng = random.Random(seed * 100003 + snapshot)
+    running = {service_id for service_id, date_text, _ in network['calendar_dates'] if date_text == day.strftime('%Y%m%d')}
+    trips = {trip_id for _, service_id, trip_id in network['trips'] if service_id in running}
+    origin = service_day_origin(day)
+
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '2.0'
+    feed.header.timestamp = origin + 12 * 3600 + snapshot * 60
+    entities = {}
+    for trip_id, arrival, departure, stop_id, sequence in network['stop_times']:
+        if trip_id not in trips:
+            continue
+        if trip_id not in entities:
+            entity = feed.entity.add()
+            entity.id = trip_id
+            entity.trip_update.trip.trip_id = trip_id
+            entity.trip_update.trip.start_date = day.strftime('%Y%m%d')
+            entities[trip_id] = (entity, rng.randrange(-120, 600))
+        entity, delay = entities[trip_id]
+        update = entity.trip_update.stop_time_update.add()
+        update.stop_sequence = sequence
+        update.stop_id = str(stop_id)
+        update.arrival.time = origin + arrival + delay + rng.randrange(0, 30) * (snapshot % 3) if sequence > 1 else 0
+        update.departure.time = origin + departure + delay
+    for entity, _ in entities.values():
+        updates = entity.trip_update.stop_time_update
+        if len(updates):
+            updates[len(updates) - 1].departure.time = 0
+    return feed.SerializeToString()
@@ -0,0 +1,80 @@
+import mmap
+import zlib
+import bisect
+import struct
+from pathlib import Path
+from datetime import datetime, timezone
+
+# One index record per snapshot: feed timestamp, offset and length of the compressed payload in the segment
+INDEX_RECORD = struct.Struct('<qQI')
+
+
+class IndexView:
+    # Sequence of the feed timestamps of a memory-mapped index, for bisect
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def __len__(self):
+        return len(self.buffer) // INDEX_RECORD.size
+
+    def __getitem__(self, position):
+        return INDEX_RECORD.unpack_from(self.buffer, position * INDEX_RECORD.size)[0]
+
+    def record(self, position):
+        return INDEX_RECORD.unpack_from(self.buffer, position * INDEX_RECORD.size)
+
+
+def segment_path(directory, feed_timestamp):
+    # One segment per UTC day of feed timestamps
+    day = datetime.fromtimestamp(feed_timestamp, tz=timezone.utc)
+    return Path(directory) / f"feeds-{day:%Y%m%d}"
+
+
+def last_timestamp(index_path):
+    if not index_path.is_file() or index_path.stat().st_size < INDEX_RECORD.size:
+        return None
+    with open(index_path, 'rb') as f:
+        f.seek(-INDEX_RECORD.size, 2)
+        return INDEX_RECORD.unpack(f.read(INDEX_RECORD.size))[0]
+
+
+def append_feed(directory, feed_timestamp, payload):
+    # Append-only: the payload goes to the data file first and the index record last, so a crash
+    # in between leaves unreferenced bytes but never an index entry pointing past the data
+    base = segment_path(directory, feed_timestamp)
+    base.parent.mkdir(parents=True, exist_ok=True)
+    data_path, index_path = base.with_suffix('.seg'), base.with_suffix('.idx')
+
+    # The index stays sorted for binary search: snapshots not newer than the last one are not archived
+    last = last_timestamp(index_path)
+    if last is not None and feed_timestamp <= last:
+        return False
+
+    compressed = zlib.compress(payload)
+    with open(data_path, 'ab') as f:
+        offset = f.tell()
+        f.write(compressed)
+    with open(index_path, 'ab') as f:
+        f.write(INDEX_RECORD.pack(feed_timestamp, offset, len(compressed)))
+    return True
+
+
+def iter_feeds(directory, start_timestamp, end_timestamp):
+    # (feed timestamp, payload) of every archived snapshot in [start, end], oldest first. Only the index
+    # of each segment is searched, and only the matching payloads are decompressed
+    first_segment = segment_path(directory, start_timestamp).name
+    last_segment = segment_path(directory, end_timestamp).name
+    for index_path in sorted(Path(directory).glob('feeds-*.idx')):
+        if not first_segment <= index_path.stem <= last_segment or index_path.stat().st_size < INDEX_RECORD.size:
+            continue
+        with open(index_path, 'rb') as index_file, open(index_path.with_suffix('.seg'), 'rb') as data_file:
+            with mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ) as index_buffer, \
+                    mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as data_buffer:
+                index = IndexView(index_buffer)
+                position = bisect.bisect_left(index, start_timestamp)
+                while position < len(index):
+                    feed_timestamp, offset, length = index.record(position)
+                    if feed_timestamp > end_timestamp:
+                        break
+                    yield feed_timestamp, zlib.decompress(data_buffer[offset:offset + length])
+                    position += 1
@@ -0,0 +1,72 @@
+import os
+import json
+from pathlib import Path
+
+# Registry of the agencies tracked from this host, feeds.json at the root of the repository (or FEEDS_FILE).
+# Without it, the pipeline tracks Sudbury only, as it always has
+root_dir = Path(os.path.dirname(os.path.abspath(__file__))).parent
+
+# Settings of a feed: a name used for its lock, state and archive files, the static and realtime URLs,
+# the time zone of its schedule, the OpenWeather query of its city (no weather when null), and an
+# optional database schema holding its tables. Feeds without a schema use the default search path. A registry
+# of several feeds needs a distinct schema for each, or their tables and watermarks would be shared
+DEFAULT_FEED = {
+    'name': 'sudbury',
+    'static_url': 'https://sudbury.tmix.se/gtfs/gtfs.zip',
+    'realtime_url': 'https://sudbury.tmix.se/gtfs-realtime/tripupdates.pb',
+    'timezone': 'America/Toronto',
+    'weather_query': 'Sudbury,ca',
+    'schema': None,
+}
+REQUIRED_KEYS = ['name', 'static_url', 'realtime_url', 'timezone']
+
+
+def load_feeds():
+    path = Path(os.getenv("FEEDS_FILE", root_dir / "feeds.json"))
+    if not path.is_file():
+        return [dict(DEFAULT_FEED)]
+    with open(path, 'r') as f:
+        entries = json.load(f)['feeds']
+
+    feeds = []
+    for entry in entries:
+        missing = [key for key in REQUIRED_KEYS if key not in entry]
+        if missing:
+            raise ValueError(f"Feed {entry.get('name', '?')} in {path} is missing {', '.join(missing)}")
+        feeds.append({'weather_query': None, 'schema': None, **entry})
+    names = [feed['name'] for feed in feeds]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Feed names in {path} must be unique")
+    schemas = [feed['schema'] for feed in feeds]
+    if len(feeds) > 1 and (None in schemas or len(set(schemas)) != len(schemas)):
+        raise ValueError(f"Feeds in {path} must each have a schema of their own when there are several")
+    return feeds
+
+
+def current_feed():
+    # Feed a script works on, selected with FEED. The first feed of the registry by default
+    feeds = load_feeds()
+    name = os.getenv("FEED")
+    if not name:
+        return feeds[0]
+    for feed in feeds:
+        if feed['name'] == name:
+            return feed
+    raise ValueError(f"Unknown feed {name}. Feeds: {', '.join(feed['name'] for feed in feeds)}")
+
+
+def is_default_feed(feed):
+    # The default feed keeps the local file names used before the registry, so an upgrade finds its state
+    return feed['name'] == DEFAULT_FEED['name']
+
+
+def search_path_option(feed):
+    # libpq options making the feed's schema the only one searched, so the unqualified table names of the
+    # scripts resolve to its tables and never fall through to those of public. Empty for feeds without a schema
+    return f"-c search_path={feed['schema']}" if feed['schema'] else ''
+
+
+def connect_args(feed):
+    # Keyword arguments of psycopg2.connect, or connect_args of a SQLAlchemy engine
+    option = search_path_option(feed)
+    return {'options': option} if option else {}
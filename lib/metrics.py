@@ -0,0 +1,189 @@
+import io
+import os
+import re
+import sys
+import json
+import time
+import pstats
+import cProfile
+import tracemalloc
+import contextlib
+from pathlib import Path
+from collections import defaultdict
+from datetime import datetime, timezone
+
+# Settings are read from the environment when used, since the scripts load their .env after importing this module:
+# METRICS_TEXTFILE_DIR  directory of the node_exporter textfile collector, no Prometheus file is written when unset
+# METRICS_LOG           structured JSON log lines on stdout, on unless set to 0
+# PIPELINE_PROFILE      profilers run around a single run: "cprofile", "tracemalloc" or both, comma separated
+# PIPELINE_PROFILE_DIR  directory the profiles are written to, "profiles" by default
+
+# Lines of the hottest functions or allocation sites kept in the profile summaries
+PROFILE_TOP = 30
+
+# Only the first run of a process is profiled, so a daemon does not keep writing profiles
+_profiled_runs = 0
+
+
+class RunMetrics:
+    # Stage timings and counters of one run of a job, reported as JSON log lines and as a Prometheus textfile.
+    # Jobs run for one feed of the registry carry its name
+    def __init__(self, job, feed=None):
+        self.job = job
+        self.feed = feed
+        self.runs = 0
+        self.failures = 0
+        self.reset()
+
+    def reset(self):
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.stages = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # Time spent in a stage adds up when a stage runs several times in the same run,
+        # and is reported with the run summary
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - start
+
+    def add(self, name, value=1):
+        self.counters[name] += int(value)
+
+    def log(self, event, **fields):
+        if os.getenv("METRICS_LOG", "1") != "0":
+            line = {'ts': datetime.now(timezone.utc).isoformat(), 'job': self.job, **({'feed': self.feed} if self.feed else {}), 'event': event, **fields}
+            print(json.dumps(line, default=str), flush=True)
+
+    def finish(self, status='ok'):
+        # Summary of the run, then the counters start over for the next one (daemon mode).
+        # Statuses ending in "error" are failures, others such as "not_modified" are normal outcomes
+        duration = time.perf_counter() - self.start
+        self.runs += 1
+        if status.endswith('error'):
+            self.failures += 1
+        self.log('run', status=status, seconds=round(duration, 6),
+                 stages={name: round(seconds, 6) for name, seconds in self.stages.items()}, counters=dict(self.counters))
+        textfile_dir = os.getenv("METRICS_TEXTFILE_DIR")
+        if textfile_dir:
+            write_textfile(textfile_dir, self, status, duration)
+        self.reset()
+
+
+def metric_label(value):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', value)
+
+
+def write_textfile(textfile_dir, metrics, status, duration):
+    # node_exporter reads every *.prom file of its textfile directory, so the file is replaced atomically.
+    # Each feed of a job has its own file
+    job = metric_label(metrics.job)
+    labels = f'job="{job}"' + (f',feed="{metric_label(metrics.feed)}"' if metrics.feed else '')
+    lines = [
+        '# HELP transit_run_duration_seconds Duration of the last run.',
+        '# TYPE transit_run_duration_seconds gauge',
+        f'transit_run_duration_seconds{{{labels}}} {duration:.6f}',
+        '# HELP transit_run_success Whether the last run succeeded.',
+        '# TYPE transit_run_success gauge',
+        f'transit_run_success{{{labels}}} {int(not status.endswith("error"))}',
+        '# HELP transit_run_timestamp_seconds End time of the last run.',
+        '# TYPE transit_run_timestamp_seconds gauge',
+        f'transit_run_timestamp_seconds{{{labels}}} {time.time():.3f}',
+        '# HELP transit_runs_total Runs since the process started.',
+        '# TYPE transit_runs_total counter',
+        f'transit_runs_total{{{labels}}} {metrics.runs}',
+        '# HELP transit_run_failures_total Failed runs since the process started.',
+        '# TYPE transit_run_failures_total counter',
+        f'transit_run_failures_total{{{labels}}} {metrics.failures}',
+        '# HELP transit_stage_seconds Time spent in each stage of the last run.',
+        '# TYPE transit_stage_seconds gauge',
+    ]
+    lines += [f'transit_stage_seconds{{{labels},stage="{metric_label(name)}"}} {seconds:.6f}' for name, seconds in metrics.stages.items()]
+    lines += [
+        '# HELP transit_run_count Rows, bytes and database round trips counted in the last run.',
+        '# TYPE transit_run_count gauge',
+    ]
+    lines += [f'transit_run_count{{{labels},counter="{metric_label(name)}"}} {value}' for name, value in metrics.counters.items()]
+
+    directory = Path(textfile_dir)
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / (f'{job}-{metric_label(metrics.feed)}.prom' if metrics.feed else f'{job}.prom')
+    temporary_file = path.with_name(path.name + '.tmp')
+    with open(temporary_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(temporary_file, path)
+
+
+def count_round_trips(connection, metrics):
+    # Counts every statement and COPY sent through a psycopg2 connection, including the cursors SQLAlchemy creates.
+    # A SQLAlchemy engine gets the counting cursor on every new pooled connection
+    if hasattr(connection, 'raw_connection'):
+        from sqlalchemy import event
+        event.listen(connection, 'connect', lambda dbapi_connection, record: count_round_trips(dbapi_connection, metrics))
+        return
+
+    # A connection borrowed from a SQLAlchemy pool counts for the job that borrowed it last
+    connection = getattr(connection, 'dbapi_connection', connection)
+    import psycopg2.extensions
+    base = getattr(connection.cursor_factory, 'base_cursor', connection.cursor_factory) or psycopg2.extensions.cursor
+
+    class CountingCursor(base):
+        base_cursor = base
+
+        def execute(self, query, vars=None):
+            metrics.add('db_round_trips')
+            return super().execute(query, vars)
+
+        def executemany(self, query, vars_list):
+            metrics.add('db_round_trips')
+            return super().executemany(query, vars_list)
+
+        def copy_expert(self, sql, file, size=8192):
+            metrics.add('db_round_trips')
+            return super().copy_expert(sql, file, size)
+
+    connection.cursor_factory = CountingCursor
+
+
+@contextlib.contextmanager
+def profiled(job):
+    # Optional profiles of one run, enabled with PIPELINE_PROFILE, written to PIPELINE_PROFILE_DIR
+    global _profiled_runs
+    profile_modes = {mode.strip() for mode in os.getenv("PIPELINE_PROFILE", "").split(",") if mode.strip()}
+    if not profile_modes or _profiled_runs:
+        yield
+        return
+    _profiled_runs += 1
+
+    profile_dir = Path(os.getenv("PIPELINE_PROFILE_DIR", "profiles"))
+    stamp = datetime.now().strftime('%Y%m%dT%H%M%S')
+    prefix = profile_dir / f'{job}-{stamp}'
+    profiler = cProfile.Profile() if 'cprofile' in profile_modes else None
+    if 'tracemalloc' in profile_modes:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        if profiler is not None:
+            # Raw stats for snakeviz or pstats, plus a readable summary of the hottest functions
+            profiler.dump_stats(f'{prefix}.prof')
+            summary = io.StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(PROFILE_TOP)
+            Path(f'{prefix}-cprofile.txt').write_text(summary.getvalue())
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            lines = [f'Peak traced memory: {peak / 1024 / 1024:.1f} MB, still allocated: {current / 1024 / 1024:.1f} MB']
+            lines += [str(statistic) for statistic in snapshot.statistics('lineno')[:PROFILE_TOP]]
+            Path(f'{prefix}-tracemalloc.txt').write_text('\n'.join(lines) + '\n')
+        print(f'Profiles written to {prefix}*', file=sys.stderr)
@@ -0,0 +1,128 @@
+import os
+from lib.feeds import current_feed
+from lib.rollups import ROLLUP_TABLE, create_rollup_stats_view
+
+# Table recording the schema steps applied to a database
+MIGRATIONS_TABLE = 'schema_migrations'
+
+# Names of EXTRACT(DOW ...), from 0 for Sunday
+DAY_NAMES = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
+
+
+def migration_tables():
+    # Tables the steps apply to, by role. Their names follow the environment, as in the scripts
+    return {
+        'realtime': os.getenv("REALTIME_TABLE"),
+        'historical': os.getenv("HISTORICAL_TABLE"),
+        'diffs': 'trip_updates_with_diffs',
+        'rollups': ROLLUP_TABLE,
+    }
+
+
+def ensure_migrations_table(cur):
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE}
+        (
+            version integer NOT NULL,
+            description text NOT NULL,
+            applied_at timestamp with time zone NOT NULL DEFAULT now(),
+            CONSTRAINT {MIGRATIONS_TABLE}_pkey PRIMARY KEY (version)
+        )""")
+
+
+def day_type_expression(column, timezone):
+    # Name of the local day of a timestamp with time zone. A single AT TIME ZONE gives the local wall clock
+    return (f"CASE EXTRACT(DOW FROM {column} AT TIME ZONE '{timezone}') "
+            + ' '.join(f"WHEN {number} THEN '{name}'" for number, name in enumerate(DAY_NAMES)) + " END")
+
+
+def hour_expression(column, timezone):
+    return f"EXTRACT(HOUR FROM {column} AT TIME ZONE '{timezone}')::integer"
+
+
+def withdrawn_step(cur, table, timezone):
+    # A step taken back after it was released. Its version stays recorded where it ran, and it does nothing
+    # where it has not
+    pass
+
+
+def stop_id_as_text(cur, table, timezone):
+    # GTFS stop ids are strings, and some agencies use alphanumeric ones. Version 1 turned the realtime column
+    # into a bigint, this turns it back. Rewrites the table, unless the column already is text
+    cur.execute("SELECT format_type(atttypid, atttypmod) FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attname = 'stop_id'", (table,))
+    if cur.fetchone()[0] != 'text':
+        cur.execute(f"ALTER TABLE {table} ALTER COLUMN stop_id TYPE text USING stop_id::text")
+
+
+def index_change_time(cur, table, timezone):
+    # Incremental diff runs, the sync and the exports select the rows changed after a watermark with this expression
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_changed_at_idx ON {table} ((GREATEST(created_at, updated_at)))")
+
+
+def index_start_date(cur, table, timezone):
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_start_date_idx ON {table} (start_date)")
+
+
+def index_diffs_by_date(cur, table, timezone):
+    # Date-range exports, and the rollup refresh joining the diffs on (route, stop, service date)
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_start_date_idx ON {table} (start_date, route_id, stop_id)")
+
+
+def add_local_time_columns(cur, table, timezone):
+    # Day type and hour of day of the scheduled arrival in the feed's time zone, computed once when a row is
+    # written instead of on every diff run. Rewrites the table
+    cur.execute(f"""
+        ALTER TABLE {table}
+        ADD COLUMN IF NOT EXISTS day_type text GENERATED ALWAYS AS ({day_type_expression('arrival_time', timezone)}) STORED,
+        ADD COLUMN IF NOT EXISTS hour_of_day integer GENERATED ALWAYS AS ({hour_expression('arrival_time', timezone)}) STORED""")
+
+
+def add_rollup_stats_view(cur, table, timezone):
+    create_rollup_stats_view(cur, table)
+
+
+# Steps in the order they are applied: version, table role, description and function. New steps are appended
+# with the next version, applied steps are never edited
+MIGRATIONS = [
+    (1, 'realtime', 'stop_id as bigint (withdrawn by version 9)', withdrawn_step),
+    (2, 'realtime', 'index on the change time', index_change_time),
+    (3, 'diffs', 'index on the change time', index_change_time),
+    (4, 'historical', 'index on start_date', index_start_date),
+    (5, 'diffs', 'index on start_date, route and stop', index_diffs_by_date),
+    (6, 'rollups', 'index on start_date', index_start_date),
+    (7, 'historical', 'generated day type and hour of day', add_local_time_columns),
+    (8, 'rollups', 'delay statistics view', add_rollup_stats_view),
+    (9, 'realtime', 'stop_id as text', stop_id_as_text),
+]
+
+
+def run_migrations(conn, timezone=None):
+    # Applies the pending steps, each in its own transaction together with its row in schema_migrations, and
+    # returns the descriptions of those applied. A step whose table does not exist in this database, like the
+    # schedule on the remote server, stays pending until it does. Concurrent runs wait on an advisory lock
+    timezone = timezone or current_feed()['timezone']
+    tables = migration_tables()
+    cur = conn.cursor()
+    ensure_migrations_table(cur)
+    cur.execute(f"SELECT version FROM {MIGRATIONS_TABLE}")
+    done = {row[0] for row in cur.fetchall()}
+    conn.commit()
+
+    applied = []
+    for version, role, description, step in MIGRATIONS:
+        table = tables[role]
+        if version in done or not table:
+            continue
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (MIGRATIONS_TABLE,))
+        cur.execute(f"SELECT to_regclass(%s) IS NOT NULL, EXISTS (SELECT 1 FROM {MIGRATIONS_TABLE} WHERE version = %s)", (table, version))
+        exists, already_applied = cur.fetchone()
+        if not exists or already_applied:
+            conn.rollback()
+            continue
+        print(f'Applying schema migration {version}: {table}, {description}...')
+        step(cur, table, timezone)
+        cur.execute(f"INSERT INTO {MIGRATIONS_TABLE} (version, description) VALUES (%s, %s)", (version, f'{table}: {description}'))
+        conn.commit()
+        applied.append(f'{version}: {table}, {description}')
+    cur.close()
+    return applied
@@ -0,0 +1,174 @@
+import os
+import re
+from datetime import date, datetime, timedelta
+
+# Length of one start_date partition, 'month' or 'week'
+PARTITION_INTERVAL = os.getenv("PARTITION_INTERVAL", "month")
+
+# Number of partitions created ahead of the current one
+PARTITION_AHEAD = int(os.getenv("PARTITION_AHEAD", 2))
+
+# Start dates given partitions, in days before and after today. A date further away is taken for a bad one
+PARTITION_MAX_AGE_DAYS = int(os.getenv("PARTITION_MAX_AGE_DAYS", 5 * 366))
+PARTITION_MAX_AHEAD_DAYS = int(os.getenv("PARTITION_MAX_AHEAD_DAYS", 2 * 366))
+
+# Partitioned tables and partitions already known to exist, so long-running processes skip the catalog lookups
+_partitioned_tables = set()
+_known_partitions = set()
+
+
+def period_start(day, interval=PARTITION_INTERVAL):
+    if interval == 'month':
+        return day.replace(day=1)
+    elif interval == 'week':
+        return day - timedelta(days=day.weekday())
+    raise ValueError(f"Unknown partition interval: {interval}")
+
+
+def next_period(start, interval=PARTITION_INTERVAL):
+    if interval == 'month':
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start + timedelta(days=7)
+
+
+def partition_name(table, start, interval=PARTITION_INTERVAL):
+    return f"{table}_p{start:%Y%m}" if interval == 'month' else f"{table}_p{start:%Y%m%d}"
+
+
+def is_partitioned(cur, table):
+    cur.execute("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))", (table,))
+    return cur.fetchone()[0]
+
+
+def ensure_partitions(cur, table, first_day, last_day, interval=PARTITION_INTERVAL):
+    # Create every missing partition between the periods of first_day and last_day, both included
+    created = []
+    start = period_start(first_day, interval)
+    while start <= last_day:
+        end = next_period(start, interval)
+        name = partition_name(table, start, interval)
+        if name not in _known_partitions:
+            # Look the partition up first: creating one locks the parent table even when it already exists
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+            if not cur.fetchone()[0]:
+                cur.execute(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM ('{start}') TO ('{end}')")
+                created.append(name)
+            _known_partitions.add(name)
+        start = end
+    return created
+
+
+def partition_window(today=None):
+    # First and last start date ensure_partitions_for_dates accepts
+    today = today or date.today()
+    return today - timedelta(days=PARTITION_MAX_AGE_DAYS), today + timedelta(days=PARTITION_MAX_AHEAD_DAYS)
+
+
+def ensure_partitions_for_dates(cur, table, dates, interval=PARTITION_INTERVAL, ahead=PARTITION_AHEAD):
+    # Partitions for the periods of the given start dates, plus the current period and a few ahead of it. Only
+    # the periods present are created, not those between them. A date outside partition_window() raises
+    # ValueError, rather than getting a partition of its own. No-op on a plain table
+    if table not in _partitioned_tables:
+        if not is_partitioned(cur, table):
+            return []
+        _partitioned_tables.add(table)
+
+    days = {day if isinstance(day, date) else datetime.strptime(str(day), '%Y%m%d').date() for day in dates}
+    first_day, last_day = partition_window()
+    outside = sorted(day for day in days if not first_day <= day <= last_day)
+    if outside:
+        raise ValueError(f"{len(outside)} start date(s) of {table} outside {first_day} to {last_day}: "
+                         + ', '.join(str(day) for day in outside[:5]) + (', ...' if len(outside) > 5 else ''))
+
+    periods = {period_start(day, interval) for day in days}
+    start = period_start(date.today(), interval)
+    for _ in range(ahead + 1):
+        periods.add(start)
+        start = next_period(start, interval)
+    created = []
+    for start in sorted(periods):
+        created += ensure_partitions(cur, table, start, start, interval)
+    return created
+
+
+def list_partitions(cur, table):
+    # (name, lower bound, upper bound) of every range partition of the table, oldest first
+    cur.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)""", (table,))
+    partitions = []
+    for name, bound in cur.fetchall():
+        match = re.search(r"FROM \('([\d-]+)'\) TO \('([\d-]+)'\)", bound or '')
+        if match:
+            partitions.append((name, date.fromisoformat(match.group(1)), date.fromisoformat(match.group(2))))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def detach_partitions_before(cur, table, cutoff, archive_schema=None, drop=False):
+    # Retention without big DELETEs: whole partitions that end before the cutoff leave the table
+    detached = []
+    for name, lower, upper in list_partitions(cur, table):
+        if upper > cutoff:
+            continue
+        cur.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+        if archive_schema:
+            cur.execute(f"CREATE SCHEMA IF NOT EXISTS {archive_schema}")
+            cur.execute(f"ALTER TABLE {name} SET SCHEMA {archive_schema}")
+        elif drop:
+            cur.execute(f"DROP TABLE {name}")
+        _known_partitions.discard(name)
+        detached.append(name)
+    return detached
+
+
+def convert_to_partitioned(cur, table, interval=PARTITION_INTERVAL):
+    # Keep the old heap next to the new partitioned table until the copy has been checked
+    old_table = f"{table}_unpartitioned"
+    cur.execute(f"ALTER TABLE {table} RENAME TO {old_table}")
+    cur.execute(f"ALTER TABLE {old_table} RENAME CONSTRAINT {table}_pkey TO {old_table}_pkey")
+    # Generated columns and the indexes added by the migrations carry over, the primary key included
+    cur.execute(f"CREATE TABLE {table} (LIKE {old_table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING GENERATED INCLUDING INDEXES) PARTITION BY RANGE (start_date)")
+
+    # Every row of the old table needs a partition, whatever its date
+    cur.execute(f"SELECT DISTINCT start_date FROM {old_table}")
+    for (day,) in cur.fetchall():
+        ensure_partitions(cur, table, day, day, interval)
+    _partitioned_tables.add(table)
+    ensure_partitions_for_dates(cur, table, [], interval)
+
+    # Generated columns are computed again on insert
+    cur.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_name = %s AND table_schema = current_schema() AND is_generated = 'NEVER'
+        ORDER BY ordinal_position""", (old_table,))
+    columns = ', '.join(row[0] for row in cur.fetchall())
+    cur.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {old_table}")
+    return cur.rowcount
+
+
+def forget_partitions(table):
+    # Drops what is known about a table that was dropped or renamed, so its partitions are looked up again
+    _partitioned_tables.discard(table)
+    for name in [name for name in _known_partitions if name.startswith(f"{table}_p")]:
+        _known_partitions.discard(name)
+
+
+def rename_partitions(cur, table, old_table):
+    # After a table built as old_table was renamed to table: its partitions, and their indexes, take the names
+    # they would have had under table
+    forget_partitions(old_table)
+    renamed = []
+    for name, lower, upper in list_partitions(cur, table):
+        if not name.startswith(f"{old_table}_p"):
+            continue
+        new_name = table + name[len(old_table):]
+        cur.execute("SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = to_regclass(%s)", (name,))
+        for (index,) in cur.fetchall():
+            if index.startswith(f"{name}_"):
+                cur.execute(f"ALTER INDEX {index} RENAME TO {new_name + index[len(name):]}")
+        cur.execute(f"ALTER TABLE {name} RENAME TO {new_name}")
+        _known_partitions.add(new_name)
+        renamed.append(new_name)
+    return renamed
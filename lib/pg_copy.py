@@ -0,0 +1,17 @@
+import csv
+import io
+
+
+def copy_rows(cursor, table, columns, rows):
+    # Serialize the rows as CSV in memory. None becomes an empty unquoted field, which COPY reads as NULL
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    buffer.seek(0)
+
+    # Stream the buffer to the server in a single COPY round trip
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    return count
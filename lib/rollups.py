@@ -0,0 +1,103 @@
+ROLLUP_TABLE = 'trip_delay_rollups'
+ROLLUP_STATS_VIEW = 'trip_delay_rollup_stats'
+
+# Columns a rollup row is keyed by
+ROLLUP_KEY_COLUMNS = ['route_id', 'stop_id', 'start_date', 'hour', 'day_type', 'weather_group']
+
+# Delay histogram: one-minute buckets from -10 to +30 minutes, plus one bucket below and one above
+# (width_bucket numbering, 0 to HISTOGRAM_BUCKETS + 1). Changing these needs a full rebuild
+HISTOGRAM_LOW = -10
+HISTOGRAM_HIGH = 30
+HISTOGRAM_BUCKETS = 40
+
+
+def ensure_rollup_table(cur):
+    # Count, sum and sum of squares are additive, so coarser aggregates and the standard deviation can be
+    # computed from them. The histogram gives approximate percentiles
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {ROLLUP_TABLE}
+        (
+            route_id text NOT NULL,
+            stop_id bigint NOT NULL,
+            start_date date NOT NULL,
+            hour integer NOT NULL,
+            day_type text NOT NULL,
+            weather_group text NOT NULL,
+            delays bigint NOT NULL,
+            delay_sum double precision NOT NULL,
+            delay_sum_sq double precision NOT NULL,
+            delay_histogram integer[] NOT NULL,
+            CONSTRAINT {ROLLUP_TABLE}_pkey PRIMARY KEY ({', '.join(ROLLUP_KEY_COLUMNS)})
+        )""")
+
+
+def create_rollup_stats_view(cur, table=ROLLUP_TABLE):
+    # Average and standard deviation of every rollup row. Created once by a migration step rather than on
+    # every run, since replacing a view locks it
+    cur.execute(f"""
+        CREATE OR REPLACE VIEW {ROLLUP_STATS_VIEW} AS
+        SELECT {', '.join(ROLLUP_KEY_COLUMNS)}, delays,
+            delay_sum / delays AS average_delay,
+            sqrt(GREATEST(delay_sum_sq / delays - (delay_sum / delays) ^ 2, 0)) AS delay_stddev,
+            delay_histogram
+        FROM {table}""")
+
+
+def rollup_query(source_join=''):
+    # Aggregates trip_updates_with_diffs into rollup rows. Every (key, bucket) pair is counted once, then the
+    # groups are crossed with every bucket number so each histogram has all its buckets, zeros included
+    keys = ', '.join(ROLLUP_KEY_COLUMNS)
+    return f"""
+        WITH source AS (
+            SELECT d.route_id, d.stop_id, d.start_date, d.sudbury_hour_of_day AS hour, d.day_type,
+                COALESCE(d.weather_group, 'Unknown') AS weather_group, d.average_diff_in_minutes AS delay
+            FROM trip_updates_with_diffs AS d
+            {source_join}
+            WHERE d.average_diff_in_minutes IS NOT NULL
+                AND d.route_id IS NOT NULL
+                AND d.sudbury_hour_of_day IS NOT NULL
+                AND d.day_type IS NOT NULL
+        ),
+        bucketed AS (
+            SELECT {keys},
+                width_bucket(delay, {HISTOGRAM_LOW}, {HISTOGRAM_HIGH}, {HISTOGRAM_BUCKETS}) AS bucket,
+                count(*) AS delays, sum(delay) AS delay_sum, sum(delay * delay) AS delay_sum_sq
+            FROM source
+            GROUP BY {keys}, bucket
+        ),
+        groups AS (
+            SELECT DISTINCT {keys} FROM bucketed
+        )
+        INSERT INTO {ROLLUP_TABLE} ({keys}, delays, delay_sum, delay_sum_sq, delay_histogram)
+        SELECT {', '.join(f'g.{column}' for column in ROLLUP_KEY_COLUMNS)},
+            sum(b.delays), sum(b.delay_sum), sum(b.delay_sum_sq),
+            array_agg(COALESCE(b.delays, 0)::integer ORDER BY s.bucket)
+        FROM groups AS g
+        CROSS JOIN generate_series(0, {HISTOGRAM_BUCKETS + 1}) AS s(bucket)
+        LEFT JOIN bucketed AS b
+            ON ({', '.join(f'b.{column}' for column in ROLLUP_KEY_COLUMNS)}, b.bucket)
+            = ({', '.join(f'g.{column}' for column in ROLLUP_KEY_COLUMNS)}, s.bucket)
+        GROUP BY {', '.join(f'g.{column}' for column in ROLLUP_KEY_COLUMNS)}"""
+
+
+def create_rollup_keys(cur):
+    # (route, stop, service date) triples touched by the current transaction, filled by the diff upsert
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS rollup_keys (route_id text, stop_id bigint, start_date date) ON COMMIT DROP")
+
+
+def refresh_rollups(cur):
+    # Recompute every rollup row of the touched triples, whatever their hour, day type or weather group
+    cur.execute("ANALYZE rollup_keys")
+    cur.execute(f"""
+        DELETE FROM {ROLLUP_TABLE} AS r
+        USING (SELECT DISTINCT route_id, stop_id, start_date FROM rollup_keys) AS k
+        WHERE r.route_id = k.route_id AND r.stop_id = k.stop_id AND r.start_date = k.start_date""")
+    cur.execute(rollup_query("""JOIN (SELECT DISTINCT route_id, stop_id, start_date FROM rollup_keys) AS k
+            ON d.route_id = k.route_id AND d.stop_id = k.stop_id AND d.start_date = k.start_date"""))
+    return cur.rowcount
+
+
+def rebuild_rollups(cur):
+    cur.execute(f"TRUNCATE {ROLLUP_TABLE}")
+    cur.execute(rollup_query())
+    return cur.rowcount
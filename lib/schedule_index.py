@@ -0,0 +1,168 @@
+import os
+import json
+import shutil
+import numpy as np
+from pathlib import Path
+from datetime import date, datetime
+
+# File of the index directory naming the current version. It is replaced atomically once a new version is
+# complete, and readers reload when its modification time changes
+CURRENT_FILE = 'CURRENT'
+
+# Arrays of one version, each saved as <name>.npy and memory-mapped by the readers
+INDEX_ARRAYS = ['keys', 'arrival', 'departure', 'route', 'stop']
+
+# Columns of the realtime table filled from the index at ingest
+DELAY_COLUMNS = ['arrival_time_diff_in_minutes', 'departure_time_diff_in_minutes']
+
+# Bits of a packed key: trip code, then days since 1970-01-01, then stop sequence
+DAY_BITS = 16
+SEQUENCE_BITS = 16
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def pack_keys(trip_codes, days, stop_sequences):
+    # One sortable int64 per (trip, service date, stop sequence)
+    return ((np.asarray(trip_codes, dtype=np.int64) << (DAY_BITS + SEQUENCE_BITS))
+            | (np.asarray(days, dtype=np.int64) << SEQUENCE_BITS)
+            | np.asarray(stop_sequences, dtype=np.int64))
+
+
+def service_day_number(service_date):
+    # Days since 1970-01-01 of a YYYYMMDD service date, given as a string or an integer
+    return datetime.strptime(str(service_date), '%Y%m%d').toordinal() - EPOCH_ORDINAL
+
+
+def delay_columns_sql(table):
+    # Nullable columns, so adding them does not rewrite the table. ALTER TABLE takes an ACCESS EXCLUSIVE lock
+    # even when every column exists, so it only runs when one is missing
+    names = ', '.join(f"'{column}'" for column in DELAY_COLUMNS)
+    alter = f"ALTER TABLE {table} " + ', '.join(f"ADD COLUMN IF NOT EXISTS {column} double precision" for column in DELAY_COLUMNS)
+    return f"""DO $$
+        BEGIN
+            IF (SELECT count(*) FROM pg_attribute WHERE attrelid = to_regclass('{table}') AND attname IN ({names}) AND NOT attisdropped) < {len(DELAY_COLUMNS)} THEN
+                {alter};
+            END IF;
+        END $$;"""
+
+
+def ensure_delay_columns(cur, table):
+    cur.execute(delay_columns_sql(table))
+
+
+def write_schedule_index(directory, vocabulary, trip_codes, days, stop_sequences, arrivals, departures, route_codes, stop_codes):
+    # Sorted by key, one entry per key. Each build goes to a new version directory and CURRENT is switched
+    # once every file is written. The previous version is kept for readers that still have it mapped
+    directory = Path(directory)
+    valid = (np.asarray(stop_sequences) >= 0) & (np.asarray(stop_sequences) < 1 << SEQUENCE_BITS) & (np.asarray(days) >= 0)
+    keys = pack_keys(np.asarray(trip_codes)[valid], np.asarray(days)[valid], np.asarray(stop_sequences)[valid])
+    keys, first = np.unique(keys, return_index=True)
+    arrays = {
+        'keys': keys,
+        'arrival': np.asarray(arrivals, dtype=np.int64)[valid][first],
+        'departure': np.asarray(departures, dtype=np.int64)[valid][first],
+        'route': np.asarray(route_codes, dtype=np.int32)[valid][first],
+        'stop': np.asarray(stop_codes, dtype=np.int32)[valid][first],
+    }
+
+    version = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+    version_dir = directory / version
+    version_dir.mkdir(parents=True)
+    for name in INDEX_ARRAYS:
+        np.save(version_dir / f'{name}.npy', arrays[name])
+    with open(version_dir / 'vocabulary.json', 'w') as f:
+        json.dump(vocabulary, f, separators=(',', ':'))
+
+    previous = read_current(directory)
+    temporary_file = directory / (CURRENT_FILE + '.tmp')
+    temporary_file.write_text(version)
+    os.replace(temporary_file, directory / CURRENT_FILE)
+
+    for old in directory.iterdir():
+        if old.is_dir() and old.name not in (version, previous):
+            shutil.rmtree(old, ignore_errors=True)
+    return len(keys)
+
+
+def read_current(directory):
+    current = Path(directory) / CURRENT_FILE
+    return current.read_text().strip() if current.is_file() else None
+
+
+class ScheduleIndex:
+    # Read side of the index. The arrays are memory-mapped, so processes loading the same version share
+    # their pages through the page cache, and lookups only touch the pages they need
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.mtime = None
+        self.version = None
+        self.arrays = None
+        self.day_numbers = {}
+
+    def refresh(self):
+        # Reload when a new version was published since the last call. Returns whether an index is loaded
+        try:
+            mtime = (self.directory / CURRENT_FILE).stat().st_mtime
+        except FileNotFoundError:
+            return self.arrays is not None
+        if mtime != self.mtime:
+            version = read_current(self.directory)
+            version_dir = self.directory / version
+            self.arrays = {name: np.load(version_dir / f'{name}.npy', mmap_mode='r') for name in INDEX_ARRAYS}
+            with open(version_dir / 'vocabulary.json', 'r') as f:
+                vocabulary = json.load(f)
+            self.trip_codes = {trip_id: code for code, trip_id in enumerate(vocabulary['trip_ids'])}
+            self.stop_codes = {stop_id: code for code, stop_id in enumerate(vocabulary['stop_ids'])}
+            self.route_ids = vocabulary['route_ids']
+            self.mtime, self.version = mtime, version
+            print(f"Loaded schedule index {version} ({len(self.arrays['keys'])} stop times, "
+                  f"service dates {vocabulary.get('first_date')} to {vocabulary.get('last_date')}).")
+        return True
+
+    def day_number(self, start_date):
+        # -1 for an empty or malformed start date, which no key of the index matches
+        if start_date not in self.day_numbers:
+            try:
+                self.day_numbers[start_date] = service_day_number(start_date)
+            except (TypeError, ValueError):
+                self.day_numbers[start_date] = -1
+        return self.day_numbers[start_date]
+
+    def lookup(self, rows):
+        # Position in the index of each (trip_id, start_date, stop_sequence, stop_id, ...) row, -1 when the
+        # stop time is not scheduled or the stop differs
+        trip_codes = np.array([self.trip_codes.get(row[0], -1) for row in rows], dtype=np.int64)
+        days = np.array([self.day_number(row[1]) for row in rows], dtype=np.int64)
+        sequences = np.array([row[2] for row in rows], dtype=np.int64)
+        stop_codes = np.array([self.stop_codes.get(row[3], -1) for row in rows], dtype=np.int64)
+
+        keys = self.arrays['keys']
+        packed = pack_keys(trip_codes, days, sequences)
+        positions = np.minimum(np.searchsorted(keys, packed), max(len(keys) - 1, 0))
+        found = ((trip_codes >= 0) & (days >= 0) & (days < 1 << DAY_BITS) & (sequences >= 0) & (sequences < 1 << SEQUENCE_BITS) & (len(keys) > 0))
+        if len(keys):
+            found &= (keys[positions] == packed) & (self.arrays['stop'][positions] == stop_codes)
+        return np.where(found, positions, -1)
+
+    def delays(self, rows):
+        # Arrival and departure delays in minutes of realtime rows (trip_id, start_date, stop_sequence, stop_id,
+        # arrival_epoch, departure_epoch), None where the event or the scheduled time is missing.
+        # Returns None when no index has been published yet
+        if not self.refresh():
+            return None
+        if not rows:
+            return []
+        positions = self.lookup(rows)
+        found = positions >= 0
+        safe = np.where(found, positions, 0)
+
+        def minutes(actual_column, scheduled):
+            # Zero or missing realtime times mean the event is not predicted
+            actual = np.array([row[actual_column] or 0 for row in rows], dtype=np.int64)
+            scheduled = np.asarray(scheduled[safe]) if len(scheduled) else np.zeros(len(rows), dtype=np.int64)
+            present = found & (actual != 0) & (scheduled >= 0)
+            return np.where(present, (actual - scheduled) / 60, np.nan)
+
+        arrival = minutes(4, self.arrays['arrival'])
+        departure = minutes(5, self.arrays['departure'])
+        return [(None if np.isnan(a) else float(a), None if np.isnan(d) else float(d)) for a, d in zip(arrival, departure)]
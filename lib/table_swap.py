@@ -0,0 +1,88 @@
+import re
+from lib.partitions import ensure_partitions, ensure_partitions_for_dates, forget_partitions, is_partitioned, list_partitions, rename_partitions
+
+# Suffix of the indexes of a staging table until the swap gives them the names of the live ones
+STAGING_SUFFIX = '_staging'
+
+
+def create_staging_table(cur, table, staging, dates=()):
+    # Empty copy of the live table to be filled in the background, without indexes so it loads as a plain append.
+    # A partitioned table gets the partitions of the live table and those of the given start dates. Leftovers of an
+    # interrupted rebuild are dropped first
+    cur.execute(f"DROP TABLE IF EXISTS {staging}")
+    forget_partitions(staging)
+    partitioned = is_partitioned(cur, table)
+    cur.execute(f"CREATE TABLE {staging} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING GENERATED)"
+                + (" PARTITION BY RANGE (start_date)" if partitioned else ""))
+    if partitioned:
+        # The periods of the live table's partitions, however old, then those of the given start dates
+        for name, lower, upper in list_partitions(cur, table):
+            ensure_partitions(cur, staging, lower, lower)
+        ensure_partitions_for_dates(cur, staging, [day for day in dates if day is not None])
+
+
+def build_indexes(cur, table, staging):
+    # Indexes and primary key of the live table, built on the loaded staging table. Returns the (staging name,
+    # live name) pairs renamed by the swap
+    cur.execute("""
+        SELECT i.relname, pg_get_indexdef(i.oid), c.conname IS NOT NULL, pg_get_constraintdef(c.oid)
+        FROM pg_index AS x
+        JOIN pg_class AS i ON i.oid = x.indexrelid
+        LEFT JOIN pg_constraint AS c ON c.conindid = x.indexrelid AND c.conrelid = x.indrelid
+        WHERE x.indrelid = to_regclass(%s)""", (table,))
+    names = []
+    for name, definition, is_constraint, constraint_definition in cur.fetchall():
+        # Index names are limited to 63 bytes
+        staging_name = name[:63 - len(STAGING_SUFFIX)] + STAGING_SUFFIX
+        if is_constraint:
+            cur.execute(f"ALTER TABLE {staging} ADD CONSTRAINT {staging_name} {constraint_definition}")
+        else:
+            cur.execute(re.sub(r'^CREATE (UNIQUE )?INDEX \S+ ON (ONLY )?\S+ ',
+                               lambda match: f"CREATE {match.group(1) or ''}INDEX {staging_name} ON {staging} ", definition))
+        names.append((staging_name, name))
+    return names
+
+
+def copy_table_attributes(cur, table, staging):
+    # Owner, comments and privileges of the live table and its columns, given to the staging table, which was
+    # created with the defaults of the role running the rebuild. Those of single partitions are not carried over
+    grantee = "CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(pg_get_userbyid(a.grantee)) END"
+    grant_option = "CASE WHEN a.is_grantable THEN ' WITH GRANT OPTION' ELSE '' END"
+    cur.execute(f"""
+        SELECT statement FROM (
+            SELECT 1, format('ALTER TABLE %%s OWNER TO %%I', %(staging)s, pg_get_userbyid(c.relowner))
+            FROM pg_class AS c WHERE c.oid = to_regclass(%(table)s)
+            UNION ALL
+            SELECT 2, format('COMMENT ON TABLE %%s IS %%L', %(staging)s, obj_description(c.oid, 'pg_class'))
+            FROM pg_class AS c WHERE c.oid = to_regclass(%(table)s) AND obj_description(c.oid, 'pg_class') IS NOT NULL
+            UNION ALL
+            SELECT 3, format('COMMENT ON COLUMN %%s.%%I IS %%L', %(staging)s, t.attname, col_description(t.attrelid, t.attnum))
+            FROM pg_attribute AS t
+            WHERE t.attrelid = to_regclass(%(table)s) AND t.attnum > 0 AND NOT t.attisdropped AND col_description(t.attrelid, t.attnum) IS NOT NULL
+            UNION ALL
+            SELECT 4, format('GRANT %%s ON %%s TO %%s%%s', a.privilege_type, %(staging)s, {grantee}, {grant_option})
+            FROM pg_class AS c, aclexplode(c.relacl) AS a WHERE c.oid = to_regclass(%(table)s)
+            UNION ALL
+            SELECT 5, format('GRANT %%s (%%I) ON %%s TO %%s%%s', a.privilege_type, t.attname, %(staging)s, {grantee}, {grant_option})
+            FROM pg_attribute AS t, aclexplode(t.attacl) AS a
+            WHERE t.attrelid = to_regclass(%(table)s) AND t.attnum > 0 AND NOT t.attisdropped
+        ) AS statements (step, statement)
+        ORDER BY step""", {'table': table, 'staging': staging})
+    for (statement,) in cur.fetchall():
+        cur.execute(statement)
+
+
+def swap_tables(cur, table, staging, index_names):
+    # Replaces the live table by the staging table, in the caller's transaction: readers see either the old
+    # table or the new one. Objects that depend on the live table, like views, make the drop fail and the
+    # transaction roll back, leaving the live table in place. The new table keeps the owner, comments and
+    # privileges of the old one
+    cur.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+    copy_table_attributes(cur, table, staging)
+    cur.execute(f"DROP TABLE {table}")
+    cur.execute(f"ALTER TABLE {staging} RENAME TO {table}")
+    for staging_name, name in index_names:
+        # Renaming the index of a constraint renames the constraint too
+        cur.execute(f"ALTER INDEX {staging_name} RENAME TO {name}")
+    forget_partitions(table)
+    rename_partitions(cur, table, staging)
@@ -0,0 +1,62 @@
+def ensure_watermark_table(cur):
+    # One row per incremental job, holding the newest timestamp it has fully processed
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS etl_watermarks
+        (
+            name text NOT NULL,
+            high_water timestamp with time zone NOT NULL,
+            updated_at timestamp with time zone NOT NULL DEFAULT now(),
+            CONSTRAINT etl_watermarks_pkey PRIMARY KEY (name)
+        )""")
+
+
+def get_watermark(cur, name):
+    cur.execute("SELECT high_water FROM etl_watermarks WHERE name = %s", (name,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def set_watermark(cur, name, high_water):
+    # Part of the caller's transaction, so the watermark only moves when the work it covers is committed
+    cur.execute("""
+        INSERT INTO etl_watermarks (name, high_water)
+        VALUES (%s, %s)
+        ON CONFLICT (name) DO UPDATE SET high_water = EXCLUDED.high_water, updated_at = now()""", (name, high_water))
+
+
+# Service dates whose schedule was (re)loaded since the diffs of their realtime rows were last computed
+RELOADED_DATES_TABLE = 'schedule_reloads'
+
+
+def ensure_reloaded_dates_table(cur):
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {RELOADED_DATES_TABLE}
+        (
+            start_date date NOT NULL,
+            reloaded_at timestamp with time zone NOT NULL DEFAULT now(),
+            CONSTRAINT {RELOADED_DATES_TABLE}_pkey PRIMARY KEY (start_date)
+        )""")
+
+
+def mark_reloaded_dates(cur, dates):
+    # Part of the caller's transaction, so the dates are only marked once their schedule is committed. A date
+    # marked again gets a new time, which keeps it marked for a diff run that read the previous one
+    cur.execute(f"""
+        INSERT INTO {RELOADED_DATES_TABLE} (start_date)
+        SELECT DISTINCT unnest(%s::date[])
+        ON CONFLICT (start_date) DO UPDATE SET reloaded_at = now()""", (sorted(dates),))
+
+
+def get_reloaded_dates(cur):
+    cur.execute(f"SELECT start_date, reloaded_at FROM {RELOADED_DATES_TABLE} ORDER BY start_date")
+    return cur.fetchall()
+
+
+def clear_reloaded_dates(cur, marks):
+    # Only the marks read by the caller: a date reloaded again since then keeps its newer mark
+    if marks:
+        cur.execute(f"""
+            DELETE FROM {RELOADED_DATES_TABLE} AS r
+            USING unnest(%s::date[], %s::timestamptz[]) AS m(start_date, reloaded_at)
+            WHERE r.start_date = m.start_date AND r.reloaded_at = m.reloaded_at""",
+                    ([mark[0] for mark in marks], [mark[1] for mark in marks]))
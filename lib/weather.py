@@ -0,0 +1,33 @@
+WEATHER_TABLE = 'weather_observations'
+
+# Columns of an observation, in insert order
+WEATHER_COLUMNS = ['observed_at', 'weather_id', 'weather_group', 'weather_description', 'temperature', 'fetched_at']
+
+
+def ensure_weather_table(cur):
+    # One row per OpenWeather observation, keyed by the time the observation was made (its "dt")
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {WEATHER_TABLE}
+        (
+            observed_at timestamp with time zone NOT NULL,
+            weather_id integer,
+            weather_group text,
+            weather_description text,
+            temperature double precision,
+            fetched_at timestamp with time zone NOT NULL,
+            CONSTRAINT {WEATHER_TABLE}_pkey PRIMARY KEY (observed_at)
+        )""")
+
+
+def latest_fetch(cur):
+    cur.execute(f"SELECT max(fetched_at) FROM {WEATHER_TABLE}")
+    return cur.fetchone()[0]
+
+
+def insert_observation(cur, observation):
+    # The API returns the same observation until the station reports again, which is stored once
+    cur.execute(f"""
+        INSERT INTO {WEATHER_TABLE} ({', '.join(WEATHER_COLUMNS)})
+        VALUES ({', '.join(f'%({column})s' for column in WEATHER_COLUMNS)})
+        ON CONFLICT (observed_at) DO NOTHING""", observation)
+    return cur.rowcount
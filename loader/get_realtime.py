@@ -1,79 +1,363 @@
+import io
 import os
+import sys
+import time
+import zlib
+import shlex
+import argparse
+import threading
 import paramiko
 from dotenv import load_dotenv
 import psycopg2
 import subprocess
-import csv
-from psycopg2.extras import execute_values
+from datetime import datetime, timedelta, timezone
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib.partitions import ensure_partitions_for_dates
+from lib.metrics import RunMetrics, count_round_trips, profiled
+from lib.weather import WEATHER_TABLE, ensure_weather_table
+from lib.schedule_index import delay_columns_sql, ensure_delay_columns
+from lib.feeds import current_feed, connect_args, search_path_option
+from lib.migrations import run_migrations
 
-# Load environment variables
-load_dotenv("../scripts/.env")
+# Load environment variables, from the scripts folder whatever the working directory
+load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', '.env'))
 
 # Remote variables
 DB_USERNAME = os.getenv("REMOTE_DB_USERNAME")
 DB_PASSWORD = os.getenv("REMOTE_DB_PASSWORD")
 DB_NAME = os.getenv("REMOTE_DB_NAME")
 TABLE_NAME = os.getenv("REALTIME_TABLE")
-REMOTE_CSV_FILE_PATH = "/tmp/data.csv"  # Temporary location to store CSV on remote server
+
+# Feed of the registry whose tables are synced, selected with FEED. Its schema is used on both sides
+feed_settings = current_feed()
 
 # Local variables
 USERNAME = os.getenv("VPS_USERNAME")
 SERVER_IP = os.getenv("VPS_SERVER_IP")
-LOCAL_CSV_FILE_PATH = os.getenv("LOCAL_CSV_FILE_PATH")  # Location to store downloaded CSV on local machine
 LOCAL_DB_NAME = os.getenv("LOCAL_DB_NAME")
 PRIVATE_KEY_PATH = os.getenv("PRIVATE_KEY_PATH")
 LOCAL_USERNAME = os.getenv("LOCAL_DB_USERNAME")
 LOCAL_PASSWORD = os.getenv("LOCAL_DB_PASSWORD")
 
-def main():
-    # Create an SSH client
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(SERVER_IP, username=USERNAME, key_filename=PRIVATE_KEY_PATH)
-
-    # Export data from remote PostgreSQL table to a CSV file
-    print('Creating CSV file on the remote server...')
-    stdin, stdout, stderr = ssh.exec_command(f"PGPASSWORD={DB_PASSWORD} psql -U {DB_USERNAME} -d {DB_NAME} -c '\\COPY (SELECT * FROM {TABLE_NAME}) TO {REMOTE_CSV_FILE_PATH} CSV'")
-    stdout.channel.recv_exit_status()  # Wait until the command finishes
-    print('CSV file created.')
-
-    # Download CSV file from remote server to local machine
-    print('Transferring CSV file...')
-    scp_command = f"scp -i {PRIVATE_KEY_PATH} {USERNAME}@{SERVER_IP}:{REMOTE_CSV_FILE_PATH} {LOCAL_CSV_FILE_PATH}"
-    scp_result = subprocess.call(scp_command, shell=True)
-    if scp_result != 0:
-        print(f"Error transferring file. SCP returned code {scp_result}.")
-        return
-    print('CSV file transferred.')
-
-    # Import CSV file to local PostgreSQL table
-    print('Importing CSV file to local PostgreSQL table...')
-    with psycopg2.connect(f"dbname={LOCAL_DB_NAME} user={LOCAL_USERNAME} password={LOCAL_PASSWORD}") as conn:
-        with conn.cursor() as cur:
-            with open(LOCAL_CSV_FILE_PATH, 'r') as f:
-                execute_values(cur, f"INSERT INTO {TABLE_NAME} VALUES %s ON CONFLICT DO NOTHING", csv.reader(f))
+# Primary key of the realtime table
+KEY_COLUMNS = ['trip_id', 'start_date', 'stop_sequence', 'stop_id']
+
+# Length of the time window of remote changes pulled and committed at once
+sync_batch_minutes = int(os.getenv("SYNC_BATCH_MINUTES", 60))
+
+# Remote changes younger than this are left for the next sync, since their transaction may still be open
+sync_lag_minutes = int(os.getenv("SYNC_LAG_MINUTES", 5))
+
+# Size of the blocks read from the compressed remote stream
+READ_BLOCK_SIZE = 64 * 1024
+
+# Stage timings and counters of each run
+metrics = RunMetrics('get_realtime', feed_settings['name'])
+
+
+class LocalChannel:
+    def __init__(self, process):
+        self.process = process
+
+    def recv_exit_status(self):
+        return self.process.wait()
+
+
+class LocalStream:
+    def __init__(self, process, stream):
+        self.stream = stream
+        self.channel = LocalChannel(process)
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+
+class LocalShell:
+    # Stand-in for paramiko.SSHClient that runs the "remote" commands on this machine,
+    # so the sync can be exercised against a local Postgres without an SSH server
+    def exec_command(self, command):
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return process.stdin, LocalStream(process, process.stdout), LocalStream(process, process.stderr)
+
+    def close(self):
+        pass
+
+
+class GzipStreamReader:
+    # File-like object for COPY FROM STDIN that decompresses the remote stream as it is read
+    def __init__(self, stream):
+        self.stream = stream
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = b''
+        self.bytes_received = 0
+        self.finished = False
+
+    def read(self, size=-1):
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            block = self.stream.read(READ_BLOCK_SIZE)
+            if not block:
+                self.buffer += self.decompressor.flush()
+                self.finished = True
+                break
+            self.bytes_received += len(block)
+            self.buffer += self.decompressor.decompress(block)
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class StreamDrain:
+    # Reads a stream to its end in a background thread, so a command never blocks on a full stderr (or
+    # stdout) pipe while the other stream is being consumed
+    def __init__(self, stream):
+        self.chunks = []
+        self.thread = threading.Thread(target=self.drain, args=(stream,), daemon=True)
+        self.thread.start()
+
+    def drain(self, stream):
+        for block in iter(lambda: stream.read(READ_BLOCK_SIZE), b''):
+            self.chunks.append(block)
+
+    def text(self):
+        self.thread.join()
+        return b''.join(self.chunks).decode(errors='replace').strip()
+
+
+def remote_psql(sql, options=''):
+    # psql command line run on the remote server. A list of statements runs them one after the other in the
+    # same session
+    pgoptions = f"PGOPTIONS={shlex.quote(search_path_option(feed_settings))} " if feed_settings['schema'] else ''
+    commands = ' '.join(f"-c {shlex.quote(statement)}" for statement in ([sql] if isinstance(sql, str) else sql))
+    return f"{pgoptions}PGPASSWORD={shlex.quote(DB_PASSWORD)} psql {options} -v ON_ERROR_STOP=1 -U {DB_USERNAME} -d {DB_NAME} {commands}"
+
+
+def run_remote(ssh, command):
+    metrics.add('remote_round_trips')
+    stdin, stdout, stderr = ssh.exec_command(command)
+    output, errors = StreamDrain(stdout), StreamDrain(stderr)
+    exit_status = stdout.channel.recv_exit_status()  # Wait until the command finishes
+    output.text()
+    # The exit status decides: psql also writes NOTICEs, like those of IF NOT EXISTS, to stderr
+    if exit_status != 0:
+        raise RuntimeError(f"Remote command failed with status {exit_status}: {errors.text()}")
+
+
+def table_columns(cur, table):
+    cur.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_name = %s AND table_schema = current_schema()
+        ORDER BY ordinal_position""", (table,))
+    return [row[0] for row in cur.fetchall()]
+
+
+def remote_scalar(ssh, sql):
+    # Single value printed by psql in unaligned, tuples-only mode, or None for NULL
+    metrics.add('remote_round_trips')
+    stdin, stdout, stderr = ssh.exec_command(remote_psql(sql, '-At'))
+    errors = StreamDrain(stderr)
+    output = stdout.read().decode().strip()
+    exit_status = stdout.channel.recv_exit_status()
+    if exit_status != 0:
+        raise RuntimeError(f"Remote query failed with status {exit_status}: {errors.text()}")
+    return output or None
+
+
+def stream_remote_table(ssh, conn, table, condition):
+    # Remote COPY TO STDOUT of the rows matching the condition, compressed on the fly and piped over the SSH
+    # channel straight into a local COPY FROM STDIN. Both sides name the columns of the local table, so the
+    # remote column order does not matter
+    with conn.cursor() as cur:
+        columns = ', '.join(table_columns(cur, table))
+        select_query = f"SELECT {columns} FROM {table} WHERE {condition}"
+        command = f"set -o pipefail; {remote_psql(f'COPY ({select_query}) TO STDOUT WITH (FORMAT csv)')} | gzip -c"
+        metrics.add('remote_round_trips')
+        stdin, stdout, stderr = ssh.exec_command(f"bash -c {shlex.quote(command)}")
+        errors = StreamDrain(stderr)
+        reader = GzipStreamReader(stdout)
+
+        # Session-level staging table shaped like the local table, dropped after the merge
+        cur.execute(f"CREATE TEMP TABLE {table}_staging (LIKE {table} INCLUDING DEFAULTS)")
+        cur.copy_expert(f"COPY {table}_staging ({columns}) FROM STDIN WITH (FORMAT csv)", reader)
+        rows = cur.rowcount
+
+    exit_status = stdout.channel.recv_exit_status()
+    if exit_status != 0:
+        raise RuntimeError(f"Remote export failed with status {exit_status}: {errors.text()}")
+    return rows, reader.bytes_received
+
+
+def merge_staging(conn, table, key_columns):
+    with conn.cursor() as cur:
+        # Partitions for the synced start dates are committed on their own, before the merge
+        if 'start_date' in key_columns:
+            cur.execute(f"SELECT DISTINCT start_date FROM {table}_staging")
+            ensure_partitions_for_dates(cur, table, [row[0] for row in cur.fetchall()])
             conn.commit()
-    print('CSV file imported.')
 
-    # Truncate the remote realtime table
-    print('Truncating the remote realtime table...')
-    stdin, stdout, stderr = ssh.exec_command(f"PGPASSWORD={DB_PASSWORD} psql -U {DB_USERNAME} -d {DB_NAME} -c 'TRUNCATE TABLE {TABLE_NAME};'")
-    stdout.channel.recv_exit_status()  # Wait until the command finishes
-    print('Remote realtime table truncated.')
+        # Set-based merge: new rows are inserted, rows that changed on the remote side since the last sync are updated
+        columns = table_columns(cur, table)
+        value_columns = [column for column in columns if column not in key_columns]
+        cur.execute(f"""
+            INSERT INTO {table} ({', '.join(columns)})
+            SELECT {', '.join(columns)} FROM {table}_staging
+            ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET
+            {', '.join(f"{column} = EXCLUDED.{column}" for column in value_columns)}
+            WHERE ({', '.join(f"{table}.{column}" for column in value_columns)})
+            IS DISTINCT FROM ({', '.join(f"EXCLUDED.{column}" for column in value_columns)})""")
+        merged = cur.rowcount
+        cur.execute(f"DROP TABLE {table}_staging")
+    conn.commit()
+    return merged
+
+
+def parse_remote_timestamp(value):
+    return None if value is None else datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+
+
+def remote_timestamp(value):
+    return f"'{value.isoformat()}'::timestamptz"
+
+
+def synced_keys(conn, table, key_columns, change_column):
+    # CSV of the key and change time of every staged row, the exact versions the merge is about to commit
+    buffer = io.StringIO()
+    with conn.cursor() as cur:
+        cur.copy_expert(f"COPY (SELECT {', '.join(key_columns)}, {change_column} FROM {table}_staging) TO STDOUT WITH (FORMAT csv)", buffer)
+    return buffer.getvalue().encode()
+
+
+def delete_remote_rows(ssh, table, key_columns, change_column, keys):
+    # Deletes the remote rows that were merged locally, by key and change time. A row written again since it
+    # was pulled, or committed late with an older change time, does not match and is pulled by a later window
+    key_match = ' AND '.join(f"{table}.{column} = k.{column}" for column in key_columns)
+    statements = [
+        f"CREATE TEMP TABLE synced_keys AS SELECT {', '.join(key_columns)}, {change_column} AS changed_at FROM {table} LIMIT 0",
+        "\\copy synced_keys FROM pstdin WITH (FORMAT csv)",
+        f"DELETE FROM {table} USING synced_keys AS k WHERE {key_match} AND {change_column} = k.changed_at",
+    ]
+    metrics.add('remote_round_trips')
+    stdin, stdout, stderr = ssh.exec_command(remote_psql(statements))
+    output, errors = StreamDrain(stdout), StreamDrain(stderr)
+    stdin.write(keys)
+    stdin.close()
+    exit_status = stdout.channel.recv_exit_status()
+    output.text()
+    if exit_status != 0:
+        raise RuntimeError(f"Remote delete failed with status {exit_status}: {errors.text()}")
+
+
+def sync_table(ssh, conn, table, key_columns, change_column, batch):
+    # Incremental pull of the remote rows, in bounded time windows. Rows are deleted remotely only once
+    # committed locally, and only those merged, so whatever the remote still holds is pulled by a later sync:
+    # leftovers of a failed delete, rows updated since they were pulled, and rows committed after their window.
+    # The remote table itself is the record of what is left to sync, so no watermark is kept
+    # Range of remote changes to pull. The newest SYNC_LAG_MINUTES are left for the next sync, since the
+    # extractor transactions writing them may still be open
+    as_utc_text = "to_char({} AT TIME ZONE 'UTC', 'YYYY-MM-DD\"T\"HH24:MI:SS.US')"
+    with metrics.stage('bounds'):
+        bounds = remote_scalar(ssh, f"""
+            SELECT {as_utc_text.format(f'min({change_column})')} || ',' || {as_utc_text.format(f'max({change_column})')}
+            FROM {table} WHERE {change_column} <= now() - interval '{sync_lag_minutes} minutes'""")
+    if bounds is None:
+        print(f'{table}: no remote changes to pull.')
+        return 0
+
+    first_change, last_change = (parse_remote_timestamp(value) for value in bounds.split(','))
+    start = first_change - timedelta(microseconds=1)
+    total = 0
+    while start < last_change:
+        end = min(start + batch, last_change)
+
+        # Stream the window into the local staging table. The rows of earlier windows are gone from the
+        # remote table, except those that must be pulled again
+        window_start = time.perf_counter()
+        with metrics.stage('stream'):
+            rows, bytes_received = stream_remote_table(ssh, conn, table, f"{change_column} <= {remote_timestamp(end)}")
+            keys = synced_keys(conn, table, key_columns, change_column)
+        metrics.add('rows_streamed', rows)
+        metrics.add('bytes_downloaded', bytes_received)
+
+        # Merge into the local table, then delete the merged rows remotely
+        with metrics.stage('merge'):
+            merged = merge_staging(conn, table, key_columns)
+        metrics.add('rows_merged', merged)
+        with metrics.stage('remote_delete'):
+            delete_remote_rows(ssh, table, key_columns, change_column, keys)
+
+        seconds = time.perf_counter() - window_start
+        print(f'{table}: window up to {end}: {rows} rows, {bytes_received / 1024:.1f} KiB compressed, '
+              f'{merged} inserted or updated, {rows / max(seconds, 1e-9):,.0f} rows/s.')
+        total += rows
+        start = end
+    return total
+
+
+def sync(local_remote, batch_minutes, engine=None):
+    # Create an SSH client, or the local stand-in for testing
+    with metrics.stage('connect'):
+        if local_remote:
+            ssh = LocalShell()
+        else:
+            ssh = paramiko.SSHClient()
+            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh.connect(SERVER_IP, username=USERNAME, key_filename=PRIVATE_KEY_PATH)
+
+    batch = timedelta(minutes=batch_minutes or sync_batch_minutes)
+
+    # A connection from the pool of the pipeline runner, or a connection of its own
+    if engine is not None:
+        conn = engine.raw_connection()
+    else:
+        conn = psycopg2.connect(f"dbname={LOCAL_DB_NAME} user={LOCAL_USERNAME} password={LOCAL_PASSWORD}", **connect_args(feed_settings))
+    try:
+        count_round_trips(conn, metrics)
+        # Typed keys and supporting indexes of the local tables. The remote ones are migrated by the extractor
+        with metrics.stage('migrations'):
+            run_migrations(conn, feed_settings['timezone'])
+
+        # The remote table streams all of its columns, so both sides get the delay columns written at ingest.
+        # Each side is only altered, and locked, while a column is missing
+        run_remote(ssh, remote_psql(delay_columns_sql(TABLE_NAME)))
+        with conn.cursor() as cur:
+            ensure_delay_columns(cur, TABLE_NAME)
+        conn.commit()
+
+        # Pull the realtime rows changed since the last sync
+        print('Syncing the remote realtime table...')
+        start = time.perf_counter()
+        rows = sync_table(ssh, conn, TABLE_NAME, KEY_COLUMNS, "GREATEST(created_at, updated_at)", batch)
+        seconds = time.perf_counter() - start
+        print(f'Synced {rows} rows in {seconds:.2f} s ({rows / max(seconds, 1e-9):,.0f} rows/s).')
+
+        # Pull the weather observations fetched since the last sync
+        print('Syncing the remote weather table...')
+        with conn.cursor() as cur:
+            ensure_weather_table(cur)
+        conn.commit()
+        rows = sync_table(ssh, conn, WEATHER_TABLE, ['observed_at'], 'fetched_at', batch)
+        print(f'Synced {rows} weather observations.')
+    finally:
+        conn.close()
 
-    # Remove local CSV file
-    print('Removing local CSV file...')
-    os.remove(LOCAL_CSV_FILE_PATH)
-    print('Local CSV file removed.')
+        # Close SSH connection
+        ssh.close()
+    return 'ok'
 
-    # Remove remote CSV file
-    print('Removing remote CSV file...')
-    stdin, stdout, stderr = ssh.exec_command(f"rm {REMOTE_CSV_FILE_PATH}")
-    stdout.channel.recv_exit_status()  # Wait until the command finishes
-    print('Remote CSV file removed.')
 
-    # Close SSH connection
-    ssh.close()
+def main(local_remote=False, batch_minutes=None, engine=None):
+    # A run that does not return a status, for example on an exception, is reported as an error
+    status = 'error'
+    try:
+        with profiled('get_realtime'):
+            status = sync(local_remote, batch_minutes, engine)
+    finally:
+        metrics.finish(status)
+    return status
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Sync the remote realtime table into the local database.')
+    parser.add_argument('--local-remote', action='store_true', help='Run the "remote" psql commands on this machine instead of over SSH, for testing.')
+    parser.add_argument('--batch-minutes', type=int, help='Length of the time window pulled in one batch, defaults to SYNC_BATCH_MINUTES.')
+    args = parser.parse_args()
+    main(local_remote=args.local_remote, batch_minutes=args.batch_minutes)
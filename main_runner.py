@@ -1,8 +1,193 @@
 import os
+import sys
+import time
+import signal
+import argparse
+import multiprocessing
+from multiprocessing.connection import wait
 from dotenv import load_dotenv
 
-# Load .env file
-load_dotenv('scripts/.env')
+# Absolute paths, so the runner behaves the same from cron or from any working directory
+root_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(root_dir, 'scripts'))
+sys.path.insert(0, os.path.join(root_dir, 'loader'))
 
-os.system('python3 loader/get_realtime.py')
-os.system('python3 scripts/diff_times.py')
\ No newline at end of file
+# Load .env file, before the stages read their settings at import time
+load_dotenv(os.path.join(root_dir, 'scripts', '.env'))
+
+import get_realtime
+import historical_extractor
+import diff_times
+from sqlalchemy import create_engine
+from lib.feeds import current_feed, connect_args
+
+
+def sync_stage(engine):
+    return get_realtime.main(engine=engine)
+
+
+def historical_stage(engine):
+    return historical_extractor.main(bulk=True, incremental=True, engine=engine)
+
+
+def diff_stage(engine):
+    return diff_times.populate_table(engine=engine)
+
+
+# Stages of the local pipeline: function, stages it waits for, and whether it runs without --only.
+# Stages that do not wait for each other run in parallel
+STAGES = {
+    'sync': (sync_stage, [], True),
+    'historical': (historical_stage, [], False),
+    'diff': (diff_stage, ['sync', 'historical'], True),
+}
+
+# Longest a stage may run, in seconds, like the 30-minute alarm of the scripts run on their own
+stage_timeout_seconds = int(os.getenv("STAGE_TIMEOUT_SECONDS", 30 * 60))
+
+# Seconds a stage that timed out gets to stop after SIGTERM, before it is killed
+stage_grace_seconds = 10
+
+# Exit codes: a stage failed, or the stage selection is invalid
+EXIT_STAGE_FAILED = 1
+EXIT_USAGE = 2
+
+
+def select_stages(only, skip):
+    selected = list(only) if only else [name for name, (_, _, default) in STAGES.items() if default]
+    unknown = [name for name in selected + list(skip) if name not in STAGES]
+    if unknown:
+        raise ValueError(f"Unknown stage(s): {', '.join(unknown)}. Stages: {', '.join(STAGES)}")
+    return [name for name in STAGES if name in selected and name not in skip]
+
+
+def run_stage(name, function, engine):
+    # Status of the stage and its duration. Statuses ending in "error" are failures
+    start = time.perf_counter()
+    try:
+        status = function(engine) or 'ok'
+    except Exception as e:
+        print(f"Stage {name} failed: {e!r}")
+        status = 'error'
+    return status, time.perf_counter() - start
+
+
+def stage_process(name, function, db_url, engine_args, results):
+    # Body of the process of one stage, which sends its status and duration back. The process leads its own
+    # group, so stopping the stage also stops the processes it started, like the shards of a parallel rebuild.
+    # SIGTERM raises SystemExit, so the stage releases its locks and connections once its current call returns
+    os.setpgrp()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    engine = create_engine(db_url, pool_pre_ping=True, connect_args=engine_args)
+    try:
+        results.send(run_stage(name, function, engine))
+    finally:
+        engine.dispose()
+
+
+def stop_stage(process):
+    # SIGTERM to the stage's process group, then SIGKILL to whatever is left of it after the grace period
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.join(stage_grace_seconds)
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # Not leading its group yet, or the whole group is gone
+        process.kill()
+    process.join()
+
+
+def run_pipeline(stages, db_url, engine_args, workers, timeout=stage_timeout_seconds, functions=None):
+    # Each stage runs in its own process with its own engine. A stage starts once the selected stages it waits
+    # for have succeeded. After a failure no new stage is started, the running ones finish, and the stages left
+    # are reported as not run. A stage running longer than the timeout is stopped, with the processes it
+    # started, and reported as timed out. `functions` replaces the functions of STAGES by name
+    functions = {name: STAGES[name][0] for name in stages} | (functions or {})
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    pending = list(stages)
+    running = {}
+    failed = False
+    try:
+        while pending or running:
+            if not failed:
+                for name in list(pending):
+                    if len(running) < workers and all(dependency in results for dependency in STAGES[name][1] if dependency in stages):
+                        pending.remove(name)
+                        print(f"Starting stage {name}...")
+                        receiver, sender = context.Pipe(duplex=False)
+                        process = context.Process(target=stage_process, args=(name, functions[name], db_url, engine_args, sender), name=f'stage-{name}')
+                        process.start()
+                        sender.close()
+                        running[process.sentinel] = (name, process, receiver, time.monotonic(), time.monotonic() + timeout)
+            if not running:
+                break
+            for sentinel in wait(list(running), timeout=max(0, min(entry[4] for entry in running.values()) - time.monotonic())):
+                name, process, receiver, started, _ = running.pop(sentinel)
+                process.join()
+                try:
+                    results[name] = receiver.recv()
+                except EOFError:
+                    print(f"Stage {name} exited with code {process.exitcode} without a status.")
+                    results[name] = ('error', time.monotonic() - started)
+                if results[name][0].endswith('error'):
+                    failed = True
+            now = time.monotonic()
+            for sentinel in [sentinel for sentinel, entry in running.items() if now >= entry[4]]:
+                name, process, *_ = running.pop(sentinel)
+                print(f"Stage {name} timed out after {timeout} s, stopping it.")
+                stop_stage(process)
+                results[name] = ('timeout_error', float(timeout))
+                failed = True
+    finally:
+        # Stages still running when the runner itself is interrupted
+        for name, process, *_ in running.values():
+            stop_stage(process)
+    for name in pending:
+        results[name] = ('not_run', 0.0)
+    return results, failed
+
+
+def engine_connect_args(feed, timeout):
+    # Connections of the stages get the feed's search path, and a statement_timeout that bounds the query a
+    # stopped stage leaves running on the server
+    args = connect_args(feed)
+    args['options'] = f"{args.get('options', '')} -c statement_timeout={timeout * 1000}".strip()
+    return args
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the local pipeline stages, each in its own process, and stop those that run too long.')
+    parser.add_argument('--only', nargs='+', default=[], metavar='STAGE', help=f"Stages to run. Without it: {', '.join(name for name, (_, _, default) in STAGES.items() if default)}.")
+    parser.add_argument('--skip', nargs='+', default=[], metavar='STAGE', help='Stages to leave out.')
+    parser.add_argument('--workers', type=int, default=2, help='Stages run at the same time at most.')
+    parser.add_argument('--stage-timeout', type=int, default=stage_timeout_seconds, metavar='SECONDS',
+                        help='Longest a stage may run, and a single statement of it (STAGE_TIMEOUT_SECONDS, 1800 by default).')
+    args = parser.parse_args()
+
+    try:
+        stages = select_stages(args.only, args.skip)
+    except ValueError as e:
+        print(e)
+        sys.exit(EXIT_USAGE)
+    if not stages:
+        print('No stage selected.')
+        sys.exit(EXIT_USAGE)
+
+    # The stages work on the feed selected with FEED
+    start = time.perf_counter()
+    results, failed = run_pipeline(stages, os.getenv("LOCAL_DB_URL"), engine_connect_args(current_feed(), args.stage_timeout),
+                                   args.workers, args.stage_timeout)
+    total = time.perf_counter() - start
+
+    # Per-stage timing summary
+    print(f"{'stage':<12} {'status':<16} {'seconds':>9}")
+    for name in stages:
+        status, seconds = results[name]
+        print(f"{name:<12} {status:<16} {seconds:9.2f}")
+    print(f"{'total':<12} {'failed' if failed else 'ok':<16} {total:9.2f}")
+    sys.exit(EXIT_STAGE_FAILED if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
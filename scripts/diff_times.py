@@ -1,50 +1,94 @@
 import os
+import sys
+import time
+import argparse
 from dotenv import load_dotenv
 import psycopg2
 from datetime import datetime, timedelta
 import pytz
 import signal
+import threading
+import multiprocessing
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib.watermarks import ensure_watermark_table, get_watermark, set_watermark, ensure_reloaded_dates_table, get_reloaded_dates, clear_reloaded_dates
+from lib.partitions import ensure_partitions_for_dates
+from lib.metrics import RunMetrics, count_round_trips, profiled
+from lib.weather import WEATHER_TABLE, ensure_weather_table
+from lib.rollups import ensure_rollup_table, create_rollup_keys, refresh_rollups, rebuild_rollups
+from lib.feeds import current_feed, connect_args
+from lib.migrations import run_migrations
+from lib.table_swap import create_staging_table, build_indexes, swap_tables
 
 # Load .env file
 load_dotenv()
 
-# Define the timeout handler function
-def timeout_handler(signum, frame):
-    raise TimeoutError("Script execution timed out")
+# Feed of the registry whose tables this process diffs, selected with FEED
+feed_settings = current_feed()
 
-def populate_table():
-    # Set the timeout period in seconds
-    timeout_seconds = 30 * 60  # 30 minutes
-    
-    # Set the timeout signal handler
-    signal.signal(signal.SIGALRM, timeout_handler)
-    signal.alarm(timeout_seconds)  # Set the alarm
+# Stage timings and counters of each run
+metrics = RunMetrics('diff_times', feed_settings['name'])
 
-    try:
-        # Get current datetime in UTC
-        now = datetime.utcnow().replace(tzinfo=pytz.UTC)
+# Name of the high-water mark of this job in etl_watermarks
+WATERMARK_NAME = 'diff_times'
 
-        conn = psycopg2.connect(
-            database=os.getenv("LOCAL_DB_NAME"),
-            user=os.getenv("LOCAL_DB_USERNAME"),
-            password=os.getenv("LOCAL_DB_PASSWORD"),
-            host="localhost",
-            port="5432"
-        )
+# Advisory lock serializing the runs of a feed, rebuilds and incremental runs alike
+lock_name = f"{WATERMARK_NAME}:{feed_settings['name']}"
 
-        cur = conn.cursor()
+# Realtime rows are rescanned this far behind the high-water mark, to catch rows committed late by a slow extractor run
+watermark_overlap = timedelta(minutes=int(os.getenv("DIFF_WATERMARK_OVERLAP_MINUTES", 30)))
+
+# Weather observations older than this at the time of a realtime row are not attached to it
+weather_max_age_minutes = int(os.getenv("WEATHER_MAX_AGE_MINUTES", 60))
+
+# Columns of trip_updates_with_diffs, in the order the query selects them
+DIFF_COLUMNS = [
+    'trip_id', 'start_date', 'stop_sequence', 'stop_id', 'route_id', 'stop_name', 'route_long_name',
+    'actual_arrival_time', 'scheduled_arrival_time', 'arrival_time_diff_in_minutes',
+    'actual_departure_time', 'scheduled_departure_time', 'departure_time_diff_in_minutes', 'average_diff_in_minutes',
+    'weather_group', 'weather_description', 'temperature', 'day_type', 'sudbury_hour_of_day', 'geo_coordinates',
+    'created_at', 'updated_at',
+]
+KEY_COLUMNS = ['trip_id', 'start_date', 'stop_sequence', 'stop_id']
+
+# Table the diffs are written to, and the table a parallel rebuild fills before it is swapped in
+DIFF_TABLE = 'trip_updates_with_diffs'
+STAGING_TABLE = f'{DIFF_TABLE}_staging'
 
-        # Delete old data
-        cur.execute("DELETE FROM trip_updates_with_diffs;")
+# Longest a run may take, in seconds. Its connections get the same statement_timeout, which also bounds the
+# shards of a parallel rebuild, whose worker processes the alarm does not reach
+run_timeout_seconds = 30 * 60  # 30 minutes
 
-        # Populate the table with the new data
-        query = """
-        INSERT INTO trip_updates_with_diffs
+# Define the timeout handler function
+def timeout_handler(signum, frame):
+    raise TimeoutError("Script execution timed out")
+
+def diff_query(incremental, table=DIFF_TABLE, shard=False):
+    # Upsert the diffs of the realtime rows (only those created or updated after %(since)s or on the service
+    # dates of %(reloaded_dates)s when incremental), counting rows scanned and changed. When incremental, the (route, stop, service date) triples of the
+    # changed rows are collected in rollup_keys, so only their rollups are recomputed. A shard of a parallel
+    # rebuild appends the rows of the service dates between %(first_date)s and %(last_date)s to a table
+    # without indexes. The delay columns the extractor may write at ingest are not read: the join is needed for
+    # the other scheduled columns anyway, and its delays follow the schedule reloads
+    value_columns = [column for column in DIFF_COLUMNS if column not in KEY_COLUMNS]
+    if incremental:
+        changed_filter = "WHERE GREATEST(created_at, updated_at) > %(since)s OR start_date = ANY(%(reloaded_dates)s::date[])"
+    elif shard:
+        changed_filter = "WHERE start_date BETWEEN %(first_date)s AND %(last_date)s"
+    else:
+        changed_filter = ""
+    return """
+        WITH changed AS (
+            SELECT *
+            FROM """ + os.getenv("REALTIME_TABLE") + """
+            """ + changed_filter + """
+        ),
+        upserted AS (
+        INSERT INTO """ + table + """ (""" + ', '.join(DIFF_COLUMNS) + """)
         SELECT 
             tu.trip_id, 
             tu.start_date, 
             tu.stop_sequence, 
-            tu.stop_id::bigint,
+            gd.stop_id,
             gd.route_id, 
             gd.stop_name, 
             gd.route_long_name, 
@@ -76,49 +120,324 @@ def populate_table():
                 ELSE
                     NULL
             END AS average_diff_in_minutes,
-            tu.weather_group,
-            tu.weather_description,
-            tu.temperature,
-            CASE
-                WHEN EXTRACT(DOW FROM gd.arrival_time AT TIME ZONE 'UTC' AT TIME ZONE 'America/Toronto') = 0 THEN 'Sunday'
-                WHEN EXTRACT(DOW FROM gd.arrival_time AT TIME ZONE 'UTC' AT TIME ZONE 'America/Toronto') = 1 THEN 'Monday'
-                WHEN EXTRACT(DOW FROM gd.arrival_time AT TIME ZONE 'UTC' AT TIME ZONE 'America/Toronto') = 2 THEN 'Tuesday'
-                WHEN EXTRACT(DOW FROM gd.arrival_time AT TIME ZONE 'UTC' AT TIME ZONE 'America/Toronto') = 3 THEN 'Wednesday'
-                WHEN EXTRACT(DOW FROM gd.arrival_time AT TIME ZONE 'UTC' AT TIME ZONE 'America/Toronto') = 4 THEN 'Thursday'
-                WHEN EXTRACT(DOW FROM gd.arrival_time AT TIME ZONE 'UTC' AT TIME ZONE 'America/Toronto') = 5 THEN 'Friday'
-                WHEN EXTRACT(DOW FROM gd.arrival_time AT TIME ZONE 'UTC' AT TIME ZONE 'America/Toronto') = 6 THEN 'Saturday'
-            END AS day_type,
-            DATE_PART('hour', gd.arrival_time AT TIME ZONE 'America/Toronto') AS sudbury_hour_of_day,
+            COALESCE(w.weather_group, tu.weather_group) AS weather_group,
+            COALESCE(w.weather_description, tu.weather_description) AS weather_description,
+            COALESCE(w.temperature, tu.temperature) AS temperature,
+            gd.day_type,
+            gd.hour_of_day AS sudbury_hour_of_day,
             gd.geo_coordinates,
             tu.created_at,
             tu.updated_at
         FROM 
-            """ + os.getenv("REALTIME_TABLE") + """ AS tu
+            changed AS tu
         JOIN """ + os.getenv("HISTORICAL_TABLE") + """ AS gd
         ON tu.trip_id = gd.trip_id 
             AND tu.start_date = gd.start_date 
             AND tu.stop_sequence = gd.stop_sequence 
-            AND tu.stop_id::bigint = gd.stop_id 
+            AND tu.stop_id = gd.stop_id::text 
+            """ + ("AND gd.start_date BETWEEN %(first_date)s AND %(last_date)s" if incremental or shard else "") + """
+        -- Latest weather observation made before the realtime row was last written. Rows written
+        -- before the weather table existed keep the weather columns they were stored with
+        LEFT JOIN LATERAL (
+            SELECT wo.weather_group, wo.weather_description, wo.temperature
+            FROM """ + WEATHER_TABLE + """ AS wo
+            WHERE wo.observed_at <= COALESCE(tu.updated_at, tu.created_at)
+                AND wo.observed_at > COALESCE(tu.updated_at, tu.created_at) - interval '""" + str(weather_max_age_minutes) + """ minutes'
+            ORDER BY wo.observed_at DESC
+            LIMIT 1
+        ) AS w ON true
         WHERE 
             NOT (
                 (EXTRACT(EPOCH FROM tu.arrival_time) = 0 AND EXTRACT(EPOCH FROM gd.arrival_time) <= 1000 * 60) AND
                 (EXTRACT(EPOCH FROM tu.departure_time) = 0 AND EXTRACT(EPOCH FROM gd.departure_time) <= 1000 * 60)
             )
-        ORDER BY tu.trip_id ASC, tu.stop_sequence ASC, tu.start_date ASC;
+        ORDER BY tu.trip_id ASC, tu.stop_sequence ASC, tu.start_date ASC
+        """ + ("" if shard else """ON CONFLICT (""" + ', '.join(KEY_COLUMNS) + """)
+        DO UPDATE SET
+            """ + ',\n            '.join(f"{column} = EXCLUDED.{column}" for column in value_columns) + """
+        WHERE
+            (""" + ', '.join(f"{table}.{column}" for column in value_columns) + """)
+            IS DISTINCT FROM
+            (""" + ', '.join(f"EXCLUDED.{column}" for column in value_columns) + """)
+        """) + """RETURNING route_id, stop_id, start_date
+        )""" + (""",
+        affected AS (
+            INSERT INTO rollup_keys SELECT DISTINCT route_id, stop_id, start_date FROM upserted
+        )""" if incremental else "") + """
+        SELECT (SELECT count(*) FROM changed), (SELECT count(*) FROM upserted);
         """
 
-        cur.execute(query)
+def local_connection(application_name='diff_times'):
+    options = connect_args(feed_settings).get('options', '')
+    return psycopg2.connect(
+        database=os.getenv("LOCAL_DB_NAME"),
+        user=os.getenv("LOCAL_DB_USERNAME"),
+        password=os.getenv("LOCAL_DB_PASSWORD"),
+        host="localhost",
+        port="5432",
+        application_name=application_name,
+        options=f"{options} -c statement_timeout={run_timeout_seconds * 1000}".strip()
+    )
+
+
+def shard_application_name():
+    # Application name of the shard connections of this process, for an interrupted rebuild to cancel them
+    return f'diff_times_shard_{os.getpid()}'
+
+
+def plan_shards(cur, shards):
+    # Contiguous start_date ranges holding about the same number of realtime rows, at most one per shard
+    cur.execute("SELECT start_date, count(*) FROM " + os.getenv("REALTIME_TABLE") + " GROUP BY start_date ORDER BY start_date")
+    counts = cur.fetchall()
+    total = sum(count for day, count in counts)
+    ranges = []
+    first_day = None
+    cumulative = 0
+    for day, count in counts:
+        first_day = first_day or day
+        cumulative += count
+        if cumulative >= total * (len(ranges) + 1) / shards:
+            ranges.append((first_day, day))
+            first_day = None
+    if first_day is not None:
+        ranges.append((first_day, counts[-1][0]))
+    return ranges
+
+
+def rebuild_shard(first_date, last_date, application_name):
+    # One shard of a parallel rebuild, run in a worker process on a connection of its own. An INSERT never
+    # gets a parallel plan, so each shard keeps one backend busy
+    start = time.perf_counter()
+    conn = local_connection(application_name)
+    try:
+        cur = conn.cursor()
+        cur.execute(diff_query(False, STAGING_TABLE, shard=True), {'first_date': first_date, 'last_date': last_date})
+        scanned, written = cur.fetchone()
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+    return first_date, last_date, scanned, written, time.perf_counter() - start
+
+
+def stop_shards(pool, conn, cur):
+    # Drops the queued shards and ends the worker processes, then cancels the queries of the shards that were
+    # running, whose backends would otherwise go on and hold the staging table
+    pool.terminate()
+    conn.rollback()
+    cur.execute("SELECT pg_cancel_backend(pid) FROM pg_stat_activity WHERE application_name = %s", (shard_application_name(),))
+    conn.commit()
+
+
+def rebuild_in_parallel(conn, cur, workers, dates):
+    # Full rebuild split by start_date over worker processes. The shards fill a staging table without indexes,
+    # which then gets the indexes of the live table and replaces it in one transaction, so readers never see
+    # a partly built table. Returns the realtime rows scanned and the diff rows written
+    with metrics.stage('staging'):
+        shards = plan_shards(cur, workers)
+        create_staging_table(cur, DIFF_TABLE, STAGING_TABLE, dates)
+        conn.commit()
+
+    try:
+        print(f'Computing {len(shards)} shards with {workers} workers...')
+        results = []
+        start = time.perf_counter()
+        with metrics.stage('shards'):
+            if shards:
+                # Fresh interpreters rather than forks, so no worker inherits the connection of this process
+                pool = multiprocessing.get_context('spawn').Pool(min(workers, len(shards)))
+                try:
+                    pending = [pool.apply_async(rebuild_shard, (first, last, shard_application_name())) for first, last in shards]
+                    results = [result.get() for result in pending]
+                except BaseException:
+                    # A failed shard or the run's alarm: stop the other shards instead of waiting for them
+                    stop_shards(pool, conn, cur)
+                    raise
+                pool.close()
+                pool.join()
+        elapsed = time.perf_counter() - start
+        for number, (first, last, scanned, written, seconds) in enumerate(results, 1):
+            print(f'Shard {number}: {first} to {last}, {scanned} realtime rows scanned, {written} rows written in {seconds:.2f} s.')
+        shard_seconds = sum(result[4] for result in results)
+        print(f'Shards done in {elapsed:.2f} s for {shard_seconds:.2f} s of work on their connections, '
+              f'a {shard_seconds / max(elapsed, 1e-9):.1f}x speedup over running them one after the other.')
+
+        with metrics.stage('indexes'):
+            index_names = build_indexes(cur, DIFF_TABLE, STAGING_TABLE)
+            cur.execute(f"ANALYZE {STAGING_TABLE}")
+            conn.commit()
+        with metrics.stage('swap'):
+            swap_tables(cur, DIFF_TABLE, STAGING_TABLE, index_names)
+            conn.commit()
+    except BaseException:
+        # The live table is untouched until the swap commits
+        conn.rollback()
+        cur.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE}")
         conn.commit()
+        raise
+
+    metrics.add('shards', len(shards))
+    return sum(result[2] for result in results), sum(result[3] for result in results)
+
+
+def release_lock(conn):
+    try:
+        conn.rollback()
+        cur = conn.cursor()
+        cur.execute("SELECT pg_advisory_unlock(hashtext(%s))", (lock_name,))
+        conn.commit()
+        cur.close()
+    except psycopg2.Error:
+        # A broken connection has lost its session, and the lock with it
+        pass
+
+
+def compute_diffs(full_rebuild, engine=None, full_rollups=False, parallel=None):
+    # Get current datetime in UTC
+    now = datetime.utcnow().replace(tzinfo=pytz.UTC)
+
+    # A connection from the pool of the pipeline runner, or a connection of its own
+    with metrics.stage('db_connect'):
+        if engine is not None:
+            conn = engine.raw_connection()
+        else:
+            conn = local_connection()
+    try:
+        count_round_trips(conn, metrics)
+
+        cur = conn.cursor()
+
+        # One run at a time for the feed: an incremental run during a rebuild would upsert into the table
+        # the swap is about to drop
+        with metrics.stage('lock'):
+            cur.execute("SELECT pg_advisory_lock(hashtext(%s))", (lock_name,))
+            conn.commit()
+        with metrics.stage('watermark'):
+            ensure_watermark_table(cur)
+            ensure_reloaded_dates_table(cur)
+            ensure_weather_table(cur)
+            ensure_rollup_table(cur)
+
+        # Typed keys, supporting indexes and the generated day type and hour of the schedule
+        with metrics.stage('migrations'):
+            run_migrations(conn, feed_settings['timezone'])
+
+        with metrics.stage('watermark'):
+            # Newest realtime change as of this run, which becomes the next high-water mark
+            cur.execute("SELECT max(GREATEST(created_at, updated_at)) FROM " + os.getenv("REALTIME_TABLE"))
+            high_water = cur.fetchone()[0]
+
+            watermark = get_watermark(cur, WATERMARK_NAME)
+
+            # Service dates whose schedule was reloaded since they were last diffed. Any run recomputes them, so
+            # their marks are cleared when it commits
+            reloads = get_reloaded_dates(cur)
+            reloaded_dates = [mark[0] for mark in reloads]
+        # A parallel run always rebuilds the whole table
+        parallel = parallel if parallel and parallel > 1 else None
+        incremental = not full_rebuild and not parallel and watermark is not None
+        if incremental:
+            since = watermark - watermark_overlap
+            print(f'Updating the diff times table with realtime rows changed since {since}'
+                  + (f' and those of {len(reloaded_dates)} reloaded service dates...' if reloaded_dates else '...'))
+        else:
+            # Rebuild from every realtime row
+            since = None
+            print('Rebuilding the diff times table from scratch' + (f' with {parallel} workers...' if parallel else '...'))
+
+        # Service dates touched by this run. Bounding the schedule side by them lets a partitioned
+        # historical table skip every partition outside the range, and a partitioned diff table gets a
+        # partition for each of their periods
+        with metrics.stage('partitions'):
+            cur.execute("SELECT DISTINCT start_date FROM " + os.getenv("REALTIME_TABLE")
+                        + (" WHERE GREATEST(created_at, updated_at) > %(since)s OR start_date = ANY(%(reloaded_dates)s::date[])" if incremental else ""),
+                        {'since': since, 'reloaded_dates': reloaded_dates})
+            dates = [row[0] for row in cur.fetchall()]
+            first_date, last_date = (min(dates), max(dates)) if dates else (None, None)
+            if dates and not parallel:
+                ensure_partitions_for_dates(cur, DIFF_TABLE, dates)
+                conn.commit()
+
+        if parallel:
+            # The new table is swapped in on its own commit, the rollups follow in the next transaction
+            scanned, changed = rebuild_in_parallel(conn, cur, parallel, dates)
+        else:
+            if not incremental:
+                # Delete old data
+                with metrics.stage('delete'):
+                    cur.execute(f"DELETE FROM {DIFF_TABLE};")
+
+            # Populate the table with the new data
+            with metrics.stage('diff_query'):
+                if incremental:
+                    create_rollup_keys(cur)
+                    if reloaded_dates:
+                        # Diffs of a reloaded date are recomputed from scratch: rows whose stop time left the schedule
+                        # go away, and their rollups are refreshed with the rest
+                        cur.execute(f"""
+                            WITH removed AS (
+                                DELETE FROM {DIFF_TABLE} WHERE start_date = ANY(%s::date[]) RETURNING route_id, stop_id, start_date
+                            )
+                            INSERT INTO rollup_keys SELECT DISTINCT route_id, stop_id, start_date FROM removed""", (reloaded_dates,))
+                cur.execute(diff_query(incremental), {'since': since, 'first_date': first_date, 'last_date': last_date,
+                                                      'reloaded_dates': reloaded_dates})
+                scanned, changed = cur.fetchone()
+        metrics.add('rows_scanned', scanned)
+        metrics.add('rows_changed', changed)
+
+        # Rollups in the same transaction as the diffs, so they never disagree
+        with metrics.stage('rollups'):
+            if incremental and not full_rollups:
+                rollup_rows = refresh_rollups(cur)
+            else:
+                rollup_rows = rebuild_rollups(cur)
+        metrics.add('rollup_rows', rollup_rows)
+
+        with metrics.stage('commit'):
+            if high_water is not None:
+                set_watermark(cur, WATERMARK_NAME, high_water)
+            clear_reloaded_dates(cur, reloads)
+            conn.commit()
         cur.close()
+    finally:
+        # The lock belongs to the session, which a pooled connection outlives
+        release_lock(conn)
+        # Back to the pool, or closed, whatever happened to the run
         conn.close()
 
-        print('Diff times table populated!')
-        print('Current Datetime:', now)
+    print(f'Diff times table populated! {scanned} realtime rows scanned, {changed} rows changed, {rollup_rows} rollup rows written.')
+    print('Current Datetime:', now)
+    return 'ok'
 
+
+def populate_table(full_rebuild=False, engine=None, full_rollups=False, parallel=None):
+    # Signals can only be handled by the main thread. When the pipeline runner runs this stage in a worker
+    # thread, the runner's per-stage timeout applies instead, and the statement_timeout of its connections
+    # stops the query that is running
+    use_alarm = threading.current_thread() is threading.main_thread()
+    if use_alarm:
+        # Set the timeout signal handler
+        signal.signal(signal.SIGALRM, timeout_handler)
+        signal.alarm(run_timeout_seconds)  # Set the alarm
+
+    # A run that does not return a status, for example on an exception, is reported as an error
+    status = 'error'
+    try:
+        with profiled('diff_times'):
+            status = compute_diffs(full_rebuild, engine, full_rollups, parallel)
     except TimeoutError as e:
+        status = 'timeout_error'
         print(f"Timeout error: {e}")
     finally:
-        signal.alarm(0)  # Cancel the alarm
+        if use_alarm:
+            signal.alarm(0)  # Cancel the alarm
+        metrics.finish(status)
+    return status
 
 if __name__ == "__main__":
-    populate_table()
+    parser = argparse.ArgumentParser(description='Compute arrival and departure delays into trip_updates_with_diffs.')
+    parser.add_argument('--full-rebuild', action='store_true', help='Delete the table and recompute it from every realtime row, e.g. after a schema change.')
+    parser.add_argument('--rebuild-rollups', action='store_true', help='Recompute every rollup instead of those of the changed rows, e.g. after changing the histogram buckets.')
+    parser.add_argument('--parallel', type=int, metavar='N', help='Rebuild the whole table with N worker processes, each computing a range of service dates on its own connection.')
+    args = parser.parse_args()
+    populate_table(full_rebuild=args.full_rebuild, full_rollups=args.rebuild_rollups, parallel=args.parallel)
@@ -0,0 +1,223 @@
+import os
+import sys
+import gzip
+import time
+import argparse
+import psycopg2
+from datetime import date, datetime
+from dotenv import load_dotenv
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib.watermarks import ensure_watermark_table, get_watermark, set_watermark
+from lib.rollups import ROLLUP_TABLE
+from lib.feeds import current_feed, connect_args
+
+# Load environment variables
+load_dotenv()
+
+# Tables that can be exported, by name on the command line
+SOURCES = {'diffs': 'trip_updates_with_diffs', 'rollups': ROLLUP_TABLE}
+
+# Rows fetched from the server-side cursor at a time, and written as one Parquet row group
+PARQUET_BATCH_ROWS = 50000
+
+
+def export_query(source, first_date, last_date, since):
+    # Rows of the service dates between first_date and last_date, and when since is given, only the rows changed
+    # after it. Rollups have no change time, so every rollup of a service date with a changed diff row is exported
+    conditions = []
+    if first_date is not None:
+        conditions.append("start_date >= %(first_date)s")
+    if last_date is not None:
+        conditions.append("start_date <= %(last_date)s")
+    if since is not None:
+        if source == 'diffs':
+            conditions.append("GREATEST(created_at, updated_at) > %(since)s")
+        else:
+            conditions.append("""start_date IN (
+                SELECT DISTINCT start_date FROM trip_updates_with_diffs WHERE GREATEST(created_at, updated_at) > %(since)s)""")
+    return f"SELECT * FROM {SOURCES[source]}" + (" WHERE " + " AND ".join(conditions) if conditions else "")
+
+
+def record_end(data, quotes):
+    # Offset just after the first newline of data that ends a CSV record, given the number of quote characters
+    # already seen in the file. A newline inside a quoted field follows an odd number of quotes
+    position = data.find(b'\n')
+    while position != -1:
+        if (quotes + data.count(b'"', 0, position)) % 2 == 0:
+            return position + 1
+        position = data.find(b'\n', position + 1)
+    return None
+
+
+class ChunkedFiles:
+    # Numbered output files of at most about max_bytes each on disk. A new file is only started on a record
+    # boundary, so every file can be read on its own
+    def __init__(self, output_dir, prefix, extension, max_bytes):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.extension = extension
+        self.max_bytes = max_bytes
+        self.paths = []
+
+    def next_path(self):
+        path = os.path.join(self.output_dir, f'{self.prefix}-{len(self.paths) + 1:04d}.{self.extension}')
+        self.paths.append(path)
+        return path
+
+
+class GzipCsvWriter(ChunkedFiles):
+    # File-like target of COPY TO STDOUT. COPY writes the CSV in chunks that do not follow rows, so a chunk
+    # that crosses the size limit is split at its first record boundary
+    def __init__(self, output_dir, prefix, max_bytes, header):
+        super().__init__(output_dir, prefix, 'csv.gz', max_bytes)
+        self.header = header
+        self.raw = self.file = None
+
+    def open(self):
+        self.raw = open(self.next_path(), 'wb')
+        self.file = gzip.GzipFile(fileobj=self.raw, mode='wb')
+        self.file.write(self.header)
+        self.quotes = 0
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.raw.close()
+            self.raw = self.file = None
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        while data:
+            if self.file is None:
+                self.open()
+            # Size of the compressed file so far, up to what the compressor still buffers
+            if self.raw.tell() < self.max_bytes:
+                cut = None
+            else:
+                cut = record_end(data, self.quotes)
+            if cut is None:
+                self.file.write(data)
+                self.quotes += data.count(b'"')
+                return
+            self.file.write(data[:cut])
+            self.close()
+            data = data[cut:]
+
+
+def export_csv(conn, query, writer):
+    with conn.cursor() as cur:
+        cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv)", writer)
+        rows = cur.rowcount
+    writer.close()
+    return rows
+
+
+def arrow_type(pa, type_code):
+    # Arrow type of a PostgreSQL column, by type OID. Unknown types are exported as text
+    return {
+        16: pa.bool_(), 20: pa.int64(), 21: pa.int16(), 23: pa.int32(), 700: pa.float32(), 701: pa.float64(),
+        1082: pa.date32(), 1114: pa.timestamp('us'), 1184: pa.timestamp('us', tz='UTC'),
+        1007: pa.list_(pa.int32()), 1016: pa.list_(pa.int64()),
+    }.get(type_code, pa.string())
+
+
+def export_parquet(conn, query, files, compression):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit('Parquet export needs pyarrow: pip install pyarrow')
+
+    rows = 0
+    writer = None
+    # Named cursor: the rows stay on the server and come in batches of PARQUET_BATCH_ROWS
+    with conn.cursor(name='export_diffs') as cur:
+        cur.itersize = PARQUET_BATCH_ROWS
+        cur.execute(query)
+        batch = cur.fetchmany(PARQUET_BATCH_ROWS)
+        schema = pa.schema([(column.name, arrow_type(pa, column.type_code)) for column in cur.description])
+        to_text = [index for index, field in enumerate(schema) if field.type == pa.string()]
+        while batch:
+            columns = [list(values) for values in zip(*batch)]
+            for index in to_text:
+                columns[index] = [None if value is None else str(value) for value in columns[index]]
+            table = pa.Table.from_arrays([pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+                                         schema=schema)
+            if writer is None:
+                path = files.next_path()
+                writer = pq.ParquetWriter(path, schema, compression=compression)
+            writer.write_table(table)
+            rows += len(batch)
+            # Row groups are flushed as they are written, so the file size is known between batches
+            if os.path.getsize(path) >= files.max_bytes:
+                writer.close()
+                writer = None
+            batch = cur.fetchmany(PARQUET_BATCH_ROWS)
+    if writer is not None:
+        writer.close()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export trip_updates_with_diffs or its rollups to size-bounded gzip CSV or Parquet files, streaming from the database.')
+    parser.add_argument('output_dir', help='Directory the files are written to.')
+    parser.add_argument('--source', choices=list(SOURCES), default='diffs', help='diffs: trip_updates_with_diffs, rollups: trip_delay_rollups.')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv', help='gzip CSV, or Parquet (needs pyarrow).')
+    parser.add_argument('--from', dest='first_date', type=date.fromisoformat, help='First service date exported, YYYY-MM-DD.')
+    parser.add_argument('--to', dest='last_date', type=date.fromisoformat, help='Last service date exported, YYYY-MM-DD.')
+    parser.add_argument('--since-last-export', action='store_true', help='Only export rows changed since the last export of this source that used this option.')
+    parser.add_argument('--max-file-mb', type=float, default=100, help='Files are closed once they reach about this size.')
+    parser.add_argument('--parquet-compression', default='zstd', help='Parquet compression codec.')
+    parser.add_argument('--db-url', default=os.getenv("LOCAL_DB_URL"), help='Connection string, defaults to LOCAL_DB_URL.')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    watermark_name = f'export:{args.source}'
+    start = time.perf_counter()
+
+    # Tables of the feed selected with FEED
+    conn = psycopg2.connect(args.db_url, **connect_args(current_feed()))
+    # One snapshot for the high-water mark and the exported rows, so rows committed during the export
+    # are left for the next one. Timestamps are written in UTC
+    conn.set_session(isolation_level='REPEATABLE READ')
+    cur = conn.cursor()
+    cur.execute("SET TIME ZONE 'UTC'")
+    since = high_water = None
+    if args.since_last_export:
+        ensure_watermark_table(cur)
+        since = get_watermark(cur, watermark_name)
+        cur.execute("SELECT max(GREATEST(created_at, updated_at)) FROM trip_updates_with_diffs")
+        high_water = cur.fetchone()[0]
+        print(f'Exporting {args.source} changed since {since or "the beginning"}...')
+
+    query = cur.mogrify(export_query(args.source, args.first_date, args.last_date, since),
+                        {'first_date': args.first_date, 'last_date': args.last_date, 'since': since}).decode()
+    prefix = f"{args.source}-{datetime.now().strftime('%Y%m%dT%H%M%S')}"
+    max_bytes = int(args.max_file_mb * 1024 * 1024)
+
+    if args.format == 'csv':
+        # Header line repeated at the top of every file
+        cur.execute(f"SELECT * FROM ({query}) AS export LIMIT 0")
+        header = (','.join(column.name for column in cur.description) + '\n').encode()
+        files = GzipCsvWriter(args.output_dir, prefix, max_bytes, header)
+        rows = export_csv(conn, query, files)
+    else:
+        files = ChunkedFiles(args.output_dir, prefix, 'parquet', max_bytes)
+        rows = export_parquet(conn, query, files, args.parquet_compression)
+
+    # The mark only moves once every file is written
+    if args.since_last_export and high_water is not None:
+        set_watermark(cur, watermark_name, high_water)
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    seconds = time.perf_counter() - start
+    print(f'Exported {rows} rows to {len(files.paths)} files in {seconds:.2f} s:')
+    for path in files.paths:
+        print(f'  {path} ({os.path.getsize(path) / 1024 / 1024:.1f} MB)')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import os
+import sys
+import time
+import signal
+import argparse
+import threading
+import subprocess
+from pathlib import Path
+from datetime import datetime
+from dotenv import load_dotenv
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib.feeds import load_feeds
+
+# Load environment variables
+load_dotenv()
+
+# Get the absolute path to the directory of this script
+script_dir = Path(os.path.dirname(os.path.abspath(__file__)))
+
+# Each feed is polled by its own long-lived realtime extractor daemon with FEED set, so the feeds share no
+# state, keep their database pool and HTTPS connection across polls, and a slow or stuck agency only holds its
+# own process. The extractor takes the per-feed lock itself, and backs off from a feed answering 503
+EXTRACTOR = script_dir / "realtime_extractor.py"
+
+# Exit code of a run that found its feed unavailable (503), see realtime_extractor.EXIT_UNAVAILABLE
+EXIT_UNAVAILABLE = 3
+
+
+class FeedProcess:
+    # Supervision state of one feed: its extractor process, when it may be started again, the wait before that
+    # after a quick exit, and the outcome of its last process
+    def __init__(self, name):
+        self.name = name
+        self.process = None
+        self.started = None
+        self.restart_at = time.monotonic()
+        self.restart_delay = 0
+        self.starts = 0
+        self.last_status = None
+        self.last_seconds = None
+
+
+def exit_status(returncode):
+    if returncode == 0:
+        return 'ok'
+    if returncode == EXIT_UNAVAILABLE:
+        return 'unavailable'
+    if returncode < 0:
+        return f'signal {-returncode}'
+    return f'exit {returncode}'
+
+
+def reap(feed):
+    # Records the outcome of the feed's process once it has exited
+    feed.last_status, feed.last_seconds = exit_status(feed.process.returncode), time.monotonic() - feed.started
+    feed.process = None
+
+
+def schedule_restart(feed, interval, max_backoff):
+    # A daemon that ran for at least max_backoff seconds is started again after one interval. One exiting
+    # sooner, for example on a bad configuration or a database that is down, waits twice as long as the
+    # previous time, up to max_backoff seconds
+    if feed.last_seconds >= max_backoff:
+        feed.restart_delay = interval
+    else:
+        feed.restart_delay = min(max(feed.restart_delay * 2, interval), max_backoff)
+    feed.restart_at = time.monotonic() + feed.restart_delay
+
+
+def stop_processes(feeds, timeout):
+    # SIGTERM ends each daemon once its current poll is written. Those still running after the timeout are killed
+    running = [feed for feed in feeds if feed.process is not None]
+    for feed in running:
+        feed.process.terminate()
+    deadline = time.monotonic() + timeout
+    for feed in running:
+        try:
+            feed.process.wait(max(deadline - time.monotonic(), 0))
+        except subprocess.TimeoutExpired:
+            print(f"{feed.name}: still running after {timeout:.0f} s, killing it.")
+            feed.process.kill()
+            feed.process.wait()
+        reap(feed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run one realtime extractor daemon per feed of the registry, and restart those that exit.')
+    parser.add_argument('--feeds', nargs='+', help='Names of the feeds to poll, all feeds of the registry by default.')
+    parser.add_argument('--interval', type=float, default=float(os.getenv("REALTIME_POLL_INTERVAL", 15)), help='Seconds between polls of a feed.')
+    parser.add_argument('--jitter', type=float, default=float(os.getenv("REALTIME_POLL_JITTER", 1)), help='Maximum random delay in seconds added to each poll.')
+    parser.add_argument('--max-backoff', type=float, default=float(os.getenv("FEED_MAX_BACKOFF", 600)),
+                        help='Longest wait in seconds between polls of an unavailable feed, and before restarting a daemon that keeps exiting.')
+    parser.add_argument('--stop-timeout', type=float, default=float(os.getenv("FEED_STOP_TIMEOUT", 120)), help='Seconds the daemons get to stop on shutdown before they are killed.')
+    parser.add_argument('--once', action='store_true', help='Poll every feed once, in parallel, and exit.')
+    parser.add_argument('extractor_args', nargs=argparse.REMAINDER, help='Arguments passed to each extractor, after --.')
+    args = parser.parse_args()
+    extractor_args = [arg for arg in args.extractor_args if arg != '--']
+
+    names = [feed['name'] for feed in load_feeds()]
+    if args.feeds:
+        unknown = set(args.feeds) - set(names)
+        if unknown:
+            parser.error(f"Unknown feeds: {', '.join(sorted(unknown))}. Feeds: {', '.join(names)}")
+        names = [name for name in names if name in args.feeds]
+    feeds = [FeedProcess(name) for name in names]
+    print(f"Polling {len(feeds)} feeds: {', '.join(names)}")
+
+    command = [sys.executable, str(EXTRACTOR)]
+    if not args.once:
+        command += ['--daemon', '--interval', str(args.interval), '--jitter', str(args.jitter), '--max-backoff', str(args.max_backoff)]
+    command += extractor_args
+
+    # Stop the daemons on SIGTERM or Ctrl+C, letting each finish its current poll
+    stop = threading.Event()
+
+    def shutdown_handler(signum, frame):
+        print(f"Received signal {signum}. Stopping the extractors after their current poll.")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown_handler)
+    signal.signal(signal.SIGINT, shutdown_handler)
+
+    try:
+        while not stop.is_set():
+            for feed in feeds:
+                if feed.process is not None and feed.process.poll() is not None:
+                    reap(feed)
+                    if not args.once:
+                        schedule_restart(feed, args.interval, args.max_backoff)
+                    restart = f", restarting in {feed.restart_delay:.0f} s" if not args.once else ''
+                    print(f"{datetime.now():%Y-%m-%d %H:%M:%S} {feed.name}: {feed.last_status} after {feed.last_seconds:.2f} s{restart}")
+                if feed.process is None and feed.restart_at <= time.monotonic() and not (args.once and feed.starts):
+                    feed.process = subprocess.Popen(command, env={**os.environ, 'FEED': feed.name})
+                    feed.started = time.monotonic()
+                    feed.starts += 1
+            if args.once and all(feed.starts and feed.process is None for feed in feeds):
+                break
+            stop.wait(1)
+    finally:
+        stop_processes(feeds, args.stop_timeout)
+
+    for feed in feeds:
+        last = f"{feed.last_status} after {feed.last_seconds:.2f} s" if feed.starts else 'never started'
+        print(f"{feed.name}: {feed.starts} starts, last {last}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,40 @@
 import os
+import sys
+import time
+import argparse
 import requests
 import pandas as pd
 import zipfile
-import io
+import json
+import hashlib
+import functools
 import pytz
+import resource
+import numpy as np
+import psycopg2
+from pathlib import Path
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib.pg_copy import copy_rows
+from lib.partitions import ensure_partitions_for_dates
+from lib.metrics import RunMetrics, count_round_trips, profiled
+from lib.schedule_index import service_day_number, write_schedule_index
+from lib.feeds import current_feed, connect_args, is_default_feed
+from lib.migrations import run_migrations
+from lib.watermarks import ensure_reloaded_dates_table, mark_reloaded_dates
+from lib.table_swap import create_staging_table, build_indexes, swap_tables
 from sqlalchemy import create_engine, text, Table, MetaData
 from sqlalchemy.orm import sessionmaker
 
 # Load environment variables
 load_dotenv()
 
+# Feed of the registry this process loads, selected with FEED
+feed_settings = current_feed()
+
 # URL to download the data
-url = "https://sudbury.tmix.se/gtfs/gtfs.zip"
+url = feed_settings['static_url']
 
 # Database connection string
 db_string = os.getenv("LOCAL_DB_URL")
@@ -23,79 +45,564 @@ table_name = os.getenv("HISTORICAL_TABLE")
 # Chunk size
 chunk_size = 5000  # Adjust as necessary depending on your server's resources
 
-def parse_date_and_time_vectorized(dates, times):
-    sudbury_tz = pytz.timezone('America/Toronto')  # Sudbury is in the Toronto time zone
-    hours, minutes, seconds = zip(*[map(int, time.split(':')) for time in times])
-    hours = pd.Series(hours)
-    dates = pd.to_datetime(dates, format="%Y%m%d")
-    dates += pd.to_timedelta((hours // 24).astype(int), unit='d')
-    hours %= 24
-    timestamps = pd.to_datetime(dates.astype(str) + ' ' + hours.astype(str) + ':' + pd.Series(minutes).astype(str) + ':' + pd.Series(seconds).astype(str))
-    # Convert to Sudbury's time zone first
-    timestamps = timestamps.dt.tz_localize(sudbury_tz)
-    # Then convert to UTC
-    return timestamps.dt.tz_convert('UTC')
-
-def main():
-    # Create engine and session
-    engine = create_engine(db_string)
+# Get the absolute path to the directory of this script
+script_dir = Path(os.path.dirname(os.path.abspath(__file__)))
+
+# Local copy of the static feed and the state of the last incremental refresh, one folder per feed
+cache_dir = Path(os.getenv("GTFS_CACHE_DIR", script_dir / "cache"))
+if not is_default_feed(feed_settings):
+    cache_dir = cache_dir / feed_settings['name']
+cached_feed_file = cache_dir / "gtfs.zip"
+refresh_state_file = cache_dir / "gtfs_state.json"
+
+# Approximate memory budget of one batch of expanded rows, in MB
+memory_cap_mb = int(os.getenv("HISTORICAL_MEMORY_CAP_MB", 256))
+
+# Stage timings and counters of each run
+metrics = RunMetrics('historical_extractor', feed_settings['name'])
+
+# Directory of the schedule indexes read by the realtime extractor (one folder per feed), and the days ahead they cover
+schedule_index_dir = os.getenv("SCHEDULE_INDEX_DIR")
+schedule_index_days = int(os.getenv("SCHEDULE_INDEX_DAYS", 14))
+
+# Columns of the historical table, in the order they are loaded
+HISTORICAL_COLUMNS = ['trip_id', 'start_date', 'stop_sequence', 'stop_id', 'route_id', 'stop_name', 'route_long_name', 'arrival_time', 'departure_time', 'geo_coordinates']
+
+# Time zone of the feed's schedule (America/Toronto for Sudbury)
+SCHEDULE_TIMEZONE = feed_settings['timezone']
+
+
+@functools.lru_cache(maxsize=4096)
+def service_day_origin(service_date, tz_name=SCHEDULE_TIMEZONE):
+    # GTFS times count from noon minus 12 hours of the service day in local time, which is midnight except on
+    # DST change days. Returned as UTC epoch seconds, computed once per service date
+    noon = pytz.timezone(tz_name).localize(datetime.strptime(str(service_date), '%Y%m%d').replace(hour=12))
+    return int(noon.timestamp()) - 12 * 3600
+
+
+def gtfs_time_seconds(times):
+    # "H:MM:SS" or "HH:MM:SS" strings (hours can go past 24) to seconds, -1 where the time is missing.
+    # The strings are zero-padded to "HHH:MM:SS" and read as a matrix of digit bytes
+    text = pd.Series(times, dtype=object).to_numpy()
+    missing = pd.isna(text)
+    text = np.char.zfill(np.char.strip(np.where(missing, '0:00:00', text).astype(str)), 9)
+    if text.dtype.itemsize // 4 > 9:
+        raise ValueError('GTFS times must be H:MM:SS or HH:MM:SS')
+    chars = text.astype('S9').view(np.uint8).reshape(-1, 9).astype(np.int64) - ord('0')
+    digits = chars[:, [0, 1, 2, 4, 5, 7, 8]]
+    if len(chars) and ((digits < 0) | (digits > 9)).any() | (chars[:, [3, 6]] != ord(':') - ord('0')).any():
+        raise ValueError('GTFS times must be H:MM:SS or HH:MM:SS')
+    seconds = (digits[:, 0] * 100 + digits[:, 1] * 10 + digits[:, 2]) * 3600 + (digits[:, 3] * 10 + digits[:, 4]) * 60 + digits[:, 5] * 10 + digits[:, 6]
+    return np.where(missing, -1, seconds)
+
+
+def service_epochs(dates, times, tz_name=SCHEDULE_TIMEZONE):
+    # UTC epoch seconds (int64) of GTFS times on their YYYYMMDD service dates, -1 where the time is missing.
+    # Categorical times, as read by read_stop_times, are parsed once per distinct string
+    if isinstance(times, pd.Categorical) or isinstance(getattr(times, 'dtype', None), pd.CategoricalDtype):
+        times = pd.Categorical(times)
+        seconds = np.append(gtfs_time_seconds(times.categories), -1)[times.codes]
+    else:
+        seconds = gtfs_time_seconds(times)
+    unique_dates, date_codes = np.unique(np.asarray(dates).astype(np.int64), return_inverse=True)
+    origins = np.array([service_day_origin(int(service_date), tz_name) for service_date in unique_dates], dtype=np.int64)
+    return np.where(seconds >= 0, origins[date_codes.reshape(-1)] + seconds, -1)
+
+
+def parse_date_and_time_vectorized(dates, times, tz_name=SCHEDULE_TIMEZONE):
+    # UTC timestamps of GTFS times on their service dates, NaT where the time is missing
+    epochs = service_epochs(dates, times, tz_name)
+    nanoseconds = np.where(epochs >= 0, epochs * 1_000_000_000, np.iinfo(np.int64).min)
+    return pd.Series(pd.DatetimeIndex(nanoseconds.view('datetime64[ns]')).tz_localize('UTC'))
+
+def load_dimensions(zf, dates=None):
+    # Trips, with their route and service replaced by integer positions into the other lookups
+    trips = pd.read_csv(zf.open('trips.txt'), usecols=['trip_id', 'route_id', 'service_id'], dtype=str)
+    routes = pd.read_csv(zf.open('routes.txt'), usecols=['route_id', 'route_long_name'], dtype=str)
+    stops = pd.read_csv(zf.open('stops.txt'), usecols=['stop_id', 'stop_name', 'stop_lat', 'stop_lon'], dtype={'stop_id': str, 'stop_name': str})
+    calendar_dates = pd.read_csv(zf.open('calendar_dates.txt'), usecols=['service_id', 'date'], dtype={'service_id': str, 'date': np.int64})
+    if dates is not None:
+        calendar_dates = calendar_dates[calendar_dates['date'].isin(dates)]
+
+    # Service dates as one flat array sorted by service, addressed through per-service offsets and counts
+    service_index = pd.Index(calendar_dates['service_id'].unique())
+    service_codes = service_index.get_indexer(calendar_dates['service_id'])
+    order = np.argsort(service_codes, kind='stable')
+    service_counts = np.bincount(service_codes, minlength=len(service_index))
+
+    routes_index = pd.Index(routes['route_id'])
+    trip_route = routes_index.get_indexer(trips['route_id'])
+    route_hashes = pd.util.hash_pandas_object(routes, index=False).to_numpy()
+    return {
+        'trip_index': pd.Index(trips['trip_id']),
+        'trip_ids': pd.Categorical(trips['trip_id']),
+        'trip_route': trip_route,
+        'trip_service': service_index.get_indexer(trips['service_id']),
+        'service_dates': calendar_dates['date'].to_numpy()[order],
+        'service_offsets': np.cumsum(service_counts) - service_counts,
+        'service_counts': service_counts,
+        'stop_index': pd.Index(stops['stop_id']),
+        'stop_ids': pd.Categorical(stops['stop_id']),
+        'stop_names': pd.Categorical(stops['stop_name']),
+        'geo_coordinates': pd.Categorical(stops['stop_lat'].astype(str) + ', ' + stops['stop_lon'].astype(str)),
+        'route_ids': pd.Categorical(routes['route_id']),
+        'route_long_names': pd.Categorical(routes['route_long_name']),
+        # Hash of every attribute a stop time gets from its trip (route included) and from its stop, so that a
+        # renamed stop or route only changes the dates it runs on
+        'trip_hashes': pd.util.hash_pandas_object(pd.DataFrame({
+            'trip': pd.util.hash_pandas_object(trips, index=False).to_numpy(),
+            'route': np.where(trip_route >= 0, route_hashes[trip_route], np.uint64(0)),
+        }), index=False).to_numpy(),
+        'stop_hashes': pd.util.hash_pandas_object(stops, index=False).to_numpy(),
+    }
+
+
+def expand_service_dates(chunk, dims, trip_pos, stop_pos, route_pos, service):
+    # One output row per (stop time, service date), built with integer positions instead of merges
+    counts = dims['service_counts'][service]
+    rows = np.repeat(np.arange(len(chunk)), counts)
+    within = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    dates = dims['service_dates'][np.repeat(dims['service_offsets'][service], counts) + within]
+
+    df = pd.DataFrame({
+        'trip_id': dims['trip_ids'].take(trip_pos[rows]),
+        'start_date': dates,
+        'stop_sequence': chunk['stop_sequence'].to_numpy()[rows],
+        'stop_id': dims['stop_ids'].take(stop_pos[rows]),
+        'route_id': dims['route_ids'].take(route_pos[rows]),
+        'stop_name': dims['stop_names'].take(stop_pos[rows]),
+        'route_long_name': dims['route_long_names'].take(route_pos[rows]),
+        'arrival_time': chunk['arrival_time'].array.take(rows),
+        'departure_time': chunk['departure_time'].array.take(rows),
+        'geo_coordinates': dims['geo_coordinates'].take(stop_pos[rows]),
+    })
+
+    # Convert arrival_time and departure_time to timestamp
+    df['arrival_time'] = parse_date_and_time_vectorized(dates, df['arrival_time'].array)
+    df['departure_time'] = parse_date_and_time_vectorized(dates, df['departure_time'].array)
+
+    # Convert start_date to a date
+    df['start_date'] = pd.to_datetime(df['start_date'].astype(str), format="%Y%m%d").dt.date
+    return df
+
+
+def read_stop_times(zf):
+    # Only the needed stop_times columns, with explicit dtypes
+    return pd.read_csv(
+        zf.open('stop_times.txt'),
+        usecols=['trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'],
+        dtype={'trip_id': str, 'arrival_time': 'category', 'departure_time': 'category', 'stop_id': str, 'stop_sequence': np.int32},
+        chunksize=chunk_size,
+    )
+
+
+def join_dimensions(chunk, dims):
+    # Positions of each stop time in the trip, stop, route and service lookups, with the same inner join
+    # semantics as merging with trips, calendar_dates, stops and routes
+    trip_pos = dims['trip_index'].get_indexer(chunk['trip_id'])
+    stop_pos = dims['stop_index'].get_indexer(chunk['stop_id'])
+    route_pos = np.where(trip_pos >= 0, dims['trip_route'][trip_pos], -1)
+    service = np.where(trip_pos >= 0, dims['trip_service'][trip_pos], -1)
+    keep = (trip_pos >= 0) & (stop_pos >= 0) & (route_pos >= 0) & (service >= 0)
+    return chunk[keep].reset_index(drop=True), trip_pos[keep], stop_pos[keep], route_pos[keep], service[keep]
+
+
+def iter_schedule_batches(zf, memory_cap_mb, dates=None):
+    # Dimension lookups are built once for the whole feed
+    dims = load_dimensions(zf, dates)
+    stop_times = read_stop_times(zf)
+
+    # Rough size of one expanded row, refined from every batch produced
+    row_bytes = 400
+    for chunk in stop_times:
+        chunk, trip_pos, stop_pos, route_pos, service = join_dimensions(chunk, dims)
+
+        # Split the chunk so that no expanded batch goes over the memory cap
+        expanded = np.cumsum(dims['service_counts'][service])
+        start = 0
+        while start < len(chunk):
+            max_rows = max(1, int(memory_cap_mb * 1024 * 1024 / row_bytes))
+            done = expanded[start - 1] if start else 0
+            end = max(start + 1, int(np.searchsorted(expanded, done + max_rows, side='right')))
+            part = slice(start, end)
+            df = expand_service_dates(chunk.iloc[part].reset_index(drop=True), dims, trip_pos[part], stop_pos[part], route_pos[part], service[part])
+            if len(df):
+                # Parsing the times needs a few temporary copies of each row on top of its final size
+                row_bytes = max(row_bytes, 4 * int(df.memory_usage(deep=True).sum() / len(df)))
+                yield df
+            start = end
+
+
+def build_schedule_index(zf, directory, days):
+    # Scheduled epochs of every stop time from yesterday to `days` days ahead, keyed by trip, service date
+    # and stop sequence, for the realtime extractor to compute delays at ingest
+    today = datetime.now(pytz.timezone(SCHEDULE_TIMEZONE)).date()
+    window = [int((today + timedelta(days=offset)).strftime('%Y%m%d')) for offset in range(-1, days + 1)]
+    dims = load_dimensions(zf, window)
+
+    parts = []
+    for chunk in read_stop_times(zf):
+        chunk, trip_pos, stop_pos, route_pos, service = join_dimensions(chunk, dims)
+        counts = dims['service_counts'][service]
+        rows = np.repeat(np.arange(len(chunk)), counts)
+        within = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        dates = dims['service_dates'][np.repeat(dims['service_offsets'][service], counts) + within]
+        unique_dates, date_codes = np.unique(dates, return_inverse=True)
+        parts.append({
+            'trip_codes': trip_pos[rows],
+            'days': np.array([service_day_number(date) for date in unique_dates], dtype=np.int64)[date_codes.reshape(-1)],
+            'stop_sequences': chunk['stop_sequence'].to_numpy()[rows],
+            'arrivals': service_epochs(dates, chunk['arrival_time'].array.take(rows)),
+            'departures': service_epochs(dates, chunk['departure_time'].array.take(rows)),
+            'route_codes': route_pos[rows],
+            'stop_codes': stop_pos[rows],
+        })
+
+    columns = {name: np.concatenate([part[name] for part in parts]) if parts else np.array([], dtype=np.int64) for name in
+               ('trip_codes', 'days', 'stop_sequences', 'arrivals', 'departures', 'route_codes', 'stop_codes')}
+    vocabulary = {
+        'trip_ids': list(dims['trip_index']),
+        'route_ids': list(dims['route_ids']),
+        'stop_ids': list(dims['stop_index']),
+        'first_date': str(window[0]),
+        'last_date': str(window[-1]),
+        'built_at': datetime.now(pytz.UTC).isoformat(),
+    }
+    return write_schedule_index(directory, vocabulary, **columns)
+
+
+def date_fingerprints(zf):
+    # Sum of the row hashes of every stop time of each service, each combined with the hashes of its trip and
+    # stop, so that any change to a trip, stop or route shows up in the dates it runs on and only those
+    dims = load_dimensions(zf)
+    service_hashes = np.zeros(len(dims['service_counts']), dtype=np.uint64)
+    for chunk in read_stop_times(zf):
+        trip_pos = dims['trip_index'].get_indexer(chunk['trip_id'])
+        stop_pos = dims['stop_index'].get_indexer(chunk['stop_id'])
+        service = np.where(trip_pos >= 0, dims['trip_service'][trip_pos], -1)
+        keep = service >= 0
+        row_hashes = pd.util.hash_pandas_object(pd.DataFrame({
+            'stop_time': pd.util.hash_pandas_object(chunk[keep].astype(str), index=False).to_numpy(),
+            'trip': dims['trip_hashes'][trip_pos[keep]],
+            'stop': np.where(stop_pos[keep] >= 0, dims['stop_hashes'][stop_pos[keep]], np.uint64(0)),
+        }), index=False).to_numpy()
+        np.add.at(service_hashes, service[keep], row_hashes)
+
+    # A date's fingerprint sums the services running on it
+    dates, inverse = np.unique(dims['service_dates'], return_inverse=True)
+    date_hashes = np.zeros(len(dates), dtype=np.uint64)
+    services = np.repeat(np.arange(len(dims['service_counts'])), dims['service_counts'])
+    np.add.at(date_hashes, inverse, service_hashes[services])
+    return {str(date): f'{date_hash:016x}' for date, date_hash in zip(dates, date_hashes)}
+
+
+def load_refresh_state():
+    if refresh_state_file.is_file():
+        with open(refresh_state_file, 'r') as f:
+            return json.load(f)
+    else:
+        return {'etag': None, 'last_modified': None, 'sha256': None, 'dates': {}}
+
+
+def save_refresh_state(state):
+    temporary_file = refresh_state_file.with_name(refresh_state_file.name + '.tmp')
+    with open(temporary_file, 'w') as f:
+        json.dump(state, f)
+    os.replace(temporary_file, refresh_state_file)
+
+
+def download_static_feed(state=None):
+    # Conditional GET when the validators of the last download are known
+    headers = {}
+    if state is not None:
+        if state.get('etag'):
+            headers['If-None-Match'] = state['etag']
+        if state.get('last_modified'):
+            headers['If-Modified-Since'] = state['last_modified']
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    with requests.get(url, headers=headers, stream=True) as response:
+        if response.status_code == 304:
+            if cached_feed_file.is_file():
+                return None
+            # The cached zip is gone: the validators are of no use, download it again in full
+            return download_static_feed()
+        response.raise_for_status()
+
+        # Stream the zip to the cache file, hashing it on the way instead of holding it in memory
+        digest = hashlib.sha256()
+        temporary_file = cached_feed_file.with_name(cached_feed_file.name + '.tmp')
+        with open(temporary_file, 'wb') as f:
+            for block in response.iter_content(chunk_size=1024 * 1024):
+                digest.update(block)
+                f.write(block)
+        os.replace(temporary_file, cached_feed_file)
+
+        return {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'sha256': digest.hexdigest(),
+        }
+
+
+def plan_incremental_refresh(session, fingerprints, state, prune_days):
+    # Dates already in the table, as YYYYMMDD strings like the calendar_dates file
+    loaded = {row[0].strftime('%Y%m%d') for row in session.execute(text(f"SELECT DISTINCT start_date FROM {table_name}"))}
+
+    # A date is (re)loaded when it is missing from the table or when its content changed since it was loaded
+    to_load = sorted(date for date, fingerprint in fingerprints.items() if date not in loaded or state['dates'].get(date) != fingerprint)
+    to_delete = [date for date in to_load if date in loaded]
+
+    # Expired dates: no longer in the feed and older than the retention window
+    to_prune = []
+    if prune_days is not None:
+        cutoff = (datetime.now() - timedelta(days=prune_days)).strftime('%Y%m%d')
+        to_prune = sorted(date for date in loaded if date not in fingerprints and date < cutoff)
+
+    return to_load, to_delete, to_prune
+
+
+# Table a full reload is loaded into before it replaces the historical table
+rebuild_table = f"{table_name}_rebuild"
+
+# Primary key of the historical table
+KEY_COLUMNS = ['trip_id', 'start_date', 'stop_sequence', 'stop_id']
+
+
+def prepare_bulk_load(cur, rebuild_index):
+    # Staging table reused by every chunk, emptied at each commit
+    cur.execute(f"CREATE TEMP TABLE historical_staging (LIKE {table_name} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS")
+
+    if rebuild_index:
+        # Full reload into a new table without indexes, so every chunk is a plain append. The historical table
+        # stays as it is until the new one is complete and keyed
+        print(f'Loading the full schedule into {rebuild_table}, without indexes...')
+        create_staging_table(cur, table_name, rebuild_table)
+        return rebuild_table
+    return table_name
+
+
+def bulk_insert_chunk(cur, df, target):
+    # Missing values become None so COPY reads them as NULL
+    rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+    copy_rows(cur, 'historical_staging', HISTORICAL_COLUMNS, rows)
+    # One row per key, so a table without its primary key gets no duplicates from within a chunk either. The
+    # rebuild table has no key to conflict on yet, repeats across chunks are removed by finish_bulk_load
+    on_conflict = "ON CONFLICT DO NOTHING" if target == table_name else ""
+    cur.execute(f"""INSERT INTO {target} ({', '.join(HISTORICAL_COLUMNS)})
+                    SELECT DISTINCT ON ({', '.join(KEY_COLUMNS)}) {', '.join(HISTORICAL_COLUMNS)} FROM historical_staging
+                    ORDER BY {', '.join(KEY_COLUMNS)}
+                    {on_conflict}""")
+    return cur.rowcount
+
+
+def finish_bulk_load(cur, rebuild_index):
+    if rebuild_index:
+        # Keys repeated across chunks are only found once the table is complete: keep one row of each
+        print('Building the indexes and the primary key of the new table...')
+        cur.execute("SAVEPOINT build_indexes")
+        try:
+            index_names = build_indexes(cur, table_name, rebuild_table)
+        except psycopg2.errors.UniqueViolation:
+            cur.execute("ROLLBACK TO SAVEPOINT build_indexes")
+            cur.execute(f"""
+                DELETE FROM {rebuild_table} WHERE ctid IN (
+                    SELECT ctid FROM (
+                        SELECT ctid, row_number() OVER (PARTITION BY {', '.join(KEY_COLUMNS)}) AS occurrence FROM {rebuild_table}
+                    ) AS rows WHERE occurrence > 1)""")
+            print(f'Removed {cur.rowcount} duplicate stop times.')
+            index_names = build_indexes(cur, table_name, rebuild_table)
+        cur.execute(f"ANALYZE {rebuild_table}")
+
+        # Readers see the old schedule until this commits, then the new one
+        print('Swapping the new table in...')
+        swap_tables(cur, table_name, rebuild_table, index_names)
+
+
+def abort_bulk_load(raw_conn, rebuild_index):
+    # A failed full reload leaves the historical table untouched: only the new table goes away
+    raw_conn.rollback()
+    if rebuild_index:
+        cur = raw_conn.cursor()
+        cur.execute(f"DROP TABLE IF EXISTS {rebuild_table}")
+        raw_conn.commit()
+        cur.close()
+
+
+def load_static_feed(bulk, rebuild_index, memory_cap_mb, incremental, prune_days, engine=None):
+    # One refresh of the historical table, returning the status reported in the run metrics
+    # Rebuilding the index is only possible around a bulk reload, which an incremental refresh is not
+    if incremental and rebuild_index:
+        raise ValueError('--rebuild-index reloads the whole table and cannot be combined with --incremental')
+    bulk = bulk or rebuild_index
+
+    # Create engine and session, unless the pipeline runner shares its own
+    if engine is None:
+        engine = create_engine(db_string, connect_args=connect_args(feed_settings))
+        count_round_trips(engine, metrics)
     Session = sessionmaker(bind=engine)
+
+    # Typed keys, supporting indexes and the generated day type and hour of the schedule
+    with metrics.stage('migrations'):
+        conn = engine.raw_connection()
+        try:
+            run_migrations(conn, SCHEDULE_TIMEZONE)
+            cur = conn.cursor()
+            ensure_reloaded_dates_table(cur)
+            conn.commit()
+            cur.close()
+        finally:
+            conn.close()
     session = Session()
 
     # Download data
     print('Downloading data...')
-    response = requests.get(url)
+    state = load_refresh_state() if incremental else None
+    with metrics.stage('download'):
+        download = download_static_feed(state)
+    if incremental and (download is None or download['sha256'] == state['sha256']):
+        if download is not None:
+            save_refresh_state({**state, **download})
+        print('Static feed unchanged since the last refresh. Nothing to do.')
+        session.close()
+        return 'unchanged'
+    metrics.add('bytes_downloaded', cached_feed_file.stat().st_size)
     print('Download complete.')
 
-    # Extract and parse data
-    print('Extracting and parsing data...')
-    with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
-        # Read in dataframes
-        stop_times_df = pd.read_csv(zf.open('stop_times.txt'), chunksize=chunk_size)
-        trips_df = pd.read_csv(zf.open('trips.txt'))
-        calendar_dates_df = pd.read_csv(zf.open('calendar_dates.txt'))
-        stops_df = pd.read_csv(zf.open('stops.txt'))
-        routes_df = pd.read_csv(zf.open('routes.txt'))
-
-        count = 0
-        for chunk in stop_times_df:
-            # Merge dataframes
-            df = (chunk
-                .merge(trips_df, on='trip_id')
-                .merge(calendar_dates_df, on='service_id')
-                .merge(stops_df, on='stop_id')
-                .merge(routes_df, on='route_id'))
-
-            # Convert arrival_time and departure_time to timestamp
-            df['arrival_time'] = parse_date_and_time_vectorized(df['date'].astype(str), df['arrival_time'])
-            df['departure_time'] = parse_date_and_time_vectorized(df['date'].astype(str), df['departure_time'])
-
-            # Convert start_date to a date
-            df['date'] = pd.to_datetime(df['date'], format="%Y%m%d").dt.date
-            df.rename(columns={'date': 'start_date'}, inplace=True)
-
-            # Create a new column "geo_coordinates" combining latitude and longitude
-            df['geo_coordinates'] = df['stop_lat'].astype(str) + ', ' + df['stop_lon'].astype(str)
-
-            # Select columns
-            df = df[['trip_id', 'start_date', 'stop_sequence', 'stop_id', 'route_id', 'stop_name', 'route_long_name', 'arrival_time', 'departure_time', 'geo_coordinates']]
-            
-            # Insert data into the database
-            for row in df.itertuples(index=False):
-                insert_query = text(f"""INSERT INTO {table_name} (trip_id, start_date, stop_sequence, stop_id, route_id, stop_name, route_long_name, arrival_time, departure_time, geo_coordinates) 
-                                    VALUES (:trip_id, :start_date, :stop_sequence, :stop_id, :route_id, :stop_name, :route_long_name, :arrival_time, :departure_time, :geo_coordinates) 
-                                    ON CONFLICT DO NOTHING""")
-                session.execute(insert_query, dict(row._asdict()))
-            
-            # Print progress
-            count += chunk_size
-            print(f'{count} chunks have been processed and inserted.')
-
-            # Commit the transaction
+    # Bulk loads use the raw DBAPI connection for COPY
+    if bulk:
+        raw_conn = engine.raw_connection()
+        cur = raw_conn.cursor()
+        target = prepare_bulk_load(cur, rebuild_index)
+        raw_conn.commit()
+
+    try:
+        # Extract and parse data
+        print('Extracting and parsing data...')
+        with zipfile.ZipFile(cached_feed_file) as zf:
+            dates = None
+            if incremental:
+                with metrics.stage('plan'):
+                    fingerprints = date_fingerprints(zf)
+                    dates, to_delete, to_prune = plan_incremental_refresh(session, fingerprints, state, prune_days)
+                print(f'{len(dates)} of {len(fingerprints)} service dates are new or changed, {len(to_prune)} expired dates to prune.')
+
+                # Changed dates are replaced as a whole, expired ones are removed
+                if to_delete or to_prune:
+                    with metrics.stage('delete'):
+                        session.execute(text(f"DELETE FROM {table_name} WHERE start_date = ANY(CAST(:dates AS date[]))"), {'dates': to_delete + to_prune})
+                        session.commit()
+                dates = [int(date) for date in dates]
+
+            count = 0
+            loaded_dates = set()
+            batches = iter_schedule_batches(zf, memory_cap_mb, dates)
+            while True:
+                # Reading, joining and expanding the next batch
+                with metrics.stage('transform'):
+                    df = next(batches, None)
+                if df is None:
+                    break
+
+                # Make sure the start_date partitions of this batch exist
+                with metrics.stage('partitions'):
+                    partition_cur = cur if bulk else session.connection().connection.cursor()
+                    ensure_partitions_for_dates(partition_cur, target if bulk else table_name, df['start_date'].unique())
+                    if bulk:
+                        raw_conn.commit()
+                    else:
+                        session.commit()
+
+                # Insert data into the database
+                load_start = time.perf_counter()
+                if bulk:
+                    inserted = bulk_insert_chunk(cur, df, target)
+                    raw_conn.commit()
+                else:
+                    for row in df.itertuples(index=False):
+                        insert_query = text(f"""INSERT INTO {table_name} (trip_id, start_date, stop_sequence, stop_id, route_id, stop_name, route_long_name, arrival_time, departure_time, geo_coordinates) 
+                                            VALUES (:trip_id, :start_date, :stop_sequence, :stop_id, :route_id, :stop_name, :route_long_name, :arrival_time, :departure_time, :geo_coordinates) 
+                                            ON CONFLICT DO NOTHING""")
+                        session.execute(insert_query, dict(row._asdict()))
+                    inserted = len(df)
+
+                    # Commit the transaction
+                    session.commit()
+                load_seconds = time.perf_counter() - load_start
+                metrics.stages['load'] += load_seconds
+                metrics.add('rows_processed', len(df))
+                metrics.add('rows_inserted', inserted)
+
+                loaded_dates.update(df['start_date'].unique())
+
+                # Print progress
+                count += len(df)
+                print(f'{count} rows have been processed and inserted. '
+                      f'Loaded {len(df)} rows ({inserted} new) in {load_seconds:.2f} s, {len(df) / max(load_seconds, 1e-9):,.0f} rows/s.')
+
+        # diff_times recomputes the realtime rows of the loaded dates, in the transaction that makes their
+        # schedule visible to it
+        if bulk:
+            with metrics.stage('finish_load'):
+                finish_bulk_load(cur, rebuild_index)
+                mark_reloaded_dates(cur, loaded_dates)
+                raw_conn.commit()
+        else:
+            mark_reloaded_dates(session.connection().connection.cursor(), loaded_dates)
             session.commit()
+    except BaseException:
+        if bulk:
+            abort_bulk_load(raw_conn, rebuild_index)
+        raise
+    finally:
+        if bulk:
+            cur.close()
+            raw_conn.close()
 
     print('Data parsed and inserted.')
     session.close()
 
+    # Remember the feed only once all of its dates are loaded
+    if incremental:
+        for date in to_prune:
+            state['dates'].pop(date, None)
+        save_refresh_state({**download, 'dates': {**state['dates'], **fingerprints}})
+
+    # Peak resident memory of this process, in kilobytes on Linux
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    metrics.add('peak_rss_bytes', peak_rss_kb * 1024)
+    print(f'Peak RSS: {peak_rss_kb / 1024:.1f} MB')
+    return 'ok'
+
+
+def main(bulk=False, rebuild_index=False, memory_cap_mb=memory_cap_mb, incremental=False, prune_days=None, engine=None,
+         schedule_index=schedule_index_dir, index_days=schedule_index_days):
+    # A run that does not return a status, for example on an exception, is reported as an error
+    status = 'error'
+    try:
+        with profiled('historical_extractor'):
+            status = load_static_feed(bulk, rebuild_index, memory_cap_mb, incremental, prune_days, engine)
+            # Rebuilt even when the feed is unchanged, since its window of dates moves every day
+            if schedule_index:
+                print('Building the schedule index...')
+                with metrics.stage('schedule_index'):
+                    with zipfile.ZipFile(cached_feed_file) as zf:
+                        entries = build_schedule_index(zf, Path(schedule_index) / feed_settings['name'], index_days)
+                metrics.add('schedule_index_entries', entries)
+                print(f"Schedule index written to {Path(schedule_index) / feed_settings['name']}: {entries} stop times.")
+    finally:
+        metrics.finish(status)
+    return status
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Download the static GTFS feed and load it into the historical table.')
+    parser.add_argument('--bulk', action='store_true', help='Load each chunk with COPY through a staging table instead of row by row.')
+    parser.add_argument('--memory-cap-mb', type=int, default=memory_cap_mb, help='Approximate memory budget of one expanded batch of rows, in MB.')
+    parser.add_argument('--rebuild-index', action='store_true', help='Full reload: bulk load into a new table without indexes, build its key and indexes, then swap it in. Implies --bulk.')
+    parser.add_argument('--incremental', action='store_true', help='Skip an unchanged feed and only load service dates that are new or changed.')
+    parser.add_argument('--prune-days', type=int, help='With --incremental, delete service dates older than this many days that are no longer in the feed.')
+    parser.add_argument('--schedule-index', default=schedule_index_dir, metavar='DIR', help='Also write the schedule index used by realtime_extractor.py to this directory (SCHEDULE_INDEX_DIR).')
+    parser.add_argument('--schedule-index-days', type=int, default=schedule_index_days, help='Days ahead of today covered by the schedule index, from yesterday on.')
+    args = parser.parse_args()
+    main(bulk=args.bulk, rebuild_index=args.rebuild_index, memory_cap_mb=args.memory_cap_mb, incremental=args.incremental, prune_days=args.prune_days,
+         schedule_index=args.schedule_index, index_days=args.schedule_index_days)
\ No newline at end of file
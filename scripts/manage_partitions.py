@@ -0,0 +1,61 @@
+import os
+import sys
+import argparse
+import psycopg2
+from datetime import date, timedelta
+from dotenv import load_dotenv
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from lib.feeds import connect_args, current_feed
+from lib.partitions import (PARTITION_INTERVAL, convert_to_partitioned, detach_partitions_before,
+                            ensure_partitions_for_dates, list_partitions, period_start)
+
+# Load environment variables
+load_dotenv()
+
+
+def retention_cutoff(keep, interval):
+    # Start of the oldest period kept: the current one and the keep - 1 before it
+    cutoff = period_start(date.today(), interval)
+    for _ in range(keep - 1):
+        cutoff = period_start(cutoff - timedelta(days=1), interval)
+    return cutoff
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage start_date range partitions of the realtime, historical and diff tables.')
+    parser.add_argument('command', choices=['convert', 'ensure', 'retain', 'list'])
+    parser.add_argument('table', help='Table to manage, e.g. trip_updates, gtfs_data or trip_updates_with_diffs.')
+    parser.add_argument('--db-url', default=os.getenv("LOCAL_DB_URL"), help='Connection string, defaults to LOCAL_DB_URL.')
+    parser.add_argument('--interval', choices=['month', 'week'], default=PARTITION_INTERVAL, help='Length of one partition.')
+    parser.add_argument('--keep', type=int, default=12, help='retain: number of most recent partitions kept attached.')
+    parser.add_argument('--archive-schema', help='retain: move detached partitions to this schema instead of leaving them in place.')
+    parser.add_argument('--drop', action='store_true', help='retain: drop detached partitions.')
+    args = parser.parse_args()
+
+    # Tables of the feed selected with FEED, through its search path
+    conn = psycopg2.connect(args.db_url, **connect_args(current_feed()))
+    cur = conn.cursor()
+
+    if args.command == 'convert':
+        # Rename the heap to <table>_unpartitioned and copy it into a partitioned table of the same shape
+        print(f'Converting {args.table} to {args.interval}ly partitions...')
+        copied = convert_to_partitioned(cur, args.table, args.interval)
+        print(f'Copied {copied} rows. The old table is kept as {args.table}_unpartitioned.')
+    elif args.command == 'ensure':
+        created = ensure_partitions_for_dates(cur, args.table, [], args.interval)
+        print(f'Created {len(created)} partitions: {", ".join(created) or "none"}')
+    elif args.command == 'retain':
+        cutoff = retention_cutoff(args.keep, args.interval)
+        detached = detach_partitions_before(cur, args.table, cutoff, args.archive_schema, args.drop)
+        print(f'Detached {len(detached)} partitions ending before {cutoff}: {", ".join(detached) or "none"}')
+    else:
+        for name, lower, upper in list_partitions(cur, args.table):
+            print(f'{name}: {lower} to {upper}')
+
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
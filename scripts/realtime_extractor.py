@@ -1,17 +1,32 @@
 import os
+import numpy as np
 import pandas as pd
 import requests
 import json
 import pytz
 import fasteners
 import signal
+import time
+import random
+import argparse
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from pathlib import Path
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from lib import gtfs_realtime_pb2
-from sqlalchemy import create_engine, text
+from lib.pg_copy import copy_rows
+from lib.partitions import ensure_partitions_for_dates, partition_window
+from lib.feed_archive import append_feed
+from lib.metrics import RunMetrics, count_round_trips, profiled
+from lib.weather import ensure_weather_table, latest_fetch, insert_observation
+from lib.schedule_index import DELAY_COLUMNS, ScheduleIndex, ensure_delay_columns
+from lib.feeds import current_feed, connect_args, is_default_feed
+from lib.migrations import run_migrations
+from sqlalchemy import create_engine
 
 # Load environment variables
 load_dotenv()
@@ -19,15 +34,18 @@ load_dotenv()
 # Get the absolute path to the directory of this script
 script_dir = Path(os.path.dirname(os.path.abspath(__file__)))
 
-# Create the lock file in the script directory
-LOCK_FILE = script_dir / "script.lock"
+# Feed of the registry this process polls, selected with FEED
+feed_settings = current_feed()
+
+# One lock file per feed in the locks folder of the script directory, so feeds are polled independently
+LOCK_FILE = script_dir / "locks" / f"{feed_settings['name']}.lock"
 
 # URL to download the data
-url = "https://sudbury.tmix.se/gtfs-realtime/tripupdates.pb"
+url = feed_settings['realtime_url']
 
-# OpenWeather API details
+# OpenWeather API details. Feeds without a weather query are polled without weather
 open_weather_api_key = os.getenv("OPEN_WEATHER_API_KEY")
-open_weather_api_url = f"http://api.openweathermap.org/data/2.5/weather?q=Sudbury,ca&appid={open_weather_api_key}"
+open_weather_api_url = f"http://api.openweathermap.org/data/2.5/weather?q={feed_settings['weather_query']}&appid={open_weather_api_key}"
 
 # Database connection string
 db_string = os.getenv("REMOTE_DB_URL")
@@ -35,29 +53,102 @@ db_string = os.getenv("REMOTE_DB_URL")
 # The table name can be replaced
 table_name = os.getenv("REALTIME_TABLE")
 
-# Path to the file to store the time of last API call
-last_api_call_file = Path("last_api_call.json")
+# Columns of a decoded stop time update, in the order they are staged
+STAGING_COLUMNS = ('trip_id', 'start_date', 'stop_sequence', 'stop_id', 'arrival_epoch', 'departure_epoch')
 
-def get_last_api_call():
-    if last_api_call_file.is_file():
-        with open(last_api_call_file, 'r') as f:
-            return datetime.fromisoformat(json.load(f)['last_api_call'])
-    else:
-        return datetime.now() - timedelta(minutes=3)
+# Timeout of a single run in seconds
+run_timeout_seconds = 30 * 60  # 30 minutes
+
+# Exit code of a single run that found the feed unavailable (503), for the feed scheduler to back off
+EXIT_UNAVAILABLE = 3
+
+# Path to the file that stores the last feed header timestamp and a fingerprint of every stop time update written
+# The default feed keeps the file name it had before the feed registry
+state_file_name = "realtime_state.json" if is_default_feed(feed_settings) else f"realtime_state.{feed_settings['name']}.json"
+state_file = Path(os.getenv("REALTIME_STATE_FILE", script_dir / state_file_name))
+
+# Connect and read timeouts of the HTTP requests, in seconds. The read timeout applies to each socket read
+http_connect_timeout = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+feed_read_timeout = float(os.getenv("FEED_READ_TIMEOUT", 20))
+weather_read_timeout = float(os.getenv("WEATHER_READ_TIMEOUT", 5))
+
+# The weather reading is optional: a run waits for it at most this many seconds after its start
+weather_deadline_seconds = float(os.getenv("WEATHER_DEADLINE_SECONDS", 8))
+
+# Threads running the weather request next to the feed download, reused across polls in daemon mode
+fetch_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='fetch')
+
+# Stage timings and counters of each run
+metrics = RunMetrics('realtime_extractor', feed_settings['name'])
+
+# With passage inference, a stop that drops out of the feed is only recorded as passed when its last
+# prediction is at most this many seconds ahead of the feed time. Stops dropped further ahead were cancelled
+passage_horizon_seconds = int(os.getenv("PASSAGE_HORIZON_SECONDS", 600))
+
+# Append-only table of the intermediate predictions, written with --prediction-history
+history_table = os.getenv("PREDICTION_HISTORY_TABLE", "trip_update_history")
+
+# Minimum time between two OpenWeather calls
+weather_ttl = timedelta(seconds=int(os.getenv("WEATHER_TTL_SECONDS", 120)))
 
-def set_last_api_call(last_api_call):
-    with open(last_api_call_file, 'w') as f:
-        json.dump({'last_api_call': last_api_call.isoformat()}, f)
+# Time of the last OpenWeather call of this process. A new process, like each cron run, starts from the time
+# kept next to the state file: the sync deletes the synced rows of the weather table, so its newest fetched_at
+# is only a fallback
+weather_cache = {'fetched_at': None, 'seeded': False}
+weather_state_file = state_file.with_name(f'{state_file.stem}.weather.json')
+weather_lock = threading.Lock()
 
-def get_weather_data():
-    last_api_call = get_last_api_call()
-    if datetime.now() - last_api_call < timedelta(minutes=2):
+# Schedule index written by historical_extractor.py --schedule-index. When set, the delays of each stop time
+# update are computed at ingest. Tables whose delay columns were added by this process
+schedule_index = ScheduleIndex(Path(os.getenv("SCHEDULE_INDEX_DIR")) / feed_settings['name']) if os.getenv("SCHEDULE_INDEX_DIR") else None
+delay_column_tables = set()
+
+
+def load_weather_fetch():
+    if weather_state_file.is_file():
+        with open(weather_state_file, 'r') as f:
+            return datetime.fromisoformat(json.load(f)['fetched_at'])
+    return None
+
+
+def save_weather_fetch(fetched_at):
+    temporary_file = weather_state_file.with_name(weather_state_file.name + '.tmp')
+    with open(temporary_file, 'w') as f:
+        json.dump({'fetched_at': fetched_at.isoformat()}, f)
+    os.replace(temporary_file, weather_state_file)
+
+
+def weather_due(engine, now):
+    # Claims the next OpenWeather call when the last one is older than the TTL. The call is claimed
+    # before it is made, so a slow call is not started a second time by the next poll
+    with weather_lock:
+        if not weather_cache['seeded']:
+            conn = engine.raw_connection()
+            try:
+                cur = conn.cursor()
+                ensure_weather_table(cur)
+                fetches = [latest_fetch(cur), load_weather_fetch()]
+                conn.commit()
+            finally:
+                conn.close()
+            weather_cache['fetched_at'] = max((fetch for fetch in fetches if fetch is not None), default=None)
+            weather_cache['seeded'] = True
+        if weather_cache['fetched_at'] is not None and now - weather_cache['fetched_at'] < weather_ttl:
+            return False
+        weather_cache['fetched_at'] = now
+        save_weather_fetch(now)
+        return True
+
+
+def get_weather_data(engine):
+    if not feed_settings['weather_query']:
         return None
-    last_api_call = datetime.now()
-    set_last_api_call(last_api_call)
     try:
+        now = datetime.now(pytz.UTC)
+        if not weather_due(engine, now):
+            return None
         print('Getting weather data...')
-        weather_data = requests.get(open_weather_api_url).json()
+        weather_data = requests.get(open_weather_api_url, timeout=(http_connect_timeout, weather_read_timeout)).json()
         print('Got weather data.')
         weather_id = weather_data['weather'][0]['id']
         weather_description = weather_data['weather'][0]['description']
@@ -84,9 +175,12 @@ def get_weather_data():
             weather_group = 'Unknown'
         
         return {
+            'observed_at': datetime.fromtimestamp(weather_data['dt'], tz=pytz.UTC),
+            'weather_id': weather_id,
             'weather_group': weather_group,
             'weather_description': weather_description,
-            'temperature': temperature_c
+            'temperature': temperature_c,
+            'fetched_at': now,
         }
 
     except Exception as e:
@@ -94,36 +188,530 @@ def get_weather_data():
         return None
 
 
-def parse_pb_data(data):
+def read_feed(data):
     feed = gtfs_realtime_pb2.FeedMessage()
     feed.ParseFromString(data)
+    return feed
+
+
+def decode_feed(feed):
+    # Typed column buffers, filled straight from the protobuf without building a dict per stop time update
+    trip_ids = []
+    start_dates = []
+    stop_ids = []
+    stop_sequences = array('q')
+    arrivals = array('q')
+    departures = array('q')
+    has_arrival = array('b')
+    has_departure = array('b')
 
-    parsed_data = []
     for entity in feed.entity:
         if entity.HasField('trip_update'):
-            trip_id = entity.trip_update.trip.trip_id
-            start_date = entity.trip_update.trip.start_date
-            for update in entity.trip_update.stop_time_update:
-                departure_time = pd.to_datetime(update.departure.time, unit='s', utc=True) if update.HasField('departure') else None
-                arrival_time = pd.to_datetime(update.arrival.time, unit='s', utc=True) if update.HasField('arrival') else None
-                parsed_data.append({
-                    'trip_id': trip_id,
-                    'start_date': start_date,
-                    'stop_sequence': update.stop_sequence,
-                    'stop_id': update.stop_id,
-                    'departure_time': departure_time,
-                    'arrival_time': arrival_time,
-                })
+            trip_update = entity.trip_update
+            updates = trip_update.stop_time_update
+            trip_ids.extend([trip_update.trip.trip_id] * len(updates))
+            start_dates.extend([trip_update.trip.start_date] * len(updates))
+            for update in updates:
+                stop_sequences.append(update.stop_sequence)
+                stop_ids.append(update.stop_id)
+                if update.HasField('arrival'):
+                    arrivals.append(update.arrival.time)
+                    has_arrival.append(1)
+                else:
+                    arrivals.append(0)
+                    has_arrival.append(0)
+                if update.HasField('departure'):
+                    departures.append(update.departure.time)
+                    has_departure.append(1)
+                else:
+                    departures.append(0)
+                    has_departure.append(0)
+
+    return {
+        'header_timestamp': feed.header.timestamp,
+        'trip_id': trip_ids,
+        'start_date': start_dates,
+        'stop_sequence': stop_sequences,
+        'stop_id': stop_ids,
+        'arrival_epoch': arrivals,
+        'departure_epoch': departures,
+        'has_arrival': has_arrival,
+        'has_departure': has_departure,
+    }
+
+
+def parse_pb_data(data, as_frame=True):
+    columns = decode_feed(read_feed(data))
+    if not as_frame:
+        return columns
+
+    # Convert the epoch columns in one vectorized step, masking missing events as NaT
+    def to_timestamps(epochs, mask):
+        timestamps = pd.Series(pd.to_datetime(np.frombuffer(epochs, dtype=np.int64), unit='s', utc=True))
+        return timestamps.where(np.frombuffer(mask, dtype=np.int8).astype(bool))
+
+    return pd.DataFrame({
+        'trip_id': columns['trip_id'],
+        'start_date': columns['start_date'],
+        'stop_sequence': np.frombuffer(columns['stop_sequence'], dtype=np.int64),
+        'stop_id': columns['stop_id'],
+        'departure_time': to_timestamps(columns['departure_epoch'], columns['has_departure']),
+        'arrival_time': to_timestamps(columns['arrival_epoch'], columns['has_arrival']),
+    })
+
+
+def feed_rows(columns):
+    # Yield one staging record per stop time update, with missing events as None
+    return zip(
+        columns['trip_id'],
+        columns['start_date'],
+        columns['stop_sequence'],
+        columns['stop_id'],
+        (epoch if present else None for epoch, present in zip(columns['arrival_epoch'], columns['has_arrival'])),
+        (epoch if present else None for epoch, present in zip(columns['departure_epoch'], columns['has_departure'])),
+    )
+
+
+def load_state():
+    if state_file.is_file():
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+    else:
+        state = {'header_timestamp': None, 'rows': {}}
+    # Pending predictions and recorded passages of the passage inference, by stop time update key
+    state.setdefault('predictions', {})
+    state.setdefault('passed', {})
+    return state
+
+
+def save_state(state):
+    # Write to a temporary file first so an interrupted run never leaves a truncated state behind
+    temporary_file = state_file.with_name(state_file.name + '.tmp')
+    with open(temporary_file, 'w') as f:
+        json.dump(state, f, separators=(',', ':'))
+    os.replace(temporary_file, state_file)
+
+
+def select_changed_rows(rows, previous_fingerprints):
+    # Keep only the stop time updates whose stop or predicted times differ from the last written snapshot
+    changed = []
+    fingerprints = {}
+    for row in rows:
+        trip_id, start_date, stop_sequence, stop_id, arrival_epoch, departure_epoch = row
+        key = f'{trip_id}|{start_date}|{stop_sequence}'
+        fingerprint = [stop_id, arrival_epoch, departure_epoch]
+        fingerprints[key] = fingerprint
+        if previous_fingerprints.get(key) != fingerprint:
+            changed.append(row)
+    return changed, fingerprints
+
+
+def passage_time(arrival_epoch, departure_epoch):
+    # The vehicle has passed the stop once it has left it, or arrived when there is no departure (last stop).
+    # Zero times are the feed's way of saying "no such event"
+    return departure_epoch or arrival_epoch or None
+
+
+def infer_passages(rows, predictions, passed, feed_time):
+    # Collapses the rolling predictions into observed passages. A stop time update is recorded once, when
+    # its predicted passage is in the past or when the stop drops out of the feed, with its last prediction.
+    # Returns the passages to write and the new pending predictions and recorded passages
+    passages = []
+    current = set()
+    new_predictions = {}
+    new_passed = {}
+    for row in rows:
+        trip_id, start_date, stop_sequence, stop_id, arrival_epoch, departure_epoch = row
+        key = f'{trip_id}|{start_date}|{stop_sequence}'
+        fingerprint = [stop_id, arrival_epoch, departure_epoch]
+        current.add(key)
+        event = passage_time(arrival_epoch, departure_epoch)
+        if event is not None and event <= feed_time:
+            # Passed stops can stay in the feed for a while: they are written again only if their times change
+            if passed.get(key) != fingerprint:
+                passages.append(row)
+            new_passed[key] = fingerprint
+        else:
+            new_predictions[key] = fingerprint
+
+    # Stops that left the feed without being recorded: their last prediction is the observation,
+    # unless it was still well ahead of the feed time (cancelled trip or skipped stop)
+    for key, (stop_id, arrival_epoch, departure_epoch) in predictions.items():
+        if key in current:
+            continue
+        event = passage_time(arrival_epoch, departure_epoch)
+        if event is not None and event <= feed_time + passage_horizon_seconds:
+            trip_id, start_date, stop_sequence = key.rsplit('|', 2)
+            passages.append((trip_id, start_date, int(stop_sequence), stop_id, arrival_epoch, departure_epoch))
+    return passages, new_predictions, new_passed
+
+
+def ensure_history_table(cur):
+    # Compact log of the predictions: epochs instead of timestamps, no index, only appended to
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {history_table}
+        (
+            feed_timestamp bigint NOT NULL,
+            trip_id text NOT NULL,
+            start_date date NOT NULL,
+            stop_sequence integer NOT NULL,
+            stop_id text NOT NULL,
+            arrival_epoch bigint,
+            departure_epoch bigint
+        )""")
+
+
+def write_prediction_history(engine, rows, feed_time):
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        ensure_history_table(cur)
+        written = copy_rows(cur, history_table, ['feed_timestamp', *STAGING_COLUMNS], ((feed_time, *row) for row in rows))
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+    return written
+
+
+def write_weather(engine, observation):
+    # Stored once per observation, the diff computation joins it to the trip updates by time
+    conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+        inserted = insert_observation(cur, observation)
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+    return inserted
+
+
+def valid_start_date(value, window):
+    # GTFS service dates are YYYYMMDD. Trip updates without one cannot be keyed, nor placed in a partition, and
+    # those outside the partition window are bad dates that would make the partitions refuse the whole snapshot
+    try:
+        day = datetime.strptime(value, '%Y%m%d').date()
+    except (TypeError, ValueError):
+        return False
+    return window[0] <= day <= window[1]
+
+
+def write_trip_updates(engine, rows, now, table=None, delays=None):
+    table = table or table_name
+
+    # Stop time updates with an empty or invalid start date are skipped, for the partitions and the upsert alike
+    window = partition_window()
+    valid = [valid_start_date(row[1], window) for row in rows]
+    if not all(valid):
+        print(f'Skipping {valid.count(False)} stop time updates without a valid start date.')
+        metrics.add('rows_invalid_date', valid.count(False))
+        rows = [row for row, ok in zip(rows, valid) if ok]
+        if delays is not None:
+            delays = [delay for delay, ok in zip(delays, valid) if ok]
+
+    # Columns written for every stop time update. Weather lives in its own table. With delays from the
+    # schedule index, one (arrival, departure) pair per row, the delay columns are written too
+    insert_columns = ['trip_id', 'start_date', 'stop_sequence', 'stop_id', 'arrival_time', 'departure_time']
+    staging_columns = ['row_number', *STAGING_COLUMNS]
+    select_delays = update_delays = ''
+    if delays is not None:
+        insert_columns += DELAY_COLUMNS
+        staging_columns += DELAY_COLUMNS
+        rows = [(*row, *delay) for row, delay in zip(rows, delays)]
+        select_delays = ', ' + ', '.join(DELAY_COLUMNS)
+        update_delays = ''.join(f"\n            {column} = EXCLUDED.{column}," for column in DELAY_COLUMNS)
+    params = {'created_at': now, 'updated_at': now}
+
+    # One set-based upsert from the staging table. DISTINCT ON keeps the last occurrence of a key in the feed,
+    # and xmax = 0 tells freshly inserted rows apart from updated ones
+    upsert_query = f"""
+        WITH upserted AS (
+            INSERT INTO {table} ({', '.join(insert_columns)}, created_at)
+            SELECT DISTINCT ON (trip_id, start_date, stop_sequence, stop_id)
+                trip_id, start_date, stop_sequence, stop_id,
+                to_timestamp(arrival_epoch), to_timestamp(departure_epoch){select_delays}, %(created_at)s
+            FROM realtime_staging
+            ORDER BY trip_id, start_date, stop_sequence, stop_id, row_number DESC
+            ON CONFLICT (trip_id, start_date, stop_sequence, stop_id)
+            DO UPDATE SET{update_delays}
+            arrival_time = EXCLUDED.arrival_time,
+            departure_time = EXCLUDED.departure_time,
+            updated_at = %(updated_at)s
+            WHERE
+            {table}.arrival_time != EXCLUDED.arrival_time OR
+            {table}.departure_time != EXCLUDED.departure_time
+            RETURNING (xmax = 0) AS inserted
+        )
+        SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM upserted"""
+
+    with metrics.stage('db_connect'):
+        conn = engine.raw_connection()
+    try:
+        cur = conn.cursor()
+
+        # Make sure the start_date partitions exist, committed apart from the data so a failed write keeps them
+        ensure_partitions_for_dates(cur, table, {row[1] for row in rows})
+        if delays is not None and table not in delay_column_tables:
+            ensure_delay_columns(cur, table)
+            delay_column_tables.add(table)
+        conn.commit()
+
+        # Stage the whole snapshot with COPY, dropped automatically at commit
+        cur.execute("""
+            CREATE TEMP TABLE realtime_staging (
+                row_number bigint,
+                trip_id text,
+                start_date date,
+                stop_sequence integer,
+                stop_id text,
+                arrival_epoch bigint,
+                departure_epoch bigint,
+                arrival_time_diff_in_minutes double precision,
+                departure_time_diff_in_minutes double precision
+            ) ON COMMIT DROP""")
+        copy_rows(cur, 'realtime_staging', staging_columns, ((i, *row) for i, row in enumerate(rows)))
+
+        cur.execute(upsert_query, params)
+        inserted, updated = cur.fetchone()
+        conn.commit()
+        cur.close()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    return inserted, updated
+
+
+def download_feed(session, state):
+    # Conditional GET: the server answers 304 Not Modified when the validators from the last download still match
+    headers = {}
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        headers['If-Modified-Since'] = state['last_modified']
+
+    response = session.get(url, headers=headers, timeout=(http_connect_timeout, feed_read_timeout))
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()  # This will raise an HTTPError for 4xx or 5xx status codes
+    return response
+
+
+def wait_for_weather(future, deadline):
+    # Weather reading of the run, or None when it is not back by the deadline. The request itself
+    # is bounded by its timeouts, so a late reading only keeps a pool thread busy a little longer
+    try:
+        return future.result(timeout=max(0, deadline - time.monotonic()))
+    except FutureTimeoutError:
+        print('Weather data not received in time. Skipping it for this run.')
+        metrics.add('weather_timeouts')
+        return None
+
+
+def poll_feed(engine, session, state, archive_dir=None, infer=False, history=False):
+    # One poll of the feed, returning the status reported in the run metrics
+    # Print datetime of the start of this run
+    print(f"Starting run at {datetime.now()}")
+
+    try:
+        # Download data
+        print('Downloading data...')
+        with metrics.stage('download'):
+            response = download_feed(session, state)
+        if response is None:
+            print('Feed not modified since the last download. Skipping this run.')
+            return 'not_modified'
+        metrics.add('bytes_downloaded', len(response.content))
+        print('Download complete.')
+    except requests.exceptions.HTTPError as e:
+        if e.response.status_code == 503:  # If it's a 503 error, just return and end the current run
+            print('Server is unavailable. Skipping this run.')
+            return 'unavailable'
+        else:  # For other HTTP errors, you might want to raise the error or handle it differently
+            print(f"Error occurred while downloading data: {e}")
+            return 'download_error'
+    except requests.exceptions.RequestException as e:  # For non-HTTP errors
+        print(f"Error occurred while downloading data: {e}")
+        return 'download_error'
+
+    try:
+        # Parse data
+        print('Parsing data...')
+        with metrics.stage('parse'):
+            feed = read_feed(response.content)
+        # An identical header timestamp means the publisher has not regenerated the feed
+        if feed.header.timestamp and feed.header.timestamp == state['header_timestamp']:
+            print(f"Feed unchanged since {feed.header.timestamp}. Skipping this run.")
+            state.update({'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')})
+            save_state(state)
+            return 'unchanged'
+        # Keep the raw payload of every new snapshot for replays and backfills
+        if archive_dir:
+            with metrics.stage('archive'):
+                append_feed(archive_dir, feed.header.timestamp or int(time.time()), response.content)
+        with metrics.stage('parse'):
+            columns = decode_feed(feed)
+        with metrics.stage('select_changed'):
+            rows, fingerprints = select_changed_rows(feed_rows(columns), state['rows'])
+        metrics.add('rows_parsed', len(columns['trip_id']))
+        metrics.add('rows_changed', len(rows))
+        print(f"Parsing complete. {len(rows)} of {len(columns['trip_id'])} stop time updates changed.")
+
+        # With passage inference only passed stops are written, the changed predictions go to the history
+        predicted_rows, predictions, passed = rows, state['predictions'], state['passed']
+        if infer:
+            with metrics.stage('infer_passages'):
+                feed_time = feed.header.timestamp or int(time.time())
+                rows, predictions, passed = infer_passages(feed_rows(columns), state['predictions'], state['passed'], feed_time)
+            metrics.add('passages', len(rows))
+            print(f"{len(rows)} stop passages inferred, {len(predictions)} stops still predicted.")
+    except Exception as e:
+        print(f"Error occurred while parsing data: {e}")
+        return 'parse_error'
+
+    # Get current datetime in UTC
+    now = datetime.utcnow().replace(tzinfo=pytz.UTC)
+
+    # Insert data into the database
+    try:
+        if history and predicted_rows:
+            with metrics.stage('history'):
+                metrics.add('history_rows', write_prediction_history(engine, predicted_rows, feed.header.timestamp or int(time.time())))
+        if rows:
+            # Delays from the schedule index, reloaded when a new version was built
+            delays = None
+            if schedule_index is not None:
+                with metrics.stage('schedule_index'):
+                    delays = schedule_index.delays(rows)
+                if delays is not None:
+                    metrics.add('rows_scheduled', sum(delay != (None, None) for delay in delays))
+            print('Initiated database connection.')
+            with metrics.stage('upsert'):
+                inserted, updated = write_trip_updates(engine, rows, now, delays=delays)
+            metrics.add('rows_inserted', inserted)
+            metrics.add('rows_updated', updated)
+            # Print the amount of rows inserted and updated
+            print(f"Inserted {inserted} rows and updated {updated} rows in the database ({len(rows)} changed rows sent).")
+        # Remember what was written only once it is committed
+        with metrics.stage('save_state'):
+            state.update({
+                'header_timestamp': feed.header.timestamp,
+                'rows': fingerprints,
+                'predictions': predictions,
+                'passed': passed,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            })
+            save_state(state)
+        # Print the ending datetime of this run
+        print(f"Ending run at {datetime.now()}")
+        return 'ok'
+    except Exception as e:
+        print(f"Error occurred while inserting data into the database: {e}")
+        return 'db_error'
+
+
+def store_weather(engine, future, deadline):
+    observation = wait_for_weather(future, deadline)
+    if observation is None:
+        return
+    try:
+        metrics.add('weather_observations', write_weather(engine, observation))
+    except Exception as e:
+        print(f"Error occurred while inserting weather data into the database: {e}")
+
+
+def run_once(engine, session, state, archive_dir=None, infer=False, history=False):
+    # The weather is requested next to the feed download, so a run takes as long as the slower of the two
+    # instead of their sum. Between calls (WEATHER_TTL_SECONDS) the request returns None right away
+    weather_deadline = time.monotonic() + weather_deadline_seconds
+    weather_future = fetch_pool.submit(get_weather_data, engine)
+
+    # A run that does not return a status, for example on a timeout, is reported as an error
+    status = 'error'
+    try:
+        with profiled('realtime_extractor'):
+            status = poll_feed(engine, session, state, archive_dir, infer, history)
+            with metrics.stage('weather'):
+                store_weather(engine, weather_future, weather_deadline)
+    finally:
+        metrics.finish(status)
+    return status
 
-    return pd.DataFrame(parsed_data)
 
+def next_backoff(backoff, status, interval, max_backoff):
+    # Wait before the next poll of a feed answering 503: twice the previous one, from twice the interval up to
+    # max_backoff seconds. 0 once the feed answers again, back to the regular interval
+    if status == 'unavailable':
+        return min(max(backoff * 2, interval * 2), max_backoff)
+    return 0
+
+
+def run_daemon(engine, session, interval, jitter, archive_dir=None, infer=False, history=False, max_backoff=600):
+    # Stop between polls on SIGTERM or Ctrl+C, letting the current run finish its transaction
+    stop = threading.Event()
+
+    def shutdown_handler(signum, frame):
+        print(f"Received signal {signum}. Shutting down after the current run.")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown_handler)
+    signal.signal(signal.SIGINT, shutdown_handler)
+
+    state = load_state()
+    next_tick = time.monotonic()
+    backoff = 0
+    while not stop.is_set():
+        start_time = datetime.now()
+        status = 'error'
+        signal.alarm(run_timeout_seconds)
+        try:
+            status = run_once(engine, session, state, archive_dir, infer, history)
+        except TimeoutError as e:
+            print(f"Timeout error: {e}")
+        finally:
+            signal.alarm(0)
+        print(f"Run execution time: {(datetime.now() - start_time).total_seconds():.2f} seconds")
+
+        # An unavailable feed is left alone for the backoff, then the ticks start over from the next poll
+        backoff = next_backoff(backoff, status, interval, max_backoff)
+        if backoff:
+            print(f"Feed unavailable, next poll in {backoff:.0f} s.")
+            stop.wait(backoff + random.uniform(0, jitter))
+            next_tick = time.monotonic()
+            continue
+
+        # Ticks are scheduled on a fixed grid so sleep times do not accumulate drift. Ticks missed by a
+        # slow run are skipped instead of being run back to back, and jitter only delays the wake-up itself
+        next_tick += interval
+        current = time.monotonic()
+        if current > next_tick:
+            next_tick += ((current - next_tick) // interval + 1) * interval
+        stop.wait(next_tick - current + random.uniform(0, jitter))
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Download GTFS realtime trip updates into the realtime table.')
+    parser.add_argument('--daemon', action='store_true', help='Keep running and poll the feed every --interval seconds.')
+    parser.add_argument('--interval', type=float, default=float(os.getenv("REALTIME_POLL_INTERVAL", 15)), help='Seconds between polls in daemon mode.')
+    parser.add_argument('--jitter', type=float, default=float(os.getenv("REALTIME_POLL_JITTER", 1)), help='Maximum random delay in seconds added to each poll in daemon mode.')
+    parser.add_argument('--max-backoff', type=float, default=float(os.getenv("FEED_MAX_BACKOFF", 600)), help='Longest wait in seconds between polls of a feed answering 503 in daemon mode.')
+    parser.add_argument('--archive-dir', default=os.getenv("FEED_ARCHIVE_DIR"), help='Append every new raw feed payload to a compressed archive in this directory.')
+    parser.add_argument('--infer-passages', action='store_true', default=os.getenv("INFER_PASSAGES") == "1",
+                        help='Only write a stop time update once the stop has been passed, with its last prediction, instead of every new prediction.')
+    parser.add_argument('--prediction-history', action='store_true', default=os.getenv("PREDICTION_HISTORY") == "1",
+                        help='Append every changed prediction to the compact PREDICTION_HISTORY_TABLE (trip_update_history).')
+    args = parser.parse_args()
 
     # Get the start time of this run
     start_time = datetime.now()
 
+    # Raw payloads of each feed go to their own folder of the archive
+    archive_dir = os.path.join(args.archive_dir, feed_settings['name']) if args.archive_dir else None
+
     # Create a lock file to prevent multiple instances of the script from running at the same time
     lock = fasteners.InterProcessLock(LOCK_FILE)
     gotten = lock.acquire(blocking=False)
@@ -131,114 +719,37 @@ def main():
         print("Another instance of the script is running. Exiting this run.")
         sys.exit()
 
-    # Set the timeout period in seconds
-    timeout_seconds = 30 * 60  # 30 minutes
-
     # Define a function to handle timeouts
     def timeout_handler(signum, frame):
         raise TimeoutError("Script execution timed out")
 
     # Set the timeout signal handler
     signal.signal(signal.SIGALRM, timeout_handler)
-    signal.alarm(timeout_seconds)  # Set the alarm
-
 
     try:
         try:
-
-            # Print datetime of the start of this run
-            print(f"Starting run at {datetime.now()}")
-
-            # Create engine
-            engine = create_engine(db_string)
-            
-            try:
-                # Download data
-                print('Downloading data...')
-                response = requests.get(url)
-                response.raise_for_status()  # This will raise an HTTPError for 4xx or 5xx status codes
-                print('Download complete.')
-            except requests.exceptions.HTTPError as e:
-                if e.response.status_code == 503:  # If it's a 503 error, just return and end the current run
-                    print('Server is unavailable. Skipping this run.')
-                    return
-                else:  # For other HTTP errors, you might want to raise the error or handle it differently
-                    print(f"Error occurred while downloading data: {e}")
-                    return
-            except requests.exceptions.RequestException as e:  # For non-HTTP errors
-                print(f"Error occurred while downloading data: {e}")
-                return
-
-            try:
-                # Parse data
-                print('Parsing data...')
-                df = parse_pb_data(response.content)
-                print('Parsing complete.')
-            except Exception as e:
-                print(f"Error occurred while parsing data: {e}")
-                return
-
-            # Get weather data
-            weather_data = get_weather_data()
-
-            # Get current datetime in UTC
-            now = datetime.utcnow().replace(tzinfo=pytz.UTC)
-
-            # Replace 'NaT' with None
-            df['arrival_time'].replace({pd.NaT: None}, inplace=True)
-            df['departure_time'].replace({pd.NaT: None}, inplace=True)
-
-            # Insert data into the database
+            # Create engine and HTTP session. In daemon mode both are reused across polls, keeping the
+            # database connection pooled and the HTTPS connection alive
+            engine = create_engine(db_string, pool_pre_ping=True, connect_args=connect_args(feed_settings))
+            count_round_trips(engine, metrics)
+            session = requests.Session()
+
+            # Typed keys and the index of the change time, once per process
+            conn = engine.raw_connection()
             try:
-                with engine.connect() as conn:
-                    # Start counter
-                    counter = 0
-                    # First print to initiate database connection
-                    print('Initiated database connection.')
-                    for _, row in df.iterrows():
-                        # Counter to count the number of rows inserted
-                        counter += 1
-                        if weather_data is not None:
-                            row['weather_group'] = weather_data['weather_group']
-                            row['weather_description'] = weather_data['weather_description']
-                            row['temperature'] = weather_data['temperature']  # add temperature
-                            insert_query = text(f"""
-                                INSERT INTO {table_name} (trip_id, start_date, stop_sequence, stop_id, arrival_time, departure_time, weather_group, weather_description, temperature, created_at)
-                                VALUES (:trip_id, :start_date, :stop_sequence, :stop_id, :arrival_time, :departure_time, :weather_group, :weather_description, :temperature, :created_at)
-                                ON CONFLICT (trip_id, start_date, stop_sequence, stop_id) 
-                                DO UPDATE SET 
-                                arrival_time = EXCLUDED.arrival_time,
-                                departure_time = EXCLUDED.departure_time,
-                                weather_group = EXCLUDED.weather_group, 
-                                weather_description = EXCLUDED.weather_description,
-                                temperature = EXCLUDED.temperature,
-                                updated_at = :updated_at
-                                WHERE 
-                                {table_name}.arrival_time != EXCLUDED.arrival_time OR
-                                {table_name}.departure_time != EXCLUDED.departure_time""")
-                        else:
-                            insert_query = text(f"""
-                                INSERT INTO {table_name} (trip_id, start_date, stop_sequence, stop_id, arrival_time, departure_time, created_at)
-                                VALUES (:trip_id, :start_date, :stop_sequence,:stop_id, :arrival_time, :departure_time, :created_at)
-                                ON CONFLICT (trip_id, start_date, stop_sequence, stop_id) 
-                                DO UPDATE SET 
-                                arrival_time = EXCLUDED.arrival_time,
-                                departure_time = EXCLUDED.departure_time,
-                                updated_at = :updated_at
-                                WHERE 
-                                {table_name}.arrival_time != EXCLUDED.arrival_time OR
-                                {table_name}.departure_time != EXCLUDED.departure_time""")
-
-                        # Create a Transaction object and execute the insert query
-                        with conn.begin():
-                            conn.execute(insert_query, {**row.to_dict(), 'created_at': now, 'updated_at': now})
-                    # Print the amount of rows inserted
-                    print(f"Inserted {counter} rows into the database.")
-                    # Print the ending datetime of this run
-                    print(f"Ending run at {datetime.now()}")
-            except Exception as e:
-                print(f"Error occurred while inserting data into the database: {e}")
-
+                run_migrations(conn, feed_settings['timezone'])
+            finally:
+                conn.close()
+
+            status = None
+            if args.daemon:
+                run_daemon(engine, session, args.interval, args.jitter, archive_dir, args.infer_passages, args.prediction_history, args.max_backoff)
+            else:
+                signal.alarm(run_timeout_seconds)  # Set the alarm
+                status = run_once(engine, session, load_state(), archive_dir, args.infer_passages, args.prediction_history)
+
+            session.close()
+            engine.dispose()
         finally:
             lock.release()
     except TimeoutError as e:
@@ -251,6 +762,8 @@ def main():
     end_time = datetime.now()
     execution_time = end_time - start_time
     print(f"Script execution time: {execution_time.total_seconds():.2f} seconds")
+    if status == 'unavailable':
+        sys.exit(EXIT_UNAVAILABLE)
 
 if __name__ == "__main__":
     main()